@@ -0,0 +1,212 @@
+import glob
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+from docarray import Document, DocumentArray
+
+from . import __version__
+from .helper import cache_dir, logger
+
+# keys that only affect how and where a run is reported, but not the final images
+_VOLATILE_KEYS = {
+    'name_docarray',
+    'batch_name',
+    'display_rate',
+    'save_rate',
+    'checkpoint_rate',
+    'gif_fps',
+    'gif_size_ratio',
+    'image_output',
+    'spill_batches',
+    'text_clip_residency',
+}
+
+
+def _mtime(f: str) -> float:
+    try:
+        return os.path.getmtime(f)
+    except OSError:
+        return 0
+
+
+def _remove(f: str) -> None:
+    try:
+        os.remove(f)
+    except OSError:
+        pass
+
+
+class TextEmbedsCache:
+    """
+    A content-addressed on-disk cache of CLIP text embeddings.
+
+    Each embedding is stored as a ``.npy`` file named by the hash of (CLIP model name, tokenized prompt, truncate flag,
+    placement) and is memory-mapped on read. The placement is the device type and dtype of the text tower, e.g.
+    ``cuda-torch.float16``, as OpenAI models on GPU give fp16 embeddings that differ from those on CPU. The
+    modification time of a file is used as its last-access time, the least recently used entries are evicted once
+    the cache holds more than ``max_entries`` embeddings.
+    """
+
+    def __init__(self, root: str, max_entries: int = 4096):
+        self.root = root
+        self.max_entries = max_entries
+        Path(root).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _get_key(model_name: str, text: str, truncate: bool, placement: str) -> str:
+        return hashlib.sha256(
+            f'{model_name}\n{int(bool(truncate))}\n{placement}\n{text}'.encode('utf-8')
+        ).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.root, f'{key}.npy')
+
+    def get(
+        self, model_name: str, text: str, truncate: bool, placement: str
+    ) -> Optional[np.ndarray]:
+        path = self._get_path(self._get_key(model_name, text, truncate, placement))
+        try:
+            embeds = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        logger.debug(f'text embedding of `{text}` on {model_name} is loaded from cache')
+        return embeds
+
+    def put(
+        self,
+        model_name: str,
+        text: str,
+        truncate: bool,
+        placement: str,
+        embeds: np.ndarray,
+    ):
+        path = self._get_path(self._get_key(model_name, text, truncate, placement))
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as fp:
+                np.save(fp, embeds)
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            logger.debug(f'can not cache text embedding of `{text}`: {ex}')
+            return
+        self._evict()
+
+    def _evict(self):
+        all_files = glob.glob(os.path.join(self.root, '*.npy'))
+        if len(all_files) <= self.max_entries:
+            return
+
+        all_files.sort(key=_mtime)
+        for f in all_files[: len(all_files) - self.max_entries]:
+            _remove(f)
+
+
+def get_text_embeds_cache() -> Optional[TextEmbedsCache]:
+    if 'DISCOART_DISABLE_TEXT_EMBEDS_CACHE' in os.environ:
+        return None
+    return TextEmbedsCache(
+        os.path.join(cache_dir, 'text_embeds'),
+        max_entries=int(os.environ.get('DISCOART_TEXT_EMBEDS_CACHE_SIZE', 4096)),
+    )
+
+
+def get_result_key(cfg: Dict) -> Optional[str]:
+    """
+    Return the hash of a config given by :func:`discoart.config.load_config`, the seed included.
+
+    Private keys and keys that do not change the final images, e.g. `name_docarray`, are excluded. A local
+    `init_image` is hashed by its content, so that editing the file changes the key. None is returned if the
+    `init_image` is a remote URL, as its content can change without notice.
+    """
+    cfg = {
+        k: v
+        for k, v in cfg.items()
+        if not k.startswith('_') and k not in _VOLATILE_KEYS
+    }
+    init_image = cfg.get('init_image')
+    if init_image and not init_image.startswith('data:'):
+        if not os.path.isfile(init_image):
+            return None
+        with open(init_image, 'rb') as fp:
+            cfg['init_image'] = hashlib.sha256(fp.read()).hexdigest()
+    return hashlib.sha256(
+        json.dumps(
+            [__version__, cfg], sort_keys=True, default=str, ensure_ascii=False
+        ).encode('utf-8')
+    ).hexdigest()
+
+
+class ResultCache:
+    """
+    An on-disk cache of the final Documents of finished runs, keyed by :func:`get_result_key`.
+
+    Each run is stored as a ``.protobuf.lz4`` file of its final Documents without their intermediate chunks. As in
+    :class:`TextEmbedsCache`, the modification time of a file is its last-access time, the least recently used runs
+    are evicted once the cache is larger than ``max_size`` bytes.
+    """
+
+    def __init__(self, root: str, max_size: int = 1 << 30):
+        self.root = root
+        self.max_size = max_size
+        Path(root).mkdir(parents=True, exist_ok=True)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.root, f'{key}.protobuf.lz4')
+
+    def get(self, key: str) -> Optional[DocumentArray]:
+        path = self._get_path(key)
+        try:
+            da = DocumentArray.load_binary(path)
+            os.utime(path)
+        except Exception:
+            return None
+        logger.debug(f'results of {key} are loaded from cache')
+        return da
+
+    def put(self, key: str, da: DocumentArray) -> None:
+        path = self._get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as fp:
+                fp.write(
+                    DocumentArray(
+                        Document(id=d.id, tags=d.tags, uri=d.uri) for d in da
+                    ).to_bytes(protocol='protobuf', compress='lz4')
+                )
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            logger.debug(f'can not cache results of {key}: {ex}')
+            return
+        self._evict()
+
+    def _evict(self):
+        all_files = glob.glob(os.path.join(self.root, '*.protobuf.lz4'))
+        sizes = {}
+        for f in all_files:
+            try:
+                sizes[f] = os.path.getsize(f)
+            except OSError:
+                pass
+        total_size = sum(sizes.values())
+        if total_size <= self.max_size:
+            return
+
+        for f in sorted(sizes, key=_mtime):
+            if total_size <= self.max_size:
+                break
+            _remove(f)
+            total_size -= sizes[f]
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    if 'DISCOART_DISABLE_RESULT_CACHE' in os.environ:
+        return None
+    return ResultCache(
+        os.path.join(cache_dir, 'results'),
+        max_size=int(os.environ.get('DISCOART_RESULT_CACHE_SIZE', 1024)) << 20,
+    )
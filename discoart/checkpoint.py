@@ -0,0 +1,83 @@
+import inspect
+import os
+from typing import Dict, Optional
+
+import torch
+
+from .helper import logger, get_output_dir
+
+_CHECKPOINT_NAME = 'checkpoint.pt'
+
+
+def get_checkpoint_path(output_dir: str) -> str:
+    return os.path.join(output_dir, _CHECKPOINT_NAME)
+
+
+def new_checkpoint(
+    config: Dict,
+    nb: int,
+    step: Optional[int] = None,
+    sample: Optional[Dict] = None,
+    init: Optional['torch.Tensor'] = None,
+    rng_state: Optional[Dict] = None,
+    doc_ids=None,
+    telemetry: Optional[Dict] = None,
+    order: int = 2,
+) -> Dict:
+    """
+    Create the checkpoint of a run, all tensors are copied to the CPU.
+
+    :param config: the config of the run, with its original seed
+    :param nb: the batch to continue
+    :param step: the last finished step of batch `nb`, None if batch `nb` has not started yet
+    :param sample: the output of the sampler at `step`
+    :param init: the init image of batch `nb`
+    :param rng_state: the state of the random generators after `step`
+    :param doc_ids: the ids of the documents of batch `nb`
+    :param telemetry: the telemetry snapshot of batch `nb`
+    :param order: the order of PLMS, i.e. the number of its history steps to keep
+    :return: the checkpoint as a dict
+    """
+    ckpt = {'config': config, 'nb': nb, 'step': step}
+    if step is not None:
+        old_eps = sample.get('old_eps')
+        ckpt.update(
+            {
+                'x': sample['sample'].detach().cpu(),
+                'old_eps': [e.detach().cpu() for e in old_eps[-order:]]
+                if old_eps
+                else None,
+                'init': init.detach().cpu() if init is not None else None,
+                'rng_state': rng_state,
+                'doc_ids': list(doc_ids),
+                'telemetry': telemetry,
+            }
+        )
+    return ckpt
+
+
+def save_checkpoint(path: str, ckpt: Dict) -> None:
+    tmp_path = f'{path}.tmp'
+    torch.save(ckpt, tmp_path)
+    os.replace(tmp_path, path)
+    logger.debug(f'checkpoint of batch {ckpt["nb"]} step {ckpt["step"]} to {path}')
+
+
+def load_checkpoint(resume_from: str) -> Dict:
+    """
+    Load the checkpoint of a run.
+
+    :param resume_from: the path of the checkpoint file, or the output folder or the `name_docarray` of the run
+    :return: the checkpoint as a dict
+    """
+    path = resume_from
+    if not os.path.isfile(path):
+        output_dir = path if os.path.isdir(path) else get_output_dir(path)
+        path = get_checkpoint_path(output_dir)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'can not find the checkpoint of `{resume_from}`')
+    kwargs = {}
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        # the checkpoint holds the config and the random states besides tensors
+        kwargs['weights_only'] = False
+    return torch.load(path, map_location='cpu', **kwargs)
@@ -6,10 +6,10 @@ from types import SimpleNamespace
 from typing import Dict, Union, Optional, Tuple
 
 import yaml
-from docarray import DocumentArray, Document
 from yaml import Loader
 
 from . import __resources_path__, __version__
+from .schedule import _SCHEDULE_KEYS, compact_schedule
 
 with open(
     os.environ.get(
@@ -52,6 +52,31 @@ def load_config(
 
         cfg.update(**user_config)
 
+    # list-valued schedules are kept as compact scheduling strings
+    for k in _SCHEDULE_KEYS:
+        cfg[k] = compact_schedule(cfg[k])
+
+    if isinstance(cfg.get('clip_models_schedules'), dict):
+        cfg['clip_models_schedules'] = {
+            k: compact_schedule(v) for k, v in cfg['clip_models_schedules'].items()
+        }
+
+    if isinstance(cfg['text_prompts'], dict) and isinstance(
+        cfg['text_prompts'].get('prompts'), list
+    ):
+        cfg['text_prompts'] = {
+            **cfg['text_prompts'],
+            'prompts': [
+                {
+                    k: compact_schedule(v) if k in ('weight', 'schedule') else v
+                    for k, v in p.items()
+                }
+                if isinstance(p, dict)
+                else p
+                for p in cfg['text_prompts']['prompts']
+            ],
+        }
+
     int_keys = {k for k, v in default_args.items() if isinstance(v, int)}
     int_keys = int_keys.union({'seed', 'cut_overview', 'cut_innercut'})
 
@@ -208,6 +233,8 @@ def save_config(
 
 
 def _extract_config_from_docs(docs):
+    from docarray import DocumentArray, Document
+
     cfg = None
 
     if isinstance(docs, DocumentArray):
@@ -10,10 +10,7 @@ import numpy as np
 if TYPE_CHECKING:
     import threading
     import asyncio
-
-from docarray import DocumentArray, Document
-
-_clip_models_cache = {}
+    from docarray import DocumentArray, Document
 
 
 # begin_create_overload
@@ -21,6 +18,7 @@ _clip_models_cache = {}
 def create(
     batch_name: Optional[str] = None,
     batch_size: Optional[int] = 1,
+    checkpoint_rate: Optional[int] = 0,
     clamp_grad: Optional[Union[bool, str]] = True,
     clamp_max: Optional[Union[float, str]] = 0.05,
     clip_denoised: Optional[bool] = False,
@@ -31,6 +29,7 @@ def create(
         'RN50::openai',
     ],
     clip_models_schedules: Optional[Dict[str, Union[str, List[str]]]] = None,
+    cut_batch_memory_budget: Optional[int] = 0,
     cut_ic_pow: Optional[Union[float, str]] = 1.0,
     cut_icgray_p: Optional[Union[float, str]] = '[0.2]*400+[0]*600',
     cut_innercut: Optional[Union[float, str]] = '[4]*400+[12]*600',
@@ -47,6 +46,7 @@ def create(
     image_output: Optional[bool] = True,
     init_document: Optional[Union['Document', 'DocumentArray']] = None,
     init_image: Optional[str] = None,
+    init_loss_size: Optional[int] = None,
     init_scale: Optional[Union[int, str]] = 1000,
     n_batches: Optional[int] = 4,
     name_docarray: Optional[str] = None,
@@ -56,18 +56,22 @@ def create(
     rand_mag: Optional[float] = 0.05,
     randomize_class: Optional[bool] = True,
     range_scale: Optional[Union[int, str]] = 150,
+    resume_from: Optional[str] = None,
     sat_scale: Optional[Union[int, str]] = 0,
     save_rate: Optional[int] = 20,
     seed: Optional[int] = None,
+    share_innercut_geometry: Optional[bool] = False,
     skip_event: Optional[
         Union['multiprocessing.Event', 'asyncio.Event', 'threading.Event']
     ] = None,
     skip_steps: Optional[int] = 0,
+    spill_batches: Optional[bool] = False,
     steps: Optional[int] = 250,
     stop_event: Optional[
         Union['multiprocessing.Event', 'asyncio.Event', 'threading.Event']
     ] = None,
     text_clip_on_cpu: Optional[bool] = False,
+    text_clip_residency: Optional[str] = 'offload',
     text_prompts: Optional[Union[List[str], Dict[str, Any]]] = [
         'A beautiful painting of a singular lighthouse, shining its light across a tumultuous sea of blood by greg rutkowski and thomas kinkade, Trending on artstation.',
         'yellow color scheme',
@@ -100,12 +104,14 @@ def create(**kwargs) -> Optional['DocumentArray']:
 
     :param batch_name: The name of the batch, the batch id will be named as "discoart-[batch_name]-[uuid]". To avoid your artworks be overridden by other users, please use a unique name.
     :param batch_size: [DiscoArt] The number of samples generated at each steps. Say `batch_size=3`, then you can generate three images in one run. Not only this is faster than three runs, but it leverages loss function better and potentially yields higher quality images.One can of course also do `n_batches=3` and `batch_size=1` to generate three images in one run. But using `batch_size=3` is marginally faster and yield higher quality images.High `batch_size` can lead to OOM.
+    :param checkpoint_rate: [DiscoArt] The number of steps between two checkpoints of the sampler state, i.e. the current image, the PLMS history and the random states, saved to `checkpoint.pt` in the output folder. A run that is interrupted, e.g. by the preemption of a spot instance, continues exactly from its last checkpoint via `create(resume_from=...)`. 0 means no checkpoint.
     :param clamp_grad: As I understand it, clamp_grad is an internal limiter that stops DD from producing extreme results.  Try your images with and without clamp_grad. If the image changes drastically with clamp_grad turned off, it probably means your clip_guidance_scale is too high and should be reduced.[DiscoArt] Can be scheduled via syntax `[val1]*400+[val2]*600`.
     :param clamp_max: Sets the value of the clamp_grad limitation. Default is 0.05, providing for smoother, more muted coloration in images, but setting higher values (0.15-0.3) can provide interesting contrast and vibrancy.[DiscoArt] Can be scheduled via syntax `[val1]*400+[val2]*600`.
     :param clip_denoised: Determines whether CLIP discriminates a noisy or denoised image
     :param clip_guidance_scale: CGS is one of the most important parameters you will use. It tells DD how strongly you want CLIP to move toward your prompt each timestep.  Higher is generally better, but if CGS is too strong it will overshoot the goal and distort the image. So a happy medium is needed, and it takes experience to learn how to adjust CGS. Note that this parameter generally scales with image dimensions. In other words, if you increase your total dimensions by 50% (e.g. a change from 512 x 512 to 512 x 768), then to maintain the same effect on the image, you’d want to increase clip_guidance_scale from 5000 to 7500. Of the basic settings, clip_guidance_scale, steps and skip_steps are the most important contributors to image quality, so learn them well.
     :param clip_models: [DiscoArt] CLIP Model selectors provided by open-clip package. These various CLIP models are available for you to use during image generation.  Models have different styles or ‘flavors,’ so look around.  You can mix in multiple models as well for different results. However, keep in mind that some models are extremely memory-hungry, and turning on additional models will take additional memory and may cause a crash.Also supported open_clip pretrained models, use `::` to separate model name and pretrained weight name, e.g. `ViT-B/32::laion2b_e16`. Full list of models and weights can be found here: https://github.com/mlfoundations/open_clip#pretrained-model-interface RN50::openai RN50::yfcc15m RN50::cc12m RN50-quickgelu::openai RN50-quickgelu::yfcc15m RN50-quickgelu::cc12m RN101::openai RN101::yfcc15m RN101-quickgelu::openai RN101-quickgelu::yfcc15m RN50x4::openai RN50x16::openai RN50x64::openai ViT-B-32::openai ViT-B-32::laion2b_e16 ViT-B-32::laion400m_e31 ViT-B-32::laion400m_e32 ViT-B-32-quickgelu::openai ViT-B-32-quickgelu::laion400m_e31 ViT-B-32-quickgelu::laion400m_e32 ViT-B-16::openai ViT-B-16::laion400m_e31 ViT-B-16::laion400m_e32 ViT-B-16-plus-240::laion400m_e31 ViT-B-16-plus-240::laion400m_e32 ViT-L-14::openai ViT-L-14-336::openai
     :param clip_models_schedules: [DiscoArt] A dictionary of string to boolean list that represents on/off of CLIP models at each step. CLIP Model schedules use a similar mechanism to cut_overview and `cut_innercut`. For example, `{"RN101::openai": "[True]*400+[False]*600"}` schedules RN101 to run for the first 40% of steps and then is no longer used for the remaining steps. `[True]*1000` is equivalent to always on and is the default if this parameter is not set. Note, the model must be included in the `clip_models` otherwise this parameter is ignored.
+    :param cut_batch_memory_budget: [DiscoArt] The memory budget in MB for the cuts of one CLIP model. When set, the `cutn_batches` of a CLIP model are concatenated into micro-batches that fit into this budget, each micro-batch runs one forward and backward pass through the CLIP model. The gradient is the same as running the cutn batches one by one, so `cutn_batches` then mostly trades memory for quality instead of time. 0 means one pass per cutn batch.
     :param cut_ic_pow: This sets the size of the border used for inner cuts.  High cut_ic_pow values have larger borders, and therefore the cuts themselves will be smaller and provide finer details.  If you have too many or too-small inner cuts, you may lose overall image coherency and/or it may cause an undesirable ‘mosaic’ effect.   Low cut_ic_pow values will allow the inner cuts to be larger, helping image coherency while still helping with some details.[DiscoArt] This can be a list of floats that represents the value at different steps, the syntax follows the same as `cut_overview`.
     :param cut_icgray_p: In addition to the overall cut schedule, a portion of the cuts can be set to be grayscale instead of color. This may help with improved definition of shapes and edges, especially in the early diffusion steps where the image structure is being defined.
     :param cut_innercut: The schedule of inner cuts, which are smaller cropped images from the interior of the image, helpful in tuning fine details. The size of the inner cuts can be adjusted using the `cut_ic_pow` parameter.
@@ -122,6 +128,7 @@ def create(**kwargs) -> Optional['DocumentArray']:
     :param image_output: [DiscoArt] If set, then output will be saved as images. This includes intermediate, final results in the form of PNG and GIF. If set to False, then no images will be saved, everything will be saved in a Protobuf LZ4 format. https://docarray.jina.ai/fundamentals/documentarray/serialization/#from-to-bytes
     :param init_document: [DiscoArt] Use a Document object as the initial state for DD: its ``.tags`` will be used as parameters, ``.uri`` (if present) will be used as init image.
     :param init_image: Recall that in the image sequence above, the first image shown is just noise.  If an init_image is provided, diffusion will replace the noise with the init_image as its starting state.  To use an init_image, upload the image to the Colab instance or your Google Drive, and enter the full image path here. If using an init_image, you may need to increase skip_steps to ~ 50% of total steps to retain the character of the init. See skip_steps above for further discussion.
+    :param init_loss_size: [DiscoArt] The size of the shorter side that the image and the init image are downsampled to before computing the LPIPS loss of `init_scale`, which makes this loss faster and take less memory on large images. If not set, the loss is computed at the full resolution.
     :param init_scale: This controls how strongly CLIP will try to match the init_image provided.  This is balanced against the clip_guidance_scale (CGS) above.  Too much init scale, and the image won’t change much during diffusion. Too much CGS and the init image will be lost.[DiscoArt] Can be scheduled via syntax `[val1]*400+[val2]*600`.
     :param n_batches: This variable sets the number of still images you want DD to create.  If you are using an animation mode (see below for details) DD will ignore n_batches and create a single set of animated frames based on the animation settings.
     :param name_docarray: [DiscoArt] When specified, it overrides the default naming schema of the resulted DocumentArray. Useful when you have to know the result DocumentArray name in advance.The name also supports variable substitution via `{}`. For example, `name_docarray='test-{steps}-{perlin_init}'` will give the name of the DocumentArray as `test-250-False`. Any variable in the config can be substituted.
@@ -131,14 +138,18 @@ def create(**kwargs) -> Optional['DocumentArray']:
     :param rand_mag: Affects only the fuzzy_prompt.  Controls the magnitude of the random noise added by fuzzy_prompt.
     :param randomize_class: Controls whether the imagenet class is randomly changed each iteration
     :param range_scale: Optional, set to zero to turn off.  Used for adjustment of color contrast.  Lower range_scale will increase contrast. Very low numbers create a reduced color palette, resulting in more vibrant or poster-like images. Higher range_scale will reduce contrast, for more muted images.[DiscoArt] Can be scheduled via syntax `[val1]*400+[val2]*600`.
+    :param resume_from: [DiscoArt] Continue an interrupted run from its last checkpoint, see `checkpoint_rate`. It can be the path of `checkpoint.pt`, the output folder or the `name_docarray` of the run. The config is restored from the checkpoint, kwargs given together with it override the config. The run continues in the same output folder and keeps the results saved before the checkpoint.
     :param sat_scale: Saturation scale. Optional, set to zero to turn off.  If used, sat_scale will help mitigate oversaturation. If your image is too saturated, increase sat_scale to reduce the saturation.[DiscoArt] Can be scheduled via syntax `[val1]*400+[val2]*600`.
     :param save_rate: [DiscoArt] The number of steps to save intermediate results. It is a replacement to original `display_rate` parameter. Set it to -1 for not saving any intermediate result.
     :param seed: Deep in the diffusion code, there is a random number ‘seed’ which is used as the basis for determining the initial state of the diffusion.  By default, this is random, but you can also specify your own seed.  This is useful if you like a particular result and would like to run more iterations that will be similar. After each run, the actual seed value used will be reported in the parameters report, and can be reused if desired by entering seed # here.  If a specific numerical seed is used repeatedly, the resulting images will be quite similar but not identical.
+    :param share_innercut_geometry: [DiscoArt] If set, then all CLIP models use the same inner cuts (i.e. the same crop positions and sizes) at each step. CLIP models with the same input resolution then share the resized cuts as well, which saves the time of resizing when using many CLIP models. The random augmentations are still different for each CLIP model.
     :param skip_event: [DiscoArt] A multiprocessing/asyncio/threading.Event that once set, will skip the current run and move to the next run as defined in `n_batches`.
     :param skip_steps: Consider the chart shown here.  Noise scheduling (denoise strength) starts very high and progressively gets lower and lower as diffusion steps progress. The noise levels in the first few steps are very high, so images change dramatically in early steps.As DD moves along the curve, noise levels (and thus the amount an image changes per step) declines, and image coherence from one step to the next increases.The first few steps of denoising are often so dramatic that some steps (maybe 10-15% of total) can be skipped without affecting the final image. You can experiment with this as a way to cut render times.If you skip too many steps, however, the remaining noise may not be high enough to generate new content, and thus may not have ‘time left’ to finish an image satisfactorily.Also, depending on your other settings, you may need to skip steps to prevent CLIP from overshooting your goal, resulting in ‘blown out’ colors (hyper saturated, solid white, or solid black regions) or otherwise poor image quality.  Consider that the denoising process is at its strongest in the early steps, so skipping steps can sometimes mitigate other problems.Lastly, if using an init_image, you will need to skip ~50% of the diffusion steps to retain the shapes in the original init image. However, if you’re using an init_image, you can also adjust skip_steps up or down for creative reasons.  With low skip_steps you can get a result "inspired by" the init_image which will retain the colors and rough layout and shapes but look quite different. With high skip_steps you can preserve most of the init_image contents and just do fine tuning of the texture.
+    :param spill_batches: [DiscoArt] If set, then every finished batch is moved out of memory into the SQLite file `da.sqlite` in the output folder, and the returned DocumentArray is backed by this file, i.e. documents and their chunks are loaded on demand. This keeps the memory bounded by a single batch when running many `n_batches`. The cloud backup then pushes every batch on its own, i.e. batch `i` can be pulled as `[name_docarray]-[i]`.
     :param steps: When creating an image, the denoising curve is subdivided into steps for processing. Each step (or iteration) involves the AI looking at subsets of the image called ‘cuts’ and calculating the ‘direction’ the image should be guided to be more like the prompt. Then it adjusts the image with the help of the diffusion denoiser, and moves to the next step.Increasing steps will provide more opportunities for the AI to adjust the image, and each adjustment will be smaller, and thus will yield a more precise, detailed image.  Increasing steps comes at the expense of longer render times.  Also, while increasing steps should generally increase image quality, there is a diminishing return on additional steps beyond 250 - 500 steps.  However, some intricate images can take 1000, 2000, or more steps.  It is really up to the user.  Just know that the render time is directly related to the number of steps, and many other parameters have a major impact on image quality, without costing additional time.
     :param stop_event: [DiscoArt] A multiprocessing/asyncio/threading.Event that once set, will stop all generation of `n_batches` and immediately return from `create`.
     :param text_clip_on_cpu: [DiscoArt] Place text transformers of CLIP models on CPU. This saves more VRAM and will not hurt the speed at all on T4, P100, 3090; however, there are few community members report issue on V100 when it is `False`.
+    :param text_clip_residency: [DiscoArt] What happens to the text transformers of CLIP models once the prompts are encoded, only the visual arms are used afterwards. Can be 'keep', 'offload' and 'release'. If 'keep', they stay where they are. If 'offload', they are moved to CPU memory, and moved back when a later run encodes new prompts. If 'release', their memory is freed, and they are loaded again from the CLIP checkpoint when a later run encodes new prompts. Prompts found in the cache of text embeddings are never encoded again. A CLIP model shared by concurrent runs is only offloaded or released once none of them is encoding prompts.
     :param text_prompts: Phrase, sentence, or string of words and phrases describing what the image should look like.  The words will be analyzed by the AI and will guide the diffusion process toward the image(s) you describe. These can include commas and weights to adjust the relative importance of each element.  E.g. "A beautiful painting of a singular lighthouse, shining its light across a tumultuous sea of blood by greg rutkowski and thomas kinkade, Trending on artstation."Notice that this prompt loosely follows a structure: [subject], [prepositional details], [setting], [meta modifiers and artist]; this is a good starting point for your experiments. Developing text prompts takes practice and experience, and is not the subject of this guide.  If you are a beginner to writing text prompts, a good place to start is on a simple AI art app like Night Cafe, starry ai or WOMBO prior to using DD, to get a feel for how text gets translated into images by GAN tools.  These other apps use different technologies, but many of the same principles apply.You can add weight at the end of each prompt string, say `:10` for positive weights and `:-3` for negative weights. [DiscoArt] Unlike original DD notebook, `text_prompts` does not need to be indexed by the timestamp. It is a list of strings.
     :param transformation_percent: Steps expressed in percentages in which the symmetry is enforced
     :param truncate_overlength_prompt: [DiscoArt] all CLIP models use 77 as the context length. Set this parameter truncates the prompt to the length of the model's context length.
@@ -159,7 +170,22 @@ def create(**kwargs) -> Optional['DocumentArray']:
 
     from .config import load_config, print_args_table
 
-    if 'init_document' in kwargs:
+    resume_from = kwargs.pop('resume_from', None)
+    checkpoint = None
+    if resume_from:
+        from .checkpoint import load_checkpoint
+
+        checkpoint = load_checkpoint(resume_from)
+        _kwargs = copy.deepcopy(checkpoint['config'])
+        if kwargs:
+            warnings.warn(
+                'resume_from restores the config of the checkpoint, but kwargs are also present, will override the config'
+            )
+            _kwargs.update(kwargs)
+        _args = load_config(user_config=_kwargs)
+    elif 'init_document' in kwargs:
+        from docarray import DocumentArray
+
         d = kwargs['init_document']
         _kwargs = {}
         if d:
@@ -186,28 +212,47 @@ def create(**kwargs) -> Optional['DocumentArray']:
         _args = load_config(user_config=kwargs)
 
     print_args_table(_args)
+
+    from .cache import get_result_cache, get_result_key
+
+    result_cache = get_result_cache()
+    # the key is taken before the run, as the run updates the seed of each batch
+    result_key = get_result_key(_args)
+    if result_key is None:
+        # the init image is a remote URL, its content can change between runs
+        result_cache = None
     _args = SimpleNamespace(**_args)
 
     from .helper import (
-        load_diffusion_model,
-        load_clip_models,
-        load_secondary_model,
         get_device,
         free_memory,
         show_result_summary,
         get_output_dir,
+        logger,
+        start_remote_checks,
     )
+    from .store import load_results
 
-    device = get_device()
-    model, diffusion = load_diffusion_model(_args, device=device)
+    start_remote_checks()
 
-    clip_models = load_clip_models(
-        device,
-        enabled=_args.clip_models,
-        clip_models=_clip_models_cache,
-        text_clip_on_cpu=_args.text_clip_on_cpu,
-    )
-    secondary_model = load_secondary_model(_args, device=device)
+    if result_cache and not checkpoint:
+        da = result_cache.get(result_key)
+        if da is not None:
+            logger.info(
+                f'`{_args.name_docarray}` has the same config and seed as a cached run, loading its results'
+            )
+            _save_cached_results(da, _args)
+            if (
+                'DISCOART_DISABLE_RESULT_SUMMARY' not in os.environ
+                and 'DISCOART_DISABLE_IPYTHON' not in os.environ
+            ):
+                show_result_summary(da, _args.name_docarray, _args)
+            return da
+
+    from .startup import prepare_run
+
+    device = get_device()
+    models, prompts, _ = prepare_run(_args, device=device)
 
     free_memory()
     is_exit0 = False
@@ -216,11 +261,15 @@ def create(**kwargs) -> Optional['DocumentArray']:
 
         da = do_run(
             _args,
-            (model, diffusion, clip_models, secondary_model),
+            models,
             device=device,
             events=events,
+            checkpoint=checkpoint,
+            prompts=prompts,
         )
         is_exit0 = True
+        if result_cache and _is_finished(da, _args):
+            result_cache.put(result_key, da)
         return da
     except KeyboardInterrupt:
         is_exit0 = True
@@ -229,11 +278,9 @@ def create(**kwargs) -> Optional['DocumentArray']:
 
         _name = _args.name_docarray
 
-        pb_path = os.path.join(get_output_dir(_name), 'da.protobuf.lz4')
-
-        if os.path.exists(pb_path) and is_exit0:
-            _da = DocumentArray.load_binary(pb_path)
+        _da = load_results(get_output_dir(_name)) if is_exit0 else None
 
+        if _da is not None:
             if (
                 'DISCOART_DISABLE_RESULT_SUMMARY' not in os.environ
                 and 'DISCOART_DISABLE_IPYTHON' not in os.environ
@@ -241,6 +288,31 @@ def create(**kwargs) -> Optional['DocumentArray']:
                 show_result_summary(_da, _name, _args)
 
 
+def _is_finished(da: 'DocumentArray', args: SimpleNamespace) -> bool:
+    """Return True if `da` has all final images of the run, i.e. it was not stopped or skipped."""
+    return len(da) == args.n_batches * args.batch_size and all(
+        d.tags.get('_status', {}).get('completed') for d in da
+    )
+
+
+def _save_cached_results(da: 'DocumentArray', args: SimpleNamespace) -> None:
+    """Save the cached results of a run to the output folder of `args`, as if the run was done again."""
+    from .cache import _VOLATILE_KEYS
+    from .helper import get_output_dir
+    from .store import ResultStore
+
+    output_dir = get_output_dir(args.name_docarray)
+    for idx, d in enumerate(da):
+        d.tags.update({k: v for k, v in vars(args).items() if k in _VOLATILE_KEYS})
+        if args.image_output:
+            _nb, k = divmod(idx, args.batch_size)
+            d.save_uri_to_file(os.path.join(output_dir, f'{_nb}-done-{k}.png'))
+
+    store = ResultStore(output_dir)
+    store.append(da)
+    store.compact()
+
+
 def go_big(
     doc: 'Document',
     window_size: int = 256,
@@ -276,6 +348,8 @@ def go_big(
 
     old_args = SimpleNamespace(**load_config(user_config=doc.tags))
 
+    from docarray import Document
+
     d = Document(doc, copy=True)
 
     d.chunks.clear()
@@ -1,5 +1,4 @@
 import asyncio
-import os
 from typing import Dict
 
 from jina import Executor, requests, DocumentArray
@@ -38,10 +37,6 @@ class ResultPoller(Executor):
     @requests(on='/result')
     def poll_results(self, parameters: Dict, **kwargs):
         from discoart.helper import get_output_dir
+        from discoart.store import load_results
 
-        path = os.path.join(
-            get_output_dir(parameters['name_docarray']),
-            'da.protobuf.lz4',
-        )
-        if os.path.exists(path):
-            return DocumentArray.load_binary(path)
+        return load_results(get_output_dir(parameters['name_docarray']))
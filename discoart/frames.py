@@ -0,0 +1,69 @@
+import base64
+import io
+import mimetypes
+import os
+from typing import Optional
+
+from docarray import Document, DocumentArray
+
+
+def new_frame(
+    image: 'PIL.Image.Image', tags: dict, path: Optional[str] = None
+) -> Document:
+    """
+    Create the Document of an intermediate frame without encoding it as a data URI.
+
+    :param image: the frame
+    :param tags: the tags of the frame
+    :param path: the file the frame is saved to, if any. The Document then only refers to this file, otherwise it
+        keeps the frame as PNG bytes in `.blob`, which are much smaller than the raw pixels.
+    :return: the Document of the frame
+    """
+    if path:
+        return Document(tags=tags, uri=os.path.abspath(path))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return Document(tags=tags, blob=buffer.getvalue(), mime_type='image/png')
+
+
+def get_datauri(d: Document) -> str:
+    """
+    Return the image of `d` as a data URI, it is read from the file `d.uri` refers to, or encoded from `d.blob` or
+    `d.tensor`.
+    """
+    if d.uri:
+        if d.uri.startswith('data:'):
+            return d.uri
+        with open(d.uri, 'rb') as fp:
+            mime_type = mimetypes.guess_type(d.uri)[0] or 'image/png'
+            return f'data:{mime_type};base64,' + base64.b64encode(fp.read()).decode()
+    if d.blob:
+        mime_type = d.mime_type or 'image/png'
+        return f'data:{mime_type};base64,' + base64.b64encode(d.blob).decode()
+    if d.tensor is not None:
+        return Document(tensor=d.tensor).convert_image_tensor_to_uri().uri
+    return ''
+
+
+def to_datauri_document(d: Document, chunks=None) -> Document:
+    """
+    Return a copy of `d` for serialization, where the images of `d` and its chunks are data URIs.
+
+    :param d: the Document
+    :param chunks: the chunks to copy, defaults to all chunks of `d`
+    :return: a copy of `d` that shares the tags with `d`
+    """
+    return Document(
+        id=d.id,
+        tags=d.tags,
+        uri=get_datauri(d),
+        chunks=[
+            Document(id=c.id, tags=c.tags, uri=get_datauri(c))
+            for c in (d.chunks if chunks is None else chunks)
+        ],
+    )
+
+
+def to_datauri_documents(da: DocumentArray) -> DocumentArray:
+    """Return a copy of `da` for serialization, see :func:`to_datauri_document`."""
+    return DocumentArray(to_datauri_document(d) for d in da)
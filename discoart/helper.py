@@ -1,9 +1,12 @@
+import functools
 import gc
+import glob
 import hashlib
 import json
 import logging
 import os
 import sys
+import tempfile
 import threading
 import urllib.parse
 import urllib.request
@@ -11,7 +14,7 @@ import warnings
 from os.path import expanduser
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Optional, Tuple
 from urllib.request import Request, urlopen
 
 import pkg_resources
@@ -20,7 +23,6 @@ import torch
 import yaml
 from clip.simple_tokenizer import SimpleTokenizer, whitespace_clean, basic_clean
 from packaging.version import Version
-from spellchecker import SpellChecker
 from tqdm.auto import tqdm
 
 cache_dir = os.environ.get(
@@ -30,6 +32,12 @@ cache_dir = os.environ.get(
 from yaml import Loader
 
 from . import __resources_path__
+from .schedule import (
+    _MAX_DIFFUSION_STEPS,
+    _is_valid_schedule_str,
+    ScheduleTable,
+    compile_schedule,
+)
 
 
 def _get_logger():
@@ -59,12 +67,21 @@ def get_model_list():
 
 
 models_list = get_model_list()
+_models_list_lock = threading.Lock()
+
+
+def _set_models_list(new_models_list: Dict[str, Any]) -> None:
+    # the list is swapped instead of updated in place, as it is iterated by the loaders on other threads
+    global models_list
+    with _models_list_lock:
+        models_list = dict(new_models_list)
 
 
 def get_remote_model_list(local_model_list: Dict[str, Any], force_print: bool = False):
     if 'DISCOART_DISABLE_REMOTE_MODELS' in os.environ:
         return
 
+    remote_model_list = None
     try:
         req = Request(
             os.environ.get(
@@ -110,13 +127,11 @@ def get_remote_model_list(local_model_list: Dict[str, Any], force_print: bool =
             )
 
         print(param_str)
-        local_model_list.clear()
-        local_model_list.update(remote_model_list)
-
-
-threading.Thread(
-    target=get_remote_model_list, args=(models_list, False), daemon=True
-).start()
+        if local_model_list is models_list:
+            _set_models_list(remote_model_list)
+        else:
+            local_model_list.clear()
+            local_model_list.update(remote_model_list)
 
 
 def get_device():
@@ -271,71 +286,127 @@ def _wget(url, outputdir):
         logger.error(f'failed to download {url}')
 
 
-def load_clip_models(
-    device,
-    enabled: List[str],
-    clip_models: Dict[str, Any] = {},
-    text_clip_on_cpu: bool = False,
-):
-    logger.debug('loading clip models...')
-
+def _load_clip_model(name: str, device, text_clip_on_cpu: bool = False):
     if text_clip_on_cpu:
         first_device = torch.device('cpu')
         logger.debug(f'CLIP will be first loaded to CPU')
     else:
         first_device = device
 
-    # load enabled models
-    for k in enabled:
-        if k not in clip_models:
-            if '::' in k and (k.split('::')[-1] != 'openai' or '-quickgelu' in k):
-                # use open_clip loader
-                k1, k2 = k.split('::')
-                logger.debug(f'use open_clip to load {k1}')
-                import open_clip
-
-                m = open_clip.create_model_and_transforms(
-                    k1,
-                    device=first_device,
-                    pretrained=k2,
-                )[0]
-            else:
+    if '::' in name and (name.split('::')[-1] != 'openai' or '-quickgelu' in name):
+        # use open_clip loader
+        k1, k2 = name.split('::')
+        logger.debug(f'use open_clip to load {k1}')
+        import open_clip
+
+        m = open_clip.create_model_and_transforms(
+            k1,
+            device=first_device,
+            pretrained=k2,
+        )[0]
+    else:
 
-                k1 = (
-                    k.replace('B-32::', 'B/32::')
-                    .replace('B-16::', 'B/16::')
-                    .replace('L-14::', 'L/14::')
-                    .replace('L-14-336::', 'L/14@336px::')
-                )
+        k1 = (
+            name.replace('B-32::', 'B/32::')
+            .replace('B-16::', 'B/16::')
+            .replace('L-14::', 'L/14::')
+            .replace('L-14-336::', 'L/14@336px::')
+        )
+
+        if '::' in k1:
+            k1 = k1.split('::')[0]
+
+        logger.debug(f'use openai clip to load {k1}')
+
+        import clip
+
+        m = clip.load(k1, device=first_device, jit=False)[0]
+    m = m.eval().requires_grad_(False)
+    if text_clip_on_cpu:
+        # then the first device is CPU, we now load visual arm back to GPU.
+        m.visual.to(device)
+        logger.debug(f'move {name}.visual to GPU')
+    return m
+
+
+def load_clip_models(
+    device,
+    enabled: List[str],
+    text_clip_on_cpu: bool = False,
+) -> Dict[str, Any]:
+    logger.debug('loading clip models...')
+    from .residency import get_model_cache
+
+    model_cache = get_model_cache()
+    return {
+        k: model_cache.get_or_load(
+            ('clip', k, str(device), text_clip_on_cpu),
+            lambda: _load_clip_model(k, device, text_clip_on_cpu),
+        )
+        for k in enabled
+    }
 
-                if '::' in k1:
-                    k1 = k1.split('::')[0]
 
-                logger.debug(f'use openai clip to load {k1}')
+_VERIFIED_SHA_PATH = os.path.join(cache_dir, 'verified-sha.json')
+_verified_sha_lock = threading.Lock()
 
-                import clip
 
-                m = clip.load(k1, device=first_device, jit=False)[0]
-            clip_models[k] = m.eval().requires_grad_(False)
-            if text_clip_on_cpu:
-                # then the first device is CPU, we now load visual arm back to GPU.
-                m.visual.to(device)
-                logger.debug(f'move {k}.visual to GPU')
+def _get_file_record(path: str) -> Dict[str, Any]:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
 
-    # disable not enabled models to save memory
-    for k in list(clip_models.keys()):
-        if k not in enabled:
-            clip_models.pop(k)
 
-    return clip_models
+def _load_verified_sha() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(_VERIFIED_SHA_PATH) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_verified_sha(path: str, record: Dict[str, Any]) -> None:
+    # models are checked on several threads at startup, each update must see the records of the others
+    with _verified_sha_lock:
+        records = _load_verified_sha()
+        records[path] = record
+        root = os.path.dirname(_VERIFIED_SHA_PATH)
+        try:
+            Path(root).mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=root, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(records, fp)
+                os.replace(tmp_path, _VERIFIED_SHA_PATH)
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        except OSError as ex:
+            logger.debug(f'can not save the verified SHA of {path}: {ex}')
+
+
+def _get_sha(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return the SHA256 of the file at `path`, which is hashed in chunks of `chunk_size` bytes."""
+    path = os.path.abspath(path)
+    record = _get_file_record(path)
+    verified = _load_verified_sha().get(path)
+    # the file is only hashed again if it has changed since its last verification
+    if verified and {k: verified.get(k) for k in record} == record:
+        return verified['sha']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    _save_verified_sha(path, {**record, 'sha': sha.hexdigest()})
+    return sha.hexdigest()
 
 
 def _check_sha(path, expected_sha):
     if 'DISCOART_DISABLE_CHECK_MODEL_SHA' in os.environ:
         return True
     else:
-        with open(path, 'rb') as f:
-            return hashlib.sha256(f.read()).hexdigest() == expected_sha
+        return _get_sha(path) == expected_sha
 
 
 def _get_model_name(name: str) -> str:
@@ -425,9 +496,7 @@ def get_diffusion_config(user_args, device=torch.device('cuda:0')) -> Dict[str,
     return model_config
 
 
-def load_secondary_model(user_args, device=torch.device('cuda:0')):
-    if not user_args.use_secondary_model:
-        return
+def _load_secondary_model(device):
     download_model('secondary')
 
     from discoart.nn.sec_diff import SecondaryDiffusionImageNet2
@@ -443,9 +512,107 @@ def load_secondary_model(user_args, device=torch.device('cuda:0')):
     return secondary_model
 
 
+def load_secondary_model(user_args, device=torch.device('cuda:0')):
+    if not user_args.use_secondary_model:
+        return
+    from .residency import get_model_cache
+
+    return get_model_cache().get_or_load(
+        ('secondary', 'secondary_model_imagenet_2', str(device)),
+        lambda: _load_secondary_model(device),
+    )
+
+
+def load_lpips_model(device):
+    from .residency import get_model_cache
+
+    def _load():
+        import lpips
+
+        return lpips.LPIPS(net='vgg').to(device)
+
+    return get_model_cache().get_or_load(('lpips', 'vgg', str(device)), _load)
+
+
+# the config keys of the diffusion process, the UNet does not depend on them
+_DIFFUSION_KEYS = (
+    'diffusion_steps',
+    'noise_schedule',
+    'timestep_respacing',
+    'use_kl',
+    'predict_xstart',
+    'rescale_timesteps',
+    'rescale_learned_sigmas',
+)
+
+
+def _get_diffusion_model_path(diffusion_model: str) -> Tuple[str, Optional[str]]:
+    """Return the local path of the checkpoint and its expected SHA, None for a customized model."""
+    if os.path.isfile(diffusion_model):
+        return diffusion_model, None
+    _diff_model_name = _get_model_name(diffusion_model)
+    model_filename = os.path.basename(models_list[_diff_model_name]['sources'][0])
+    return (
+        os.path.join(cache_dir, model_filename),
+        models_list[_diff_model_name]['sha'],
+    )
+
+
+def _load_diffusion_model(diffusion_model: str, model_config: Dict[str, Any], device):
+    from guided_diffusion.script_util import create_model
+    from .nn.weights import (
+        get_weights_path,
+        init_empty,
+        load_weights,
+        load_weights_into,
+        save_weights,
+    )
+
+    _model_path, sha = _get_diffusion_model_path(diffusion_model)
+    weights_path = get_weights_path(
+        cache_dir, sha or _get_sha(_model_path), model_config
+    )
+
+    if weights_path and os.path.isfile(weights_path):
+        # the converted weights are memory-mapped, the module is created without allocating its own weights
+        logger.debug(f'loading diffusion model from {weights_path}')
+        with init_empty():
+            model = create_model(**model_config)
+        if model_config['use_fp16']:
+            model.convert_to_fp16()
+        load_weights_into(model, load_weights(weights_path))
+    else:
+        download_model(diffusion_model)
+
+        logger.debug('loading diffusion model...')
+        if sha is None:
+            logger.debug(f'loading customized diffusion model from {diffusion_model}')
+        model = create_model(**model_config)
+        model.load_state_dict(torch.load(_model_path, map_location='cpu'), strict=False)
+        if model_config['use_fp16']:
+            model.convert_to_fp16()
+        if weights_path:
+            try:
+                save_weights(weights_path, model.state_dict())
+            except OSError as ex:
+                logger.debug(f'can not save the weights to {weights_path}: {ex}')
+
+    model.requires_grad_(False).eval().to(device)
+
+    for name, param in model.named_parameters():
+        if 'qkv' in name or 'norm' in name or 'proj' in name:
+            param.requires_grad_()
+
+    return model
+
+
 def load_diffusion_model(user_args, device):
     diffusion_model = user_args.diffusion_model
 
+    if not os.path.isfile(diffusion_model) and not _get_model_name(diffusion_model):
+        # the model may only be on the remote model list
+        _wait_remote_model_list()
+
     _diff_model_name = _get_model_name(diffusion_model)
     if _diff_model_name:
         rec_size = models_list[_diff_model_name].get('recommended_size', None)
@@ -454,47 +621,41 @@ def load_diffusion_model(user_args, device):
                 f'{diffusion_model} is recommended to have width_height {rec_size}, but you are using {user_args.width_height}. This may lead to suboptimal results.'
             )
 
-    download_model(diffusion_model)
-
     model_config = get_diffusion_config(user_args, device=device)
+    diffusion_config = {
+        k: model_config.pop(k) for k in _DIFFUSION_KEYS if k in model_config
+    }
 
-    logger.debug('loading diffusion model...')
-    from guided_diffusion.script_util import (
-        create_model_and_diffusion,
+    from guided_diffusion.script_util import create_gaussian_diffusion
+    from .residency import get_model_cache
+
+    # the UNet is shared by runs with different steps, the precision is part of its config, i.e. `use_fp16`
+    model = get_model_cache().get_or_load(
+        (
+            'diffusion',
+            diffusion_model,
+            json.dumps(model_config, sort_keys=True, default=str),
+            str(device),
+        ),
+        lambda: _load_diffusion_model(diffusion_model, model_config, device),
+    )
+    diffusion = create_gaussian_diffusion(
+        steps=diffusion_config['diffusion_steps'],
+        learn_sigma=model_config['learn_sigma'],
+        **{k: v for k, v in diffusion_config.items() if k != 'diffusion_steps'},
     )
-
-    model, diffusion = create_model_and_diffusion(**model_config)
-    if os.path.isfile(diffusion_model):
-        logger.debug(f'loading customized diffusion model from {diffusion_model}')
-        _model_path = diffusion_model
-    elif _diff_model_name:
-        model_filename = os.path.basename(models_list[_diff_model_name]['sources'][0])
-        _model_path = os.path.join(cache_dir, model_filename)
-    model.load_state_dict(torch.load(_model_path, map_location='cpu'), strict=False)
-    model.requires_grad_(False).eval().to(device)
-
-    for name, param in model.named_parameters():
-        if 'qkv' in name or 'norm' in name or 'proj' in name:
-            param.requires_grad_()
-    if model_config['use_fp16']:
-        model.convert_to_fp16()
-
     return model, diffusion
 
 
 class PromptParser(SimpleTokenizer):
-    def __init__(self, on_misspelled_token: str, **kwargs):
+    def __init__(self, on_misspelled_token: Optional[str] = None, **kwargs):
         super().__init__(**kwargs)
-        self.spell = SpellChecker()
-        from . import __resources_path__
-
-        with open(
-            os.path.join(__resources_path__, 'vocab.txt'), encoding='utf-8'
-        ) as fp:
-            self.spell.word_frequency.load_words(
-                line.strip() for line in fp if len(line.strip()) > 1
-            )
+        from .spell import load_spell_index
+
+        self.spell = load_spell_index()
         self.on_misspelled_token = on_misspelled_token
+        # the same prompts are parsed again and again, their tokens and misspelled tokens are only found once
+        self._tokenize = functools.lru_cache(maxsize=4096)(self._tokenize)
 
     @staticmethod
     def _split_weight(prompt):
@@ -504,48 +665,52 @@ class PromptParser(SimpleTokenizer):
             vals = [prompt, 1]
         return vals[0], float(vals[1])
 
-    def parse(self, text: str, on_misspelled_token=None) -> Tuple[str, float]:
-        text, weight = self._split_weight(text)
+    def _tokenize(
+        self, text: str
+    ) -> Tuple[Tuple[str, ...], Tuple[Tuple[str, Optional[str]], ...]]:
         text = whitespace_clean(basic_clean(text)).lower()
-        all_tokens = []
-        for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            all_tokens.append(token)
-        unknowns = [
-            v
-            for v in self.spell.unknown(all_tokens)
-            if len(v) > 2 and self.spell.correction(v) != v
-        ]
-        if unknowns:
-            pairs = []
-            for v in unknowns:
+        all_tokens = tuple(
+            ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
+            for token in re.findall(self.pat, text)
+        )
+        pairs = []
+        for v in self.spell.unknown(all_tokens):
+            if len(v) > 2:
                 vc = self.spell.correction(v)
-                pairs.append((v, vc))
-                on_misspelled_token = on_misspelled_token or self.on_misspelled_token
-                if on_misspelled_token == 'correct':
-                    for idx, ov in enumerate(all_tokens):
-                        if ov == v:
-                            all_tokens[idx] = vc
-
-            if pairs:
-                warning_str = '\n'.join(
-                    f'Misspelled `{v}`, do you mean `{vc}`?' for v, vc in pairs
-                )
-                if on_misspelled_token == 'raise':
-                    raise ValueError(warning_str)
-                elif on_misspelled_token == 'correct':
-                    logger.warning(
-                        'auto-corrected the following tokens:\n' + warning_str
-                    )
-                else:
-                    logger.warning(
-                        'Found misspelled tokens in the prompt:\n' + warning_str
-                    )
+                if vc != v:
+                    pairs.append((v, vc))
+        return all_tokens, tuple(pairs)
+
+    def parse(self, text: str, on_misspelled_token=None) -> Tuple[str, float]:
+        text, weight = self._split_weight(text)
+        all_tokens, pairs = self._tokenize(text)
+        all_tokens = list(all_tokens)
+        if pairs:
+            on_misspelled_token = on_misspelled_token or self.on_misspelled_token
+            if on_misspelled_token == 'correct':
+                corrections = dict(pairs)
+                all_tokens = [corrections.get(v, v) for v in all_tokens]
+
+            warning_str = '\n'.join(
+                f'Misspelled `{v}`, do you mean `{vc}`?' for v, vc in pairs
+            )
+            if on_misspelled_token == 'raise':
+                raise ValueError(warning_str)
+            elif on_misspelled_token == 'correct':
+                logger.warning('auto-corrected the following tokens:\n' + warning_str)
+            else:
+                logger.warning('Found misspelled tokens in the prompt:\n' + warning_str)
 
         logger.debug(f'prompt: {all_tokens}, weight: {weight}')
         return ' '.join(all_tokens), weight
 
 
+@functools.lru_cache(maxsize=1)
+def get_prompt_parser() -> PromptParser:
+    """Return the prompt parser of the process, which is shared by all runs."""
+    return PromptParser()
+
+
 def free_memory():
     gc.collect()
     torch.cuda.empty_cache()
@@ -595,10 +760,23 @@ To save the full-size images, please check out the instruction in the next secti
 
     print_args_table(vars(_args))
 
-    persist_file = _fl(
-        os.path.join(get_output_dir(_name), 'da.protobuf.lz4'),
-        result_html_prefix=f'▶ Download the local backup (in case cloud storage failed): ',
-    )
+    output_dir = get_output_dir(_name)
+    persist_path = os.path.join(output_dir, 'da.protobuf.lz4')
+    # the snapshot is only complete once the segments are compacted, e.g. not after an interrupted run
+    persist_file = None
+    if os.path.exists(persist_path) and not glob.glob(
+        os.path.join(output_dir, 'da.segments', '*')
+    ):
+        persist_file = _fl(
+            persist_path,
+            result_html_prefix=f'▶ Download the local backup (in case cloud storage failed): ',
+        )
+
+    if getattr(_args, 'spill_batches', False):
+        pull_code = f'''# every batch is pushed on its own with `spill_batches`
+da = DocumentArray.pull('{_name}-0')'''
+    else:
+        pull_code = f"da = DocumentArray.pull('{_name}')"
 
     md = Markdown(
         f'''
@@ -613,6 +791,7 @@ Final results and intermediate results are created, i.e.
 ./{_name}/[i]-progress.gif
 ./{_name}/[i]-progress.png
 ./{_name}/da.protobuf.lz4
+./{_name}/da.segments/
 ```
 
 where:
@@ -623,16 +802,19 @@ where:
 - `*-progress.png` is the sprite image of all intermediate results so far.
 - `*-progress.gif` is the animated gif of all intermediate results so far.
 - `da.protobuf.lz4` is the LZ4 compressed Protobuf file of all intermediate results of all `n_batches`.
+- `da.segments/` holds the results appended since the last compaction into `da.protobuf.lz4`, it is empty once a run finishes.
 
 # 💾 Save & load the batch        
 
 Results are stored in a [DocumentArray](https://docarray.jina.ai/fundamentals/documentarray/) available both local and cloud.
 
 
-You may also download the file manually and load it from local disk:
+You may also download the folder manually and load it from local disk, together with any pending segments:
 
 ```python
-da = DocumentArray.load_binary('{get_output_dir(_name)}/da.protobuf.lz4')
+from discoart.store import load_results
+
+da = load_results('{output_dir}')
 ```
 
 You can simply pull it from any machine:
@@ -641,14 +823,14 @@ You can simply pull it from any machine:
 # pip install docarray[common]
 from docarray import DocumentArray
 
-da = DocumentArray.pull('{_name}')
+{pull_code}
 ```
 
 More usage such as plotting, post-analysis can be found in the [README](https://github.com/jina-ai/discoart).
             ''',
         code_theme='igor',
     )
-    if is_google_colab():
+    if is_google_colab() or persist_file is None:
         _dp1.display(md)
     else:
         _dp1.display(persist_file, md)
@@ -695,61 +877,46 @@ def _version_check(package: str = None, github_repo: str = None):
         logger.error(f'can not fetch the lastest version number: {ex}')
 
 
-threading.Thread(target=_version_check, args=(__package__, 'discoart')).start()
-_MAX_DIFFUSION_STEPS = 1000
+_remote_checks: List[threading.Thread] = []
 
 
-def _is_valid_schedule_str(val) -> bool:
-    r = re.match(r'(False\b|True\b|[\(\)\[\]0-9\, \.\*\+\-])+', val)
-    if r and r.group(0) == val:
-        return True
-    return False
+def start_remote_checks():
+    """
+    Fetch the remote model list and check for a newer version in the background, only once per process.
 
+    They used to run on import, now they start with the first `create()` call.
+    """
+    if _remote_checks:
+        return
+    _remote_checks.extend(
+        [
+            threading.Thread(
+                target=get_remote_model_list, args=(models_list, False), daemon=True
+            ),
+            threading.Thread(
+                target=_version_check, args=(__package__, 'discoart'), daemon=True
+            ),
+        ]
+    )
+    for t in _remote_checks:
+        t.start()
 
-def _eval_scheduling_str(val) -> List[float]:
-    if isinstance(val, str):
-        if _is_valid_schedule_str(val):
-            val = eval(val)
-        else:
-            raise ValueError(
-                f'invalid scheduling string: {val}, it contains unsafe code'
-            )
 
-    if isinstance(val, (int, float, bool)):
-        val = [val] * _MAX_DIFFUSION_STEPS
-    elif isinstance(val, (list, tuple)):
-        if len(val) != _MAX_DIFFUSION_STEPS:
-            raise ValueError(
-                f'invalid scheduling string: {val} the schedule steps should be exactly {_MAX_DIFFUSION_STEPS}'
-            )
-    else:
-        raise ValueError(f'unsupported scheduling type: {val}: {type(val)}')
-    return val
+def _wait_remote_model_list():
+    if _remote_checks:
+        _remote_checks[0].join()
 
 
-def _get_current_schedule(schedule_table: Dict, t: int) -> 'SimpleNamespace':
-    return SimpleNamespace(**{k: schedule_table[k][t] for k in schedule_table.keys()})
+def _eval_scheduling_str(val) -> List[float]:
+    return compile_schedule(val).to_list()
 
 
-def _get_schedule_table(args) -> Dict:
-    return {
-        k: _eval_scheduling_str(getattr(args, k))
-        for k in (
-            'cut_overview',
-            'cut_innercut',
-            'cut_icgray_p',
-            'cut_ic_pow',
-            'use_secondary_model',
-            'cutn_batches',
-            'clip_guidance_scale',
-            'tv_scale',
-            'range_scale',
-            'sat_scale',
-            'init_scale',
-            'clamp_grad',
-            'clamp_max',
-        )
-    }
+def _get_current_schedule(schedule_table: 'ScheduleTable', t: int) -> 'SimpleNamespace':
+    return schedule_table[t]
+
+
+def _get_schedule_table(args) -> 'ScheduleTable':
+    return ScheduleTable.from_args(args)
 
 
 def get_output_dir(name_da):
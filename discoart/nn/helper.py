@@ -11,6 +11,26 @@ def set_seed(seed: int) -> None:
     torch.backends.cudnn.deterministic = True
 
 
+def get_rng_state() -> dict:
+    """Return the states of all random generators seeded by :func:`set_seed`."""
+    return {
+        'numpy': np.random.get_state(),
+        'random': random.getstate(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state: dict) -> None:
+    """Restore the random generators from :func:`get_rng_state`."""
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    torch.backends.cudnn.deterministic = True
+
+
 def detach_gpu(val):
     if isinstance(val, (int, float)):
         return val
@@ -17,3 +17,14 @@ def tv_loss(input):
 
 def range_loss(input):
     return (input - input.clamp(-1, 1)).pow(2).mean([1, 2, 3])
+
+
+def downsample(input, size):
+    """Downsample `input` by area averaging so that its shorter side is `size`, it is kept if already smaller."""
+    h, w = input.shape[-2:]
+    if not size or min(h, w) <= size:
+        return input
+    scale = size / min(h, w)
+    return F.interpolate(
+        input, size=(max(round(h * scale), 1), max(round(w * scale), 1)), mode='area'
+    )
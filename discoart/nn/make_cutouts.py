@@ -1,3 +1,5 @@
+import math
+
 import torch
 from resize_right import resize
 from torch import nn
@@ -5,6 +7,167 @@ from torch.nn import functional as F
 from torchvision import transforms as T
 from torchvision.transforms import functional as TF
 
+_CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+_CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def _rgb_to_grayscale(x):
+    r, g, b = x.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def _blend(x, y, ratio):
+    return (ratio * x + (1.0 - ratio) * y).clamp(0, 1)
+
+
+def _rgb_to_hsv(x):
+    r, g, b = x.unbind(dim=-3)
+    maxc = x.max(dim=-3).values
+    minc = x.min(dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    # noisy inputs can be negative, so `maxc == 0` does not imply `eqc` and must not be a divisor either
+    s = cr / torch.where(eqc | (maxc == 0), ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def _hsv_to_rgb(x):
+    h, s, v = x.unbind(dim=-3)
+    channels = []
+    for n in (5, 3, 1):
+        # the closed form of the piecewise HSV -> RGB conversion, `c = 0` leaves the channel at `v`
+        k = (n + h * 6.0) % 6
+        c = torch.minimum(k, 4.0 - k).clamp(0.0, 1.0)
+        channels.append(torch.where(c == 0, v, (v * (1.0 - s * c)).clamp(0.0, 1.0)))
+    return torch.stack(channels, dim=-3)
+
+
+def _adjust_hue(x, hue_factor):
+    h, s, v = _rgb_to_hsv(x).unbind(dim=-3)
+    h = (h + hue_factor.squeeze(1)) % 1.0
+    return _hsv_to_rgb(torch.stack((h, s, v), dim=-3))
+
+
+class CutoutPlanner:
+    """
+    Plan the cutouts of one diffusion step, shared by all CLIP models.
+
+    The overview cutouts only depend on the input and the cut size, so they are computed once per cut size together
+    with their grayscale and flipped variants. When `share_innercut_geometry` is set, the `i`-th cutn batch of every
+    model uses the same inner crops, which are then also resized only once per cut size.
+    """
+
+    def __init__(
+        self,
+        input,
+        Overview=4,
+        InnerCrop=0,
+        IC_Size_Pow=0.5,
+        IC_Grey_P=0.2,
+        share_innercut_geometry=False,
+    ):
+        self.input = input
+        self.Overview = Overview
+        self.InnerCrop = InnerCrop
+        self.IC_Size_Pow = IC_Size_Pow
+        self.IC_Grey_P = IC_Grey_P
+        self.share_innercut_geometry = share_innercut_geometry
+        self._overviews = {}
+        self._geometries = {}
+        self._innercuts = {}
+
+    def get_cuts(self, cut_size, batch_idx=0):
+        """
+        Return the list of (not yet augmented) cutouts for a CLIP model.
+
+        :param cut_size: the input resolution of the CLIP model
+        :param batch_idx: the index of the cutn batch, inner crops are shared by the same index
+        :return: a list of `Overview + InnerCrop` tensors of shape `[batch_size, 3, cut_size, cut_size]`
+        """
+        return self._get_overviews(cut_size) + self._get_innercuts(cut_size, batch_idx)
+
+    def _get_overviews(self, cut_size):
+        if not self.Overview:
+            return []
+        if cut_size not in self._overviews:
+            sideY, sideX = self.input.shape[2:4]
+            max_size = min(sideX, sideY)
+            pad_input = F.pad(
+                self.input,
+                (
+                    (sideY - max_size) // 2,
+                    (sideY - max_size) // 2,
+                    (sideX - max_size) // 2,
+                    (sideX - max_size) // 2,
+                ),
+            )
+            cutout = resize(pad_input, out_shape=self._output_shape(cut_size))
+            variants = [cutout]
+            if self.Overview > 1:
+                variants.append(TF.rgb_to_grayscale(cutout, 3))
+            if self.Overview > 2:
+                flipped = TF.hflip(cutout)
+                variants += [flipped, TF.rgb_to_grayscale(flipped, 3)]
+            self._overviews[cut_size] = variants
+
+        variants = self._overviews[cut_size]
+        return [
+            variants[j] if j < len(variants) else variants[0]
+            for j in range(self.Overview)
+        ]
+
+    def _get_innercuts(self, cut_size, batch_idx):
+        if not self.InnerCrop:
+            return []
+        if not self.share_innercut_geometry:
+            return self._resize_innercuts(self._sample_geometry(), cut_size)
+
+        if batch_idx not in self._geometries:
+            self._geometries[batch_idx] = self._sample_geometry()
+        key = (cut_size, batch_idx)
+        if key not in self._innercuts:
+            self._innercuts[key] = self._resize_innercuts(
+                self._geometries[batch_idx], cut_size
+            )
+        return self._innercuts[key]
+
+    def _sample_geometry(self):
+        # the crop size depends on the cut size of a model, so only its relative size and position are sampled here
+        return [
+            (torch.rand([]) ** self.IC_Size_Pow, torch.rand([]), torch.rand([]))
+            for _ in range(self.InnerCrop)
+        ]
+
+    def _resize_innercuts(self, geometry, cut_size):
+        sideY, sideX = self.input.shape[2:4]
+        max_size = min(sideX, sideY)
+        min_size = min(sideX, sideY, cut_size)
+        output_shape = self._output_shape(cut_size)
+        cuts = []
+        for i, (size_ratio, rx, ry) in enumerate(geometry):
+            size = int(size_ratio * (max_size - min_size) + min_size)
+            offsetx = int(rx * (sideX - size + 1))
+            offsety = int(ry * (sideY - size + 1))
+            cutout = self.input[
+                :, :, offsety : offsety + size, offsetx : offsetx + size
+            ]
+            if i <= int(self.IC_Grey_P * self.InnerCrop):
+                cutout = TF.rgb_to_grayscale(cutout, 3)
+            cuts.append(resize(cutout, out_shape=output_shape))
+        return cuts
+
+    def _output_shape(self, cut_size):
+        return [self.input.shape[0], 3, cut_size, cut_size]
+
 
 class MakeCutouts(nn.Module):
     def __init__(
@@ -14,6 +177,7 @@ class MakeCutouts(nn.Module):
         InnerCrop=0,
         IC_Size_Pow=0.5,
         IC_Grey_P=0.2,
+        batched_augment=True,
     ):
         super().__init__()
         self.cut_size = cut_size
@@ -21,6 +185,7 @@ class MakeCutouts(nn.Module):
         self.InnerCrop = InnerCrop
         self.IC_Size_Pow = IC_Size_Pow
         self.IC_Grey_P = IC_Grey_P
+        self.batched_augment = batched_augment
         self.augment = T.Compose(
             [
                 T.RandomHorizontalFlip(p=0.5),
@@ -34,50 +199,152 @@ class MakeCutouts(nn.Module):
                 T.RandomGrayscale(p=0.1),
                 T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
                 T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
-                T.Normalize(
-                    mean=[0.48145466, 0.4578275, 0.40821073],
-                    std=[0.26862954, 0.26130258, 0.27577711],
-                ),
+                T.Normalize(mean=_CLIP_MEAN, std=_CLIP_STD),
             ]
         )
 
     def forward(self, input):
-        return torch.cat([self.augment(c) for c in self._cut_generator(input)])
-
-    def _cut_generator(self, input):
-        gray = T.Grayscale(3)
-        sideY, sideX = input.shape[2:4]
-        max_size = min(sideX, sideY)
-        min_size = min(sideX, sideY, self.cut_size)
-        output_shape = [input.shape[0], 3, self.cut_size, self.cut_size]
-        pad_input = F.pad(
+        planner = CutoutPlanner(
             input,
-            (
-                (sideY - max_size) // 2,
-                (sideY - max_size) // 2,
-                (sideX - max_size) // 2,
-                (sideX - max_size) // 2,
-            ),
+            Overview=self.Overview,
+            InnerCrop=self.InnerCrop,
+            IC_Size_Pow=self.IC_Size_Pow,
+            IC_Grey_P=self.IC_Grey_P,
         )
+        return self.augment_cuts(planner.get_cuts(self.cut_size))
+
+    def augment_cuts(self, cuts):
+        """
+        Augment the cutouts from :meth:`CutoutPlanner.get_cuts` and concatenate them into the CLIP input.
+
+        :param cuts: a list of cutouts of shape `[batch_size, 3, cut_size, cut_size]`
+        :return: the normalized CLIP input of shape `[len(cuts) * batch_size, 3, cut_size, cut_size]`
+        """
+        if self.batched_augment:
+            return self._augment_batch(cuts)
+        return torch.cat([self.augment(c) for c in cuts])
+
+    @staticmethod
+    def _sample_augment_params(num_cuts, h, w):
+        """Draw the random parameters of `self.augment` for `num_cuts` cuts of size `h` x `w`."""
+        # all random parameters are drawn on CPU as torchvision does
+        is_flip = torch.rand(num_cuts) < 0.5
+        angles = torch.empty(num_cuts).uniform_(-10, 10)
+        max_dx, max_dy = 0.05 * w, 0.05 * h
+        tx = torch.empty(num_cuts).uniform_(-max_dx, max_dx).round()
+        ty = torch.empty(num_cuts).uniform_(-max_dy, max_dy).round()
+        is_gray = torch.rand(num_cuts) < 0.1
+        jitter_order = torch.stack([torch.randperm(4) for _ in range(num_cuts)])
+        jitter_factors = torch.stack(
+            [
+                torch.empty(num_cuts).uniform_(0.9, 1.1),
+                torch.empty(num_cuts).uniform_(0.9, 1.1),
+                torch.empty(num_cuts).uniform_(0.9, 1.1),
+                torch.empty(num_cuts).uniform_(-0.1, 0.1),
+            ]
+        )
+        return {
+            'is_flip': is_flip,
+            'angles': angles,
+            'tx': tx,
+            'ty': ty,
+            'is_gray': is_gray,
+            'jitter_order': jitter_order,
+            'jitter_factors': jitter_factors,
+        }
+
+    def _augment_batch(self, cuts, params=None):
+        """
+        Apply the same augmentations as `self.augment` to all cuts at once.
 
-        cutout = resize(pad_input, out_shape=output_shape)
-        for j in range(self.Overview):
-            if j == 1:
-                yield gray(cutout)
-            elif j == 2:
-                yield TF.hflip(cutout)
-            elif j == 3:
-                yield gray(TF.hflip(cutout))
-            else:
-                yield cutout
-
-        for i in range(self.InnerCrop):
-            size = int(
-                torch.rand([]) ** self.IC_Size_Pow * (max_size - min_size) + min_size
+        Random parameters are drawn per cut (i.e. shared by the minibatch inside a cut), exactly as
+        `self.augment` does when it is called once per cut.
+
+        :param cuts: a list of cutouts of shape `[batch_size, 3, cut_size, cut_size]`
+        :param params: the random parameters from :meth:`_sample_augment_params`, drawn if not given
+        :return: the normalized CLIP input
+        """
+        num_cuts, batch_size = len(cuts), cuts[0].shape[0]
+        x = torch.cat(cuts)
+        device = x.device
+        h, w = x.shape[-2:]
+
+        def _per_cut(v):
+            return v.to(device).repeat_interleave(batch_size, dim=0).view(-1, 1, 1, 1)
+
+        def _add_noise(v):
+            return v + torch.randn_like(v) * 0.01
+
+        if params is None:
+            params = self._sample_augment_params(num_cuts, h, w)
+        is_flip, angles, tx, ty, is_gray, jitter_order, jitter_factors = (
+            params[k]
+            for k in (
+                'is_flip',
+                'angles',
+                'tx',
+                'ty',
+                'is_gray',
+                'jitter_order',
+                'jitter_factors',
             )
-            offsetx = torch.randint(0, sideX - size + 1, ())
-            offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety : offsety + size, offsetx : offsetx + size]
-            if i <= int(self.IC_Grey_P * self.InnerCrop):
-                cutout = gray(cutout)
-            yield resize(cutout, out_shape=output_shape)
+        )
+
+        x = torch.where(_per_cut(is_flip), x.flip(-1), x)
+        x = _add_noise(x)
+
+        # the inverse affine matrix of `TF.affine` on a centered pixel grid, expressed in normalized coordinates
+        rot = angles * math.pi / 180
+        cos, sin = rot.cos(), rot.sin()
+        theta = torch.stack(
+            [
+                torch.stack([cos, sin * h / w, -(cos * tx + sin * ty) / (0.5 * w)], -1),
+                torch.stack([-sin * w / h, cos, (sin * tx - cos * ty) / (0.5 * h)], -1),
+            ],
+            1,
+        )
+        theta = theta.to(device=device, dtype=x.dtype).repeat_interleave(
+            batch_size, dim=0
+        )
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        # `RandomAffine` fills with 0, for which torchvision also samples a mask of ones and re-weights the border by it
+        x = F.grid_sample(
+            torch.cat([x, torch.ones_like(x[:, :1])], dim=1),
+            grid,
+            mode='bilinear',
+            padding_mode='zeros',
+            align_corners=False,
+        )
+        x = x[:, :-1] * x[:, -1:]
+        x = _add_noise(x)
+
+        x = torch.where(_per_cut(is_gray), _rgb_to_grayscale(x).expand_as(x), x)
+        x = _add_noise(x)
+
+        jitter_factors = jitter_factors.to(device=device, dtype=x.dtype)
+        jitter_fns = (
+            lambda v, f: _blend(v, torch.zeros_like(v), f),
+            lambda v, f: _blend(
+                v, _rgb_to_grayscale(v).mean(dim=(-3, -2, -1), keepdim=True), f
+            ),
+            lambda v, f: _blend(v, _rgb_to_grayscale(v), f),
+            _adjust_hue,
+        )
+        for k in range(4):
+            # each cut applies its own random order of color jitters, so every jitter runs on its own subset of cuts
+            x_new = x
+            for fn_idx in jitter_order[:, k].unique().tolist():
+                cut_ids = (jitter_order[:, k] == fn_idx).nonzero().flatten()
+                rows = (
+                    cut_ids.to(device).view(-1, 1) * batch_size
+                    + torch.arange(batch_size, device=device)
+                ).flatten()
+                factors = jitter_factors[fn_idx, rows // batch_size].view(-1, 1, 1, 1)
+                x_new = x_new.index_copy(
+                    0, rows, jitter_fns[fn_idx](x.index_select(0, rows), factors)
+                )
+            x = x_new
+
+        mean = x.new_tensor(_CLIP_MEAN).view(1, -1, 1, 1)
+        std = x.new_tensor(_CLIP_STD).view(1, -1, 1, 1)
+        return (x - mean) / std
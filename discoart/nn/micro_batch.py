@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+from typing import Dict, List
+
+import torch
+
+# a rough estimate of the forward+backward activation memory of a CLIP visual tower, per pixel of one cut
+_ESTIMATED_BYTES_PER_PIXEL = 1536
+
+
+class CutMicroBatcher:
+    """
+    Group the `cutn_batches` of a CLIP model into micro-batches that fit into a memory budget.
+
+    The memory of one cut is estimated from the input resolution of the CLIP model, and on CUDA it is calibrated by
+    the peak memory of the micro-batches that have already run. Without a budget, every cutn batch is its own
+    micro-batch.
+    """
+
+    def __init__(self, budget_mb: float, device):
+        self.budget = budget_mb * 1024 * 1024
+        self.device = device
+        self._bytes_per_cut: Dict[str, float] = {}
+
+    def split(
+        self, model_name: str, num_batches: int, cuts_per_batch: int, input_resolution
+    ) -> List[int]:
+        """
+        Split `num_batches` cutn batches into micro-batches.
+
+        :param model_name: the name of the CLIP model
+        :param num_batches: the number of cutn batches
+        :param cuts_per_batch: the number of cuts in one cutn batch, i.e. number of cuts times the batch size
+        :param input_resolution: the input resolution of the CLIP model
+        :return: the number of cutn batches in each micro-batch
+        """
+        if self.budget <= 0:
+            return [1] * num_batches
+
+        bytes_per_cut = self._bytes_per_cut.get(
+            model_name, input_resolution**2 * _ESTIMATED_BYTES_PER_PIXEL
+        )
+        size = max(
+            1, min(num_batches, int(self.budget // (bytes_per_cut * cuts_per_batch)))
+        )
+        sizes = [size] * (num_batches // size)
+        if num_batches % size:
+            sizes.append(num_batches % size)
+        return sizes
+
+    @contextmanager
+    def calibrate(self, model_name: str, num_cuts: int):
+        """Measure the peak memory of a micro-batch of `num_cuts` cuts, only on CUDA."""
+        if self.budget <= 0 or self.device.type != 'cuda':
+            yield
+            return
+
+        torch.cuda.reset_peak_memory_stats(self.device)
+        allocated = torch.cuda.memory_allocated(self.device)
+        yield
+        bytes_per_cut = (
+            torch.cuda.max_memory_allocated(self.device) - allocated
+        ) / num_cuts
+        if model_name in self._bytes_per_cut:
+            bytes_per_cut = max(bytes_per_cut, self._bytes_per_cut[model_name])
+        self._bytes_per_cut[model_name] = bytes_per_cut
+
+
+def get_cut_loss(
+    dists: 'torch.Tensor',
+    weights: 'torch.Tensor',
+    num_batches: int,
+    num_cuts: int,
+    batch_size: int,
+    clip_guidance_scale: float,
+    cutn_batches: int,
+) -> 'torch.Tensor':
+    """
+    Return the CLIP loss of a micro-batch, which equals the sum of the losses of its cutn batches run one by one.
+
+    :param dists: the distances of the cuts to the prompts, ordered by cutn batch, cut and image
+    :param weights: the weights of the prompts
+    :param num_batches: the number of cutn batches in the micro-batch
+    :param num_cuts: the number of cuts of an image in one cutn batch
+    :param batch_size: the number of images
+    :param clip_guidance_scale: the scale of the CLIP loss
+    :param cutn_batches: the number of cutn batches of the step
+    :return: the loss as a scalar tensor
+    """
+    dists = dists.view([num_batches, num_cuts, batch_size, -1])
+    # each cutn batch is averaged over its own cuts, as if they were run one by one
+    return dists.mul(weights).sum(3).mean(1).sum() * clip_guidance_scale / cutn_batches
@@ -0,0 +1,103 @@
+from typing import List, Optional
+
+import torch
+
+
+def sample_loop_progressive(
+    diffusion,
+    model,
+    shape,
+    sampling_mode: str,
+    cond_fn=None,
+    clip_denoised: bool = True,
+    model_kwargs: Optional[dict] = None,
+    progress: bool = False,
+    skip_timesteps: int = 0,
+    init_image: Optional['torch.Tensor'] = None,
+    randomize_class: bool = False,
+    eta: float = 0.0,
+    transformation_fn=None,
+    transformation_percent=(),
+    order: int = 2,
+    start_step: int = 0,
+    x: Optional['torch.Tensor'] = None,
+    old_eps: Optional[List['torch.Tensor']] = None,
+):
+    """
+    The DDIM and PLMS sampling loops of guided_diffusion, which can also continue from a later step.
+
+    From the first step, it yields the same samples as `ddim_sample_loop_progressive` and
+    `plms_sample_loop_progressive`. To continue, `x` is the sample of step `start_step - 1` and `old_eps` its PLMS
+    history, i.e. the `sample` and `old_eps` of the output of that step.
+
+    :param sampling_mode: `ddim` or `plms`
+    :param start_step: the index of the first step to run
+    :param x: the sample to continue from, only used when `start_step > 0`
+    :param old_eps: the PLMS history to continue from, only used when `start_step > 0`
+    :return: a generator of the output of each step
+    """
+    if model_kwargs is None:
+        model_kwargs = {}
+    device = next(model.parameters()).device
+
+    indices = list(range(diffusion.num_timesteps - skip_timesteps))[::-1]
+    transformation_steps = [int(len(indices) * (1 - p)) for p in transformation_percent]
+
+    if start_step:
+        img = x.to(device)
+    else:
+        img = torch.randn(*shape, device=device)
+        if skip_timesteps and init_image is None:
+            init_image = torch.zeros_like(img)
+        if init_image is not None:
+            my_t = torch.ones([shape[0]], device=device, dtype=torch.long) * indices[0]
+            img = diffusion.q_sample(init_image, my_t, img)
+
+    old_out = None
+    if start_step and old_eps:
+        old_out = {'old_eps': [e.to(device) for e in old_eps]}
+
+    indices = indices[start_step:]
+    if progress:
+        from tqdm.auto import tqdm
+
+        indices = tqdm(indices, initial=start_step, total=start_step + len(indices))
+
+    for i in indices:
+        t = torch.tensor([i] * shape[0], device=device)
+        if randomize_class and 'y' in model_kwargs:
+            model_kwargs['y'] = torch.randint(
+                low=0,
+                high=model.num_classes,
+                size=model_kwargs['y'].shape,
+                device=model_kwargs['y'].device,
+            )
+        with torch.no_grad():
+            if sampling_mode == 'ddim':
+                if i in transformation_steps and transformation_fn is not None:
+                    img = transformation_fn(img)
+                out = diffusion.ddim_sample(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                    eta=eta,
+                )
+            else:
+                out = diffusion.plms_sample(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                    order=order,
+                    old_out=old_out,
+                )
+                # only the last `order` steps are used by the next step
+                del out['old_eps'][:-order]
+            yield out
+            old_out = out
+            img = out['sample']
@@ -0,0 +1,47 @@
+from typing import Callable
+
+import torch
+
+
+class SharedForward:
+    """
+    Share the forward of a diffusion model between the sampler and `cond_fn`.
+
+    The sampler calls the model on `x` without grad, and `cond_fn` then calls it again on the same `x` with grad.
+    When `is_enabled()` is true, the sampler's call runs with grad on a detached leaf of `x` and keeps the output,
+    so that `cond_fn` can reuse both via :meth:`get_leaf` instead of running the model a second time.
+    """
+
+    def __init__(self, model, is_enabled: Callable[[], bool]):
+        self.model = model
+        self.is_enabled = is_enabled
+        self._x = None
+        self._leaf = None
+        self._out = None
+
+    def __getattr__(self, name):
+        # the samplers also read attributes of the model, e.g. `parameters()` for the device
+        return getattr(self.model, name)
+
+    def __call__(self, x, ts, **kwargs):
+        if self._leaf is not None and x is self._leaf:
+            return self._out
+
+        self.clear()
+        if not self.is_enabled():
+            return self.model(x, ts, **kwargs)
+
+        leaf = x.detach().requires_grad_()
+        with torch.enable_grad():
+            out = self.model(leaf, ts, **kwargs)
+        self._x, self._leaf, self._out = x, leaf, out
+        return out
+
+    def get_leaf(self, x):
+        """Return the leaf whose model output is kept for `x`, or a new leaf when there is none."""
+        if self._x is not None and x is self._x:
+            return self._leaf
+        return x.detach().requires_grad_()
+
+    def clear(self):
+        self._x = self._leaf = self._out = None
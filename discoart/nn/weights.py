@@ -0,0 +1,105 @@
+import contextlib
+import hashlib
+import inspect
+import json
+import os
+import struct
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+# tensors are aligned in the file, so that they can be viewed in place
+_ALIGN = 64
+
+# creating a module on the `meta` device and assigning the loaded tensors to it needs torch>=2.1
+_SUPPORTS_ASSIGN = (
+    'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+)
+
+
+def save_weights(path: str, state_dict: Dict[str, 'torch.Tensor']) -> None:
+    """
+    Save `state_dict` as a flat file that :func:`load_weights` memory-maps.
+
+    The file starts with the length of a JSON header, which holds the dtype, shape and offset of every tensor. The
+    tensors follow as raw bytes, each aligned to 64 bytes. The file is written atomically.
+    """
+    header = {}
+    offset = 0
+    arrays = []
+    for name, tensor in state_dict.items():
+        arr = tensor.detach().cpu().contiguous().numpy()
+        offset = -(-offset // _ALIGN) * _ALIGN
+        header[name] = {
+            'dtype': arr.dtype.str,
+            'shape': list(arr.shape),
+            'offset': offset,
+        }
+        arrays.append((offset, arr))
+        offset += arr.nbytes
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(8 + len(header_bytes)) // _ALIGN) * _ALIGN
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for start, arr in arrays:
+            fp.seek(data_start + start)
+            fp.write(memoryview(arr.reshape(-1)).cast('B'))
+        fp.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_weights(path: str) -> Dict[str, 'torch.Tensor']:
+    """
+    Load the tensors saved by :func:`save_weights` without reading or copying them.
+
+    The file is memory-mapped copy-on-write, so all processes that load it share its pages in the page cache.
+    """
+    with open(path, 'rb') as fp:
+        (header_len,) = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_len))
+    data_start = -(-(8 + header_len) // _ALIGN) * _ALIGN
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start)
+
+    state_dict = {}
+    for name, meta in header.items():
+        dtype = np.dtype(meta['dtype'])
+        size = int(np.prod(meta['shape'])) * dtype.itemsize
+        arr = data[meta['offset'] : meta['offset'] + size].view(dtype)
+        state_dict[name] = torch.from_numpy(arr.reshape(meta['shape']))
+    return state_dict
+
+
+def init_empty():
+    """A context to create modules without allocating and initializing their weights, if torch supports it."""
+    if _SUPPORTS_ASSIGN:
+        return torch.device('meta')
+    return contextlib.nullcontext()
+
+
+def load_weights_into(module: 'torch.nn.Module', state_dict: Dict) -> None:
+    """Load `state_dict` into `module` created in :func:`init_empty`, its tensors are used without a copy."""
+    if _SUPPORTS_ASSIGN:
+        module.load_state_dict(state_dict, assign=True)
+    else:
+        module.load_state_dict(state_dict)
+
+
+def get_weights_path(root: str, sha: str, model_config: Dict) -> Optional[str]:
+    """
+    Return the path of the converted weights of the checkpoint with `sha` in `root`, None if the cache is disabled.
+
+    The weights depend on the checkpoint and on the model config, e.g. `use_fp16` sets the dtype of the blocks.
+    """
+    if 'DISCOART_DISABLE_WEIGHT_CACHE' in os.environ:
+        return None
+    config_sha = hashlib.sha256(
+        json.dumps(model_config, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    precision = 'fp16' if model_config.get('use_fp16') else 'fp32'
+    return os.path.join(
+        root, 'weights', f'{sha[:16]}-{precision}-{config_sha[:16]}.bin'
+    )
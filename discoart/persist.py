@@ -1,20 +1,171 @@
+import copy
+import itertools
 import os
+import queue
 import threading
 from threading import Thread
+from typing import Callable, Dict, Optional
 
+import numpy as np
 import torchvision.transforms.functional as TF
 from docarray import DocumentArray, Document
 
+from .checkpoint import save_checkpoint
+from .frames import new_frame, to_datauri_documents
 from .helper import logger, get_output_dir
+from .store import ResultStore
 
 
-def _sample_thread(*args):
-    t = Thread(
-        target=_sample,
-        args=(*args,),
-    )
-    t.start()
-    return t
+class _LatestJobWorker:
+    """A worker thread that only runs the latest submitted job, the jobs submitted while it is busy are coalesced."""
+
+    def __init__(self, name: str):
+        self._cond = threading.Condition()
+        self._job = None
+        self._closed = False
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args) -> None:
+        with self._cond:
+            if self._job is not None:
+                logger.debug(f'{self._thread.name}: superseded a pending job')
+            self._job = (fn, args)
+            self._cond.notify()
+
+    def close(self) -> None:
+        """Run the pending job if any, then stop the worker."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._job is None and not self._closed:
+                    self._cond.wait()
+                job, self._job = self._job, None
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception as ex:
+                logger.debug(f'{self._thread.name}: {fn.__name__} failed: {ex}')
+
+
+class PersistWorker:
+    """
+    A long-lived worker that runs the persistence jobs of :func:`discoart.runner.do_run` in submission order.
+
+    Jobs are fed through a bounded queue, so the sampling waits when persisting falls behind. A job submitted with a
+    `key` is skipped when a newer job with the same key is already queued, e.g. an outdated progress image. Cloud
+    backups run on their own thread and only the latest one is kept. :meth:`close` runs all remaining jobs.
+    """
+
+    def __init__(self, maxsize: int = 16):
+        self._queue = queue.Queue(maxsize)
+        self._latest = {}
+        self._seq = itertools.count()
+        self._is_backup_outdated = False
+        self._store = None
+        self._cloud = _LatestJobWorker('discoart-cloud-backup')
+        self._thread = Thread(target=self._run, name='discoart-persist', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args, key: Optional[str] = None) -> None:
+        seq = next(self._seq)
+        self._is_backup_outdated = True
+        if key:
+            self._latest[key] = seq
+        self._queue.put((seq, key, fn, args))
+
+    def submit_backup(
+        self,
+        da: DocumentArray,
+        name: str,
+        cloud_da: Optional[DocumentArray] = None,
+        cloud_name: Optional[str] = None,
+    ) -> None:
+        """
+        Save the current batch `da` locally and then hand `cloud_da` over to the cloud backup as `cloud_name`, after
+        all jobs submitted before. By default, `da` is backed up as `name`.
+        """
+        self.submit(self._local_save, da, name, key='local-backup')
+        self.submit(
+            self._cloud_backup,
+            da if cloud_da is None else cloud_da,
+            cloud_name or name,
+            key='cloud-backup',
+        )
+        self._is_backup_outdated = False
+
+    def flush_backup(self, da: DocumentArray, name: str, **kwargs) -> None:
+        """Submit a backup if any job was submitted after the last backup, e.g. when the run is interrupted."""
+        if self._is_backup_outdated:
+            self.submit_backup(da, name, **kwargs)
+
+    def submit_checkpoint(
+        self, path: str, ckpt: Dict, da: DocumentArray, name: str
+    ) -> None:
+        """
+        Save the current batch `da` locally and then the checkpoint `ckpt`, so that the local results are never
+        behind a checkpoint.
+        """
+
+        def _checkpoint():
+            self._local_save(da, name)
+            save_checkpoint(path, ckpt)
+
+        self.submit(_checkpoint, key='checkpoint')
+
+    def restore(self, da: DocumentArray, name: str) -> None:
+        """Start the local results from `da`, e.g. the results loaded when resuming from a checkpoint."""
+        self.submit(self._local_save, da, name)
+
+    def wait(self) -> None:
+        """Block until all submitted jobs are done, except the cloud backup."""
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        self._cloud.close()
+        if self._store:
+            # leave a single snapshot behind
+            self._store.compact()
+
+    def _cloud_backup(self, da: DocumentArray, name: str) -> None:
+        if 'DISCOART_OPTOUT_CLOUD_BACKUP' in os.environ:
+            return
+        # the snapshot is taken in order with the jobs that change `da`, the push then runs on its own thread
+        self._cloud.submit(_cloud_push, _snapshot_results(da), name)
+
+    def _local_save(self, da: DocumentArray, name: str) -> None:
+        try:
+            if self._store is None:
+                self._store = ResultStore(get_output_dir(name))
+            # the store keeps the earlier batches already
+            self._store.append(da)
+        except Exception as ex:
+            logger.debug(f'local backup failed: {ex}')
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                seq, key, fn, args = item
+                if key and self._latest.get(key) != seq:
+                    logger.debug(f'skip superseded job {key}')
+                    continue
+                fn(*args)
+            except Exception as ex:
+                logger.debug(f'persist job failed: {ex}')
+            finally:
+                self._queue.task_done()
 
 
 def _sample(
@@ -22,160 +173,124 @@ def _sample(
     _nb,
     cur_t,
     da,
-    da_gif,
+    progress,
     _handlers,
     j,
-    loss_values,
+    telemetry_summary,
     output_dir,
-    is_sampling_done,
     is_save_step,
     is_save_gif,
     is_image_output,
     is_display_step,
     image_callback,
 ):
-    with threading.Lock():
-        is_sampling_done.clear()
-        _display_html = []
+    _display_html = []
+
+    for k, image in enumerate(sample['pred_xstart']):  # batch_size
+        image = TF.to_pil_image(image.add(1).div(2).clamp(0, 1))
 
-        for k, image in enumerate(sample['pred_xstart']):  # batch_size
-            image = TF.to_pil_image(image.add(1).div(2).clamp(0, 1))
+        if is_save_step:
+            f_name = None
+            if is_image_output:
+                if cur_t == -1:
+                    f_name = os.path.join(output_dir, f'{_nb}-done-{k}.png')
+                else:
+                    f_name = os.path.join(output_dir, f'{_nb}-step-{j}-{k}.png')
+                image.save(f_name)
 
-            c = Document(
+                if callable(image_callback):
+                    image_callback(f_name)
+
+            # intermediate frames refer to the saved file or keep the PNG bytes, data URIs are only created on
+            # serialization, see `discoart.frames`
+            c = new_frame(
+                image,
                 tags={
                     '_status': {
                         'cur_t': cur_t,
                         'step': j,
-                        'loss': loss_values[-1],
+                        'loss': telemetry_summary['loss'],
                         'minibatch_idx': k,
                     }
-                }
-            ).load_pil_image_to_datauri(image)
+                },
+                path=f_name,
+            )
+            da[k].chunks.append(c)
+            if is_image_output:
+                progress.append_tile(k, image)
+
+        if is_save_gif and is_image_output:
+            progress.append_frame(k, image)
 
-            if is_save_step:
-                if is_image_output:
-                    if cur_t == -1:
-                        f_name = os.path.join(output_dir, f'{_nb}-done-{k}.png')
-                    else:
-                        f_name = os.path.join(output_dir, f'{_nb}-step-{j}-{k}.png')
-                    c.save_uri_to_file(f_name)
+        datauri = None
+        if is_display_step or cur_t == -1:
+            datauri = Document().load_pil_image_to_datauri(image).uri
 
-                    if callable(image_callback):
-                        image_callback(f_name)
+        # root doc always update with the latest progress, the final image is kept as data URI
+        if cur_t == -1:
+            da[k].tensor = None
+            da[k].uri = datauri
+        else:
+            da[k].tensor = np.asarray(image)
 
-                da[k].chunks.append(c)
+        da[k].tags['_status'] = {
+            'completed': cur_t == -1,
+            'cur_t': cur_t,
+            'step': j,
+            # the full per-step arrays are in the `.npz` file that `telemetry` refers to
+            **telemetry_summary,
+        }
 
-            if is_save_gif and is_image_output:
-                da_gif[k].chunks.append(c)
+        if is_display_step:
+            _display_html.append(f'<img src="{datauri}" alt="step {j} minibatch {k}">')
 
-            # root doc always update with the latest progress
-            da[k].uri = c.uri
+        if cur_t == -1:
+            _handlers.completed.value += f'<br>seed: {da[k].tags["seed"]}<br><img src="{datauri}" alt="step {j} minibatch {k}"><br>'
 
-            da[k].tags['_status'] = {
-                'completed': cur_t == -1,
-                'cur_t': cur_t,
-                'step': j,
-                'loss': loss_values,
-            }
+    if is_display_step:
+        _handlers.preview.value = '<br>\n'.join(_display_html)
 
-            _display_html.append(f'<img src="{c.uri}" alt="step {j} minibatch {k}">')
+    logger.debug('sample and plot is done')
 
-            if cur_t == -1:
-                _handlers.completed.value += f'<br>seed: {da[k].tags["seed"]}<br><img src="{c.uri}" alt="step {j} minibatch {k}"><br>'
 
-        if is_display_step:
-            _handlers.preview.value = '<br>\n'.join(_display_html)
+def _save_progress(progress):
+    try:
+        progress.save()
+        logger.debug('progress are stored in as png and gif')
+    except (OSError, ValueError):
+        logger.debug('can not plot progress into sprite image and gif')
 
-        logger.debug('sample and plot is done')
-        is_sampling_done.set()
 
+def _save_telemetry(path: str, arrays: Dict[str, 'np.ndarray']) -> None:
+    try:
+        np.savez_compressed(path, **arrays)
+        logger.debug(f'telemetry is stored in {path}')
+    except OSError as ex:
+        logger.debug(f'can not save telemetry: {ex}')
 
-def _save_progress_thread(*args):
-    t = Thread(
-        target=_save_progress,
-        args=(*args,),
-    )
-    t.start()
-    return t
 
+def _snapshot_results(da: DocumentArray) -> DocumentArray:
+    """
+    Return a copy of the results `da`, which later `_sample` calls do not change.
 
-def _save_progress(da, da_gif, _nb, output_dir, fps, size_ratio):
-    with threading.Lock():
-        try:
-            for idx, d in enumerate(da):
-                if d.chunks:
-                    # only print the first image of the minibatch in progress
-                    d.chunks.plot_image_sprites(
-                        os.path.join(output_dir, f'{_nb}-progress-{idx}.png'),
-                        skip_empty=True,
-                        show_index=True,
-                        keep_aspect_ratio=True,
-                    )
-            for idx, d_gif in enumerate(da_gif):
-                if d_gif.chunks and fps > 0:
-                    d_gif.chunks.save_gif(
-                        os.path.join(output_dir, f'{_nb}-progress-{idx}.gif'),
-                        skip_empty=True,
-                        show_index=True,
-                        duration=1000 // fps,
-                        size_ratio=size_ratio,
-                    )
-            logger.debug('progress are stored in as png and gif')
-        except ValueError:
-            logger.debug('can not plot progress into sprite image and gif')
-
-
-def _persist_thread(
-    da_batches, name_docarray, is_busy_evs, is_sampling_done, is_completed
-):
-    for fn, idle_ev in zip((_local_save, _cloud_push), is_busy_evs):
-        t = Thread(
-            target=fn,
-            args=(da_batches, name_docarray, idle_ev, is_sampling_done, is_completed),
+    `_sample` only reassigns the images and the tags of a Document and appends frames to its chunks, so copying the
+    tags and the chunk lists is enough. The images are turned into data URIs later on the cloud backup thread.
+    """
+    return DocumentArray(
+        Document(
+            id=d.id,
+            tags=copy.deepcopy(d.tags),
+            tensor=d.tensor,
+            uri=d.uri,
+            chunks=list(d.chunks),
         )
-        t.start()
-        yield t
-
-
-def _local_save(
-    da_batches: DocumentArray,
-    name: str,
-    is_busy_event: threading.Event,
-    is_sampling_done: threading.Event,
-    force: bool = False,
-) -> None:
-    if is_busy_event.is_set() and not force:
-        logger.debug(f'another save is running, skipping')
-        return
-    is_sampling_done.wait()
-    is_busy_event.set()
-    try:
-        pb_path = os.path.join(get_output_dir(name), f'da.protobuf.lz4')
-        da_batches.save_binary(pb_path)
-        logger.debug(f'local backup to {pb_path}')
-    except Exception as ex:
-        logger.debug(f'local backup failed: {ex}')
-    is_busy_event.clear()
-
-
-def _cloud_push(
-    da_batches: DocumentArray,
-    name: str,
-    is_busy_event: threading.Event,
-    is_sampling_done: threading.Event,
-    force: bool = False,
-) -> None:
-    if 'DISCOART_OPTOUT_CLOUD_BACKUP' in os.environ:
-        return
-    if is_busy_event.is_set() and not force:
-        logger.debug(f'another cloud backup is running, skipping')
-        return
-    is_sampling_done.wait()
-    is_busy_event.set()
+        for d in da
+    )
+
 
+def _cloud_push(da: DocumentArray, name: str) -> None:
     try:
-        da_batches.push(name)
+        to_datauri_documents(da).push(name)
         logger.debug(f'cloud backup to {name}')
     except Exception as ex:
-        logger.debug(f'cloud backup failed: {ex}')
-    is_busy_event.clear()
+        logger.warning(f'cloud backup to {name} failed: {ex}')
@@ -0,0 +1,241 @@
+import io
+import os
+import struct
+from math import ceil, sqrt
+from typing import List
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def _draw_index(image: 'Image.Image', idx: int) -> 'Image.Image':
+    draw = ImageDraw.Draw(image)
+    draw.text((0, 0), str(idx), (255, 255, 255))
+    return image
+
+
+def _encode_gif_frame(image: 'Image.Image', duration: int) -> bytes:
+    """
+    Encode `image` as the blocks of one GIF frame: a graphic control extension with the duration in milliseconds,
+    an image descriptor with a local color table and the LZW image data.
+    """
+    buf = io.BytesIO()
+    image.convert('RGB').quantize().save(buf, format='GIF')
+    data = buf.getvalue()
+
+    # the standalone GIF has a global color table, which is moved into the frame as its local color table
+    flags = data[10]
+    color_table_end = 13 + (3 << ((flags & 7) + 1) if flags & 128 else 0)
+    color_table = data[13:color_table_end]
+
+    pos = color_table_end
+    while data[pos : pos + 1] == b'!':  # skip the extensions
+        pos += 2
+        while data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+
+    descriptor = bytearray(data[pos : pos + 10])
+    if color_table:
+        descriptor[9] |= 128 | (flags & 7)
+
+    gce = b'!\xf9\x04\x00' + struct.pack('<H', duration // 10) + b'\x00\x00'
+    # the image data runs until the trailer `;`
+    return gce + bytes(descriptor) + color_table + data[pos + 10 : -1]
+
+
+class GifWriter:
+    """
+    Write an animated GIF frame by frame.
+
+    Frames are encoded when they are appended and written to the file by :meth:`flush`, which only appends the new
+    frames to the file. After each flush, the file is a valid GIF of all frames so far.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        duration: int,
+        size_ratio: float = 1.0,
+        show_index: bool = True,
+    ):
+        self.path = path
+        self.duration = duration
+        self.size_ratio = size_ratio
+        self.show_index = show_index
+        self._size = None
+        self._num_frames = 0
+        self._pending: List[bytes] = []
+
+    def append(self, image: 'Image.Image') -> None:
+        if self._size is None:
+            w, h = image.size
+            if self.size_ratio < 1:
+                w, h = int(self.size_ratio * w), int(self.size_ratio * h)
+            self._size = (w, h)
+
+        if image.size != self._size:
+            image = image.resize(self._size)
+        else:
+            image = image.copy()
+        if self.show_index:
+            _draw_index(image, self._num_frames)
+
+        self._pending.append(_encode_gif_frame(image, self.duration))
+        self._num_frames += 1
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+
+        if self._num_frames == len(self._pending):
+            with open(self.path, 'wb') as fp:
+                fp.write(b'GIF89a' + struct.pack('<HHBBB', *self._size, 0, 0, 0))
+                # loop forever
+                fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+                fp.write(b''.join(self._pending) + b';')
+        else:
+            with open(self.path, 'r+b') as fp:
+                # overwrite the trailer
+                fp.seek(-1, io.SEEK_END)
+                fp.write(b''.join(self._pending) + b';')
+        self._pending.clear()
+
+
+class SpriteWriter:
+    """
+    Write a sprite image of the progress, tile by tile.
+
+    The canvas is allocated for `num_tiles` tiles up front with the same layout as
+    :meth:`docarray.DocumentArray.plot_image_sprites`, so appending an image only resizes and blits its own tile.
+    When more tiles than expected are appended, the canvas is laid out again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        num_tiles: int,
+        canvas_size: int = 512,
+        min_size: int = 16,
+        show_index: bool = True,
+    ):
+        self.path = path
+        self.canvas_size = canvas_size
+        self.min_size = min_size
+        self.show_index = show_index
+        self._num_tiles = 0
+        self._canvas = None
+        self._aspect_ratio = None
+        self._layout(max(num_tiles, 1))
+
+    def _layout(self, capacity: int) -> None:
+        img_per_row = ceil(sqrt(capacity))
+        tile_w = int(self.canvas_size / img_per_row)
+        if tile_w < self.min_size:
+            tile_w = self.min_size
+            img_per_row = max(int(self.canvas_size / tile_w), 1)
+        self._capacity = capacity
+        self._img_per_row = img_per_row
+        self._tile_w = tile_w
+
+    @property
+    def _tile_h(self) -> int:
+        return int(self._aspect_ratio * self._tile_w)
+
+    def _allocate(self, old_canvas=None, old_layout=None) -> None:
+        img_per_col = ceil(self._capacity / self._img_per_row)
+        self._canvas = np.zeros(
+            [self._tile_h * img_per_col, self._tile_w * self._img_per_row, 3],
+            dtype='uint8',
+        )
+        if old_canvas is None:
+            return
+
+        # re-layout the tiles that are already on the canvas
+        w, h, img_per_row = old_layout
+        for idx in range(self._num_tiles):
+            row, col = divmod(idx, img_per_row)
+            tile = old_canvas[row * h : (row + 1) * h, col * w : (col + 1) * w]
+            self._blit(idx, Image.fromarray(tile))
+
+    def _blit(self, idx: int, image: 'Image.Image') -> None:
+        w, h = self._tile_w, self._tile_h
+        if image.size != (w, h):
+            image = image.resize((w, h))
+        row, col = divmod(idx, self._img_per_row)
+        self._canvas[row * h : (row + 1) * h, col * w : (col + 1) * w] = np.asarray(
+            image.convert('RGB')
+        )
+
+    def append(self, image: 'Image.Image') -> None:
+        if self._aspect_ratio is None:
+            self._aspect_ratio = image.size[1] / image.size[0]
+            self._allocate()
+        elif self._num_tiles == self._capacity:
+            old_layout = (self._tile_w, self._tile_h, self._img_per_row)
+            self._layout(self._capacity * 2)
+            self._allocate(self._canvas, old_layout)
+
+        w, h = self._tile_w, self._tile_h
+        tile = image.resize((w, h)) if image.size != (w, h) else image.copy()
+        if self.show_index:
+            _draw_index(tile, self._num_tiles)
+        self._blit(self._num_tiles, tile)
+        self._num_tiles += 1
+
+    def save(self) -> None:
+        if self._canvas is not None:
+            Image.fromarray(self._canvas).save(self.path)
+
+
+class ProgressWriter:
+    """
+    The progress sprite images and GIFs of one batch, i.e. `{nb}-progress-{k}.png` and `{nb}-progress-{k}.gif` for
+    every image `k` in the batch.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        nb: int,
+        batch_size: int,
+        num_tiles: int,
+        gif_fps: int,
+        gif_size_ratio: float,
+    ):
+        self.sprites = [
+            SpriteWriter(os.path.join(output_dir, f'{nb}-progress-{k}.png'), num_tiles)
+            for k in range(batch_size)
+        ]
+        self.gifs = (
+            [
+                GifWriter(
+                    os.path.join(output_dir, f'{nb}-progress-{k}.gif'),
+                    duration=1000 // gif_fps,
+                    size_ratio=gif_size_ratio,
+                )
+                for k in range(batch_size)
+            ]
+            if gif_fps > 0
+            else []
+        )
+
+    def append_tile(self, k: int, image: 'Image.Image') -> None:
+        self.sprites[k].append(image)
+
+    def append_frame(self, k: int, image: 'Image.Image') -> None:
+        if self.gifs:
+            self.gifs[k].append(image)
+
+    def save(self) -> None:
+        for sprite in self.sprites:
+            sprite.save()
+        for gif in self.gifs:
+            gif.flush()
+
+
+def count_save_steps(num_steps: int, save_rate: int) -> int:
+    """Return the number of steps out of `num_steps` that are saved, i.e. every `save_rate` step and the last one."""
+    if save_rate <= 0:
+        return 1
+    return len(range(0, num_steps, save_rate)) + int((num_steps - 1) % save_rate != 0)
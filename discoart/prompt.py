@@ -1,8 +1,13 @@
 import copy
 from types import SimpleNamespace
-from typing import List, Dict, Any, Union, Tuple
+from typing import List, Dict, Any, Union, Tuple, Optional
 
-from .helper import PromptParser, _eval_scheduling_str
+import numpy as np
+import torch
+from torch.nn.functional import normalize as normalize_fn
+
+from .helper import get_prompt_parser
+from .schedule import _MAX_DIFFUSION_STEPS, compile_schedule
 
 
 class PromptPlanner:
@@ -11,23 +16,25 @@ class PromptPlanner:
         if isinstance(text_prompts, str):
             text_prompts = [text_prompts]
 
-        pmp = PromptParser(on_misspelled_token=args.on_misspelled_token)
+        pmp = get_prompt_parser()
         prompts = []  # type: List[Union[Dict[str, Any], SimpleNamespace]]
         if isinstance(text_prompts, list):
             # for legacy prompts
             for _p in text_prompts:
-                _pw = pmp.parse(_p)
+                _pw = pmp.parse(_p, args.on_misspelled_token)
                 prompts.append(
-                    {'tokenized': _pw[0], 'weight': _eval_scheduling_str(_pw[1])}
+                    {'tokenized': _pw[0], 'weight': compile_schedule(_pw[1])}
                 )
         elif isinstance(text_prompts, dict):
             if text_prompts.get('version') == '1':
                 prompts = text_prompts['prompts']
                 for _p in text_prompts['prompts']:
-                    txt, weight = pmp.parse(_p['text'], _p.get('spellcheck'))
+                    txt, weight = pmp.parse(
+                        _p['text'], _p.get('spellcheck') or args.on_misspelled_token
+                    )
                     weight = _p.get('weight', weight)
                     _p['tokenized'] = txt
-                    _p['weight'] = _eval_scheduling_str(weight)
+                    _p['weight'] = compile_schedule(weight)
             else:
                 raise ValueError(
                     f'unsupported text prompts schema: {text_prompts.get("version")}'
@@ -40,7 +47,7 @@ class PromptPlanner:
 
         # unify and set default for all prompts
         for idx, p in enumerate(prompts):
-            p['schedule'] = _eval_scheduling_str(p.get('schedule', True))
+            p['schedule'] = compile_schedule(p.get('schedule', True))
             p['clip_guidance'] = set(p.get('clip_guidance', args.clip_models))
             if not set(p['clip_guidance']).issubset(args.clip_models):
                 raise ValueError(
@@ -63,5 +70,54 @@ class PromptPlanner:
             )
         )
 
+    def get_weight_table(self, active_clip) -> 'np.ndarray':
+        """
+        Return the prompt weights of `active_clip` over all diffusion steps.
+
+        :param active_clip: the name of the CLIP model
+        :return: an array of shape `[_MAX_DIFFUSION_STEPS, len(prompts)]`, inactive prompts have weight 0
+        """
+        table = np.zeros([_MAX_DIFFUSION_STEPS, len(self.prompts)])
+        for idx, p in enumerate(self):
+            if active_clip in p.clip_guidance:
+                table[:, idx] = p.weight.to_array() * p.schedule.to_array(dtype=bool)
+        return table
+
+    def get_active_steps(self, active_clip) -> 'np.ndarray':
+        """Return a boolean mask over all diffusion steps, true where `active_clip` has at least one active prompt."""
+        return self.get_weight_table(active_clip).any(axis=1)
+
     def __iter__(self):
         return iter(self.prompts)
+
+
+class PromptWeights:
+    """
+    The active prompt embeddings and their normalized weights of a CLIP model at each diffusion step.
+
+    Identical rows of the weight table share the same embeddings and weights, which are gathered on the device once.
+    """
+
+    def __init__(self, weight_table: 'np.ndarray', prompt_embeds: 'torch.Tensor'):
+        unique_rows, row_ids = np.unique(weight_table, axis=0, return_inverse=True)
+        self._row_ids = row_ids.reshape(-1)
+        self._rows = []
+        for row in unique_rows:
+            ids = np.flatnonzero(row)
+            if not len(ids):
+                self._rows.append(None)
+                continue
+            embeds = prompt_embeds[torch.as_tensor(ids, device=prompt_embeds.device)]
+            weights = normalize_fn(
+                torch.tensor(
+                    row[ids], device=prompt_embeds.device, dtype=torch.float16
+                ),
+                dim=0,
+            )
+            self._rows.append((ids.tolist(), embeds, weights))
+
+    def __getitem__(
+        self, num_step
+    ) -> Optional[Tuple[List[int], 'torch.Tensor', 'torch.Tensor']]:
+        """Return the active prompt ids, embeddings and weights at `num_step`, or None when no prompt is active."""
+        return self._rows[self._row_ids[num_step]]
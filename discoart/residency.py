@@ -0,0 +1,244 @@
+import contextlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterator, Tuple
+
+import torch
+
+from .helper import _load_clip_model, logger
+
+
+def get_model_size(obj: Any) -> int:
+    """
+    Return the number of bytes of the parameters and buffers of `obj`, a module or a tuple of modules. Released
+    tensors on the `meta` device take no memory.
+    """
+    if isinstance(obj, torch.nn.Module):
+        return sum(
+            t.numel() * t.element_size()
+            for t in (*obj.parameters(), *obj.buffers())
+            if t.device.type != 'meta'
+        )
+    if isinstance(obj, (tuple, list)):
+        return sum(get_model_size(v) for v in obj)
+    return 0
+
+
+class ModelCache:
+    """
+    An in-memory LRU cache of loaded models that are reused across `create()` calls.
+
+    Models are keyed by everything their weights depend on, e.g. the model name, the resolved config, the device and
+    the precision. Once the models in the cache take more than ``max_size`` bytes, the least recently used models are
+    evicted. A model in use by a running `create()` is only released from the cache, its memory is freed once the run
+    drops it.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._models: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._loading: Dict[Hashable, threading.Lock] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._models
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def get_or_load(self, key: Hashable, load_fn: Callable[[], Any]) -> Any:
+        """
+        Return the model of `key`, it is loaded by `load_fn` on a miss.
+
+        :param key: a hashable key of the model
+        :param load_fn: the function to load the model
+        :return: the model
+        """
+        with self._lock:
+            model = self._get(key)
+            if model is not None:
+                return model
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        # different models are loaded concurrently, the same model only once
+        with key_lock:
+            with self._lock:
+                model = self._get(key)
+                if model is not None:
+                    return model
+
+            try:
+                model = load_fn()
+                with self._lock:
+                    self._models[key] = model
+                    self._sizes[key] = get_model_size(model)
+                    self._evict(keep=key)
+                return model
+            finally:
+                # also after a failed load, e.g. a download error, so that a retry starts afresh
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def update_size(self, model: Any) -> None:
+        """Account the size of the cached `model` again, e.g. after some of its weights are released or loaded."""
+        with self._lock:
+            for key, m in self._models.items():
+                if m is model:
+                    self._sizes[key] = get_model_size(m)
+                    self._evict(keep=key)
+                    return
+
+    def _get(self, key: Hashable) -> Any:
+        if key not in self._models:
+            return None
+        self._models.move_to_end(key)
+        logger.debug(f'{key[:2]} is reused from the model cache')
+        return self._models[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
+    def _evict(self, keep: Hashable) -> None:
+        for key in list(self._models):
+            if self.size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self._models.pop(key)
+            self._sizes.pop(key)
+            logger.debug(f'{key[:2]} is evicted from the model cache')
+
+
+_model_cache = None
+
+
+def get_model_cache() -> ModelCache:
+    """Return the model cache of the process, its budget in MB is set by `DISCOART_MODEL_CACHE_SIZE`."""
+    global _model_cache
+    if _model_cache is None:
+        _model_cache = ModelCache(
+            int(os.environ.get('DISCOART_MODEL_CACHE_SIZE', 8192)) << 20
+        )
+    return _model_cache
+
+
+def _iter_text_tensors(
+    clip_model: 'torch.nn.Module',
+) -> Iterator[Tuple[str, 'torch.nn.Module', str, 'torch.Tensor']]:
+    # the text tower is everything of a CLIP model except its `visual` arm
+    for prefix, module in clip_model.named_modules():
+        if prefix == 'visual' or prefix.startswith('visual.'):
+            continue
+        for attr, t in (*module._parameters.items(), *module._buffers.items()):
+            if t is not None:
+                yield (f'{prefix}.{attr}' if prefix else attr), module, attr, t
+
+
+def _set_tensor(module: 'torch.nn.Module', attr: str, t: 'torch.Tensor') -> None:
+    if attr in module._parameters:
+        module._parameters[attr] = torch.nn.Parameter(
+            t, requires_grad=module._parameters[attr].requires_grad
+        )
+    else:
+        module._buffers[attr] = t
+
+
+def get_text_dtype(clip_model: 'torch.nn.Module') -> 'torch.dtype':
+    """Return the dtype of the text embeddings of `clip_model`, it does not change when the text tower is offloaded."""
+    # OpenAI models cast the text features to the dtype of their visual arm, e.g. fp16 on GPU
+    dtype = getattr(clip_model, 'dtype', None)
+    if isinstance(dtype, torch.dtype):
+        return dtype
+    text_projection = getattr(clip_model, 'text_projection', None)
+    if isinstance(text_projection, torch.Tensor):
+        return text_projection.dtype
+    for *_, t in _iter_text_tensors(clip_model):
+        if t.is_floating_point():
+            return t.dtype
+    return torch.float32
+
+
+# the cached CLIP models are shared by concurrent runs, their text towers only move under this lock
+_text_tower_lock = threading.RLock()
+_text_tower_users = weakref.WeakKeyDictionary()
+
+
+@contextlib.contextmanager
+def text_tower_lease(clip_model: 'torch.nn.Module', policy: str):
+    """
+    A context to encode prompts with the text tower of `clip_model`, the residency `policy` is applied on exit.
+
+    The text tower is only offloaded or released once no other run holds a lease on the same model, as a cached CLIP
+    model is shared by all runs.
+
+    :param clip_model: the CLIP model
+    :param policy: the residency policy, see :func:`offload_text_tower`
+    """
+    with _text_tower_lock:
+        _text_tower_users[clip_model] = _text_tower_users.get(clip_model, 0) + 1
+    try:
+        yield
+    finally:
+        with _text_tower_lock:
+            _text_tower_users[clip_model] -= 1
+            if not _text_tower_users[clip_model]:
+                del _text_tower_users[clip_model]
+                offload_text_tower(clip_model, policy)
+
+
+def offload_text_tower(clip_model: 'torch.nn.Module', policy: str) -> None:
+    """
+    Apply the residency `policy` to the text tower of `clip_model` once the prompt embeddings are computed.
+
+    :param clip_model: the CLIP model
+    :param policy: `keep` leaves the text tower in place, `offload` moves it to the CPU, `release` frees its weights,
+        only their shapes and dtypes are kept to load them again
+    """
+    if policy == 'keep':
+        return
+    if policy not in ('offload', 'release'):
+        raise ValueError(
+            f'text_clip_residency must be one of `keep`, `offload` and `release`, got `{policy}`'
+        )
+    target = torch.device('cpu' if policy == 'offload' else 'meta')
+    with _text_tower_lock:
+        for _, module, attr, t in _iter_text_tensors(clip_model):
+            if t.device.type != 'meta':
+                _set_tensor(module, attr, t.to(target))
+    get_model_cache().update_size(clip_model)
+
+
+def load_text_tower(clip_model: 'torch.nn.Module', name: str, device) -> None:
+    """
+    Make the text tower of `clip_model` resident on `device` for encoding prompts.
+
+    A released text tower is loaded again from the CLIP checkpoint on the CPU, its visual arm is dropped at once.
+
+    :param clip_model: the CLIP model
+    :param name: the name of the CLIP model, e.g. `ViT-B-32::openai`
+    :param device: the device to encode prompts on
+    """
+    with _text_tower_lock:
+        tensors = list(_iter_text_tensors(clip_model))
+        fresh = {}
+        if any(t.device.type == 'meta' for *_, t in tensors):
+            logger.debug(f'loading the text tower of {name} again...')
+            fresh = {
+                k: t
+                for k, *_, t in _iter_text_tensors(
+                    _load_clip_model(name, torch.device('cpu'))
+                )
+            }
+        for k, module, attr, t in tensors:
+            # the dtype of the resident model is kept, e.g. fp16 of OpenAI models loaded to GPU
+            _set_tensor(module, attr, fresh.get(k, t).to(device=device, dtype=t.dtype))
+    get_model_cache().update_size(clip_model)
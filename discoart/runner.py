@@ -1,42 +1,64 @@
 import copy
 import os.path
 import tempfile
-import threading
-from typing import Callable, Optional
+import time
+from typing import Callable, Dict, Optional
 
 import clip
-import lpips
+import numpy as np
 import torch
 import torchvision.transforms.functional as TF
 import wandb
 from docarray import DocumentArray, Document
-from torch.nn.functional import normalize as normalize_fn
+from PIL import Image
 
+from .cache import get_text_embeds_cache
+from .checkpoint import (
+    get_checkpoint_path,
+    new_checkpoint,
+    save_checkpoint,
+)
 from .config import save_config_svg, export_python
 from .helper import (
     logger,
     get_ipython_funcs,
     free_memory,
     _MAX_DIFFUSION_STEPS,
-    _eval_scheduling_str,
     _get_current_schedule,
     _get_schedule_table,
     get_output_dir,
     is_jupyter,
+    load_lpips_model,
 )
-from .nn.helper import set_seed, detach_gpu
-from .nn.losses import spherical_dist_loss, tv_loss, range_loss
-from .nn.make_cutouts import MakeCutouts
+from .nn.helper import set_seed, get_rng_state, set_rng_state
+from .nn.losses import spherical_dist_loss, tv_loss, range_loss, downsample
+from .nn.make_cutouts import CutoutPlanner, MakeCutouts
+from .nn.micro_batch import CutMicroBatcher, get_cut_loss
+from .nn.sampling import sample_loop_progressive
 from .nn.sec_diff import alpha_sigma_to_t
+from .nn.shared_forward import SharedForward
 from .nn.transform import symmetry_transformation_fn, inv_normalize
-from .persist import _sample_thread, _persist_thread, _save_progress_thread
-from .prompt import PromptPlanner
+from .persist import PersistWorker, _sample, _save_progress, _save_telemetry
+from .progress import ProgressWriter, count_save_steps
+from .prompt import PromptPlanner, PromptWeights
+from .residency import get_text_dtype, load_text_tower, text_tower_lease
+from .schedule import compile_schedule
+from .store import load_results
+from .telemetry import LossTracker, is_wandb_enabled
 
 
 def do_run(
-    args, models, device, events, image_callback: Optional[Callable[[str], None]] = None
+    args,
+    models,
+    device,
+    events,
+    image_callback: Optional[Callable[[str], None]] = None,
+    checkpoint: Optional[Dict] = None,
+    prompts: Optional[PromptPlanner] = None,
 ) -> 'DocumentArray':
     skip_event, stop_event = events
+    # the config with the original seed, as `args.seed` is changed for every batch
+    config = copy.deepcopy(vars(args))
 
     _is_jupyter = is_jupyter()
 
@@ -45,7 +67,6 @@ def do_run(
     logger.info('preparing models...')
 
     model, diffusion, clip_models, secondary_model = models
-    lpips_model = lpips.LPIPS(net='vgg').to(device)
 
     side_x, side_y = ((args.width_height[j] // 64) * 64 for j in (0, 1))
 
@@ -55,16 +76,20 @@ def do_run(
 
     skip_steps = args.skip_steps
 
-    loss_values = []
+    loss_tracker = LossTracker(device, log_to_wandb=is_wandb_enabled())
+
+    cut_micro_batcher = CutMicroBatcher(args.cut_batch_memory_budget, device)
 
     model_stats = []
 
     _dp1, _, _handlers, _redraw_fn = get_ipython_funcs(show_widgets=True)
     _dp1.clear_output(wait=True)
 
-    prompts = PromptPlanner(args)
+    if prompts is None:
+        prompts = PromptPlanner(args)
 
     text_device = torch.device('cpu') if args.text_clip_on_cpu else device
+    text_embeds_cache = get_text_embeds_cache()
 
     for model_name, clip_model in clip_models.items():
 
@@ -81,9 +106,9 @@ def do_run(
                 f'fail to find input_resolution for {model_name}, fall back to {input_resolution}'
             )
 
-        schedules = [True] * _MAX_DIFFUSION_STEPS
+        schedules = compile_schedule(True)
         if args.clip_models_schedules and model_name in args.clip_models_schedules:
-            schedules = _eval_scheduling_str(args.clip_models_schedules[model_name])
+            schedules = compile_schedule(args.clip_models_schedules[model_name])
 
         clip_model_stats = {
             'model_name': model_name,
@@ -91,20 +116,19 @@ def do_run(
             'prompt_embeds': [],
             'schedules': schedules,
             'input_resolution': input_resolution,
+            'make_cutouts': MakeCutouts(input_resolution),
         }
 
-        for _p in prompts:
-            txt = clip_model.encode_text(
-                clip.tokenize(
-                    _p.tokenized, truncate=args.truncate_overlength_prompt
-                ).to(text_device)
-            )
-
-            clip_model_stats['prompt_embeds'].append(txt)
+        # only the visual arm is used for the rest of the run, the text tower is then offloaded unless another run
+        # encodes prompts with the same cached model
+        with text_tower_lease(clip_model, args.text_clip_residency):
+            clip_model_stats['prompt_embeds'] = _get_prompt_embeds(
+                clip_model, model_name, prompts, args, text_device, text_embeds_cache
+            ).to(device)
 
-        clip_model_stats['prompt_embeds'] = torch.cat(
-            clip_model_stats['prompt_embeds']
-        ).to(device)
+        clip_model_stats['prompt_weights'] = PromptWeights(
+            prompts.get_weight_table(model_name), clip_model_stats['prompt_embeds']
+        )
 
         model_stats.append(clip_model_stats)
 
@@ -123,20 +147,76 @@ def do_run(
         )
 
     cur_t = None
+    last_cond_t = None
 
-    def cond_fn(x, t, **kwargs):
+    # the timestep that `cond_fn` receives for each `cur_t`, looked up on the host instead of reading `t` from the device
+    model_timesteps = diffusion._wrap_model(lambda _, ts: ts)(
+        None, torch.arange(diffusion.num_timesteps)
+    ).tolist()
 
+    def get_num_step(t_idx):
         t_int = (
-            int(t[0].item()) + 1
+            int(model_timesteps[t_idx]) + 1
         )  # errors on last step without +1, need to find source
+        return _MAX_DIFFUSION_STEPS - t_int
+
+    guidance_mask = _get_guidance_mask(schedule_table, prompts, model_stats)
+
+    # LPIPS is only loaded when the init loss is scheduled on any step of this run
+    lpips_model = None
+    has_init = (
+        args.init_image
+        or args.perlin_init
+        or (checkpoint and checkpoint.get('init') is not None)
+    )
+    if has_init and any(
+        schedule_table[get_num_step(t_idx)].init_scale
+        for t_idx in range(diffusion.num_timesteps - skip_steps)
+    ):
+        lpips_model = load_lpips_model(device)
+
+    def is_guidance_active(num_step):
+        # `init` can be regenerated per batch by `perlin_init`, so its loss is checked at runtime
+        return guidance_mask[num_step] or (
+            init is not None and bool(schedule_table[num_step].init_scale)
+        )
+
+    def needs_shared_forward():
+        if cur_t == last_cond_t:
+            # the second evaluation of the first PLMS step, `cond_fn` runs the model on its own leaf at `t - 1`
+            return False
+        num_step = get_num_step(cur_t)
+        return (
+            is_guidance_active(num_step)
+            and not schedule_table[num_step].use_secondary_model
+        )
+
+    # the UNet forward of the sampler is reused by `cond_fn` on the guided steps without the secondary model
+    shared_model = SharedForward(model, needs_shared_forward)
 
-        num_step = _MAX_DIFFUSION_STEPS - t_int
+    def cond_fn(x, t, **kwargs):
+        nonlocal last_cond_t
+
+        # PLMS evaluates its first step twice, the second time at `t - 1`
+        t_idx = cur_t - 1 if cur_t == last_cond_t else cur_t
+        last_cond_t = cur_t
+
+        num_step = get_num_step(t_idx)
         scheduler = _get_current_schedule(schedule_table, num_step)
         is_cuts_visualized = False
 
+        if not is_guidance_active(num_step):
+            # every guidance term is zero, so the step runs as unguided sampling
+            loss_tracker.record(num_step, {}, False, scheduler=vars(scheduler))
+            return torch.zeros_like(x)
+
         with torch.enable_grad():
 
-            x = x.detach().requires_grad_()
+            x = (
+                shared_model.get_leaf(x)
+                if t_idx == cur_t
+                else x.detach().requires_grad_()
+            )
             if scheduler.use_secondary_model:
                 alpha = torch.tensor(
                     diffusion.sqrt_alphas_cumprod[cur_t],
@@ -152,9 +232,9 @@ def do_run(
                 out = secondary_model(x, cosine_t[None].repeat([x.shape[0]])).pred
             else:
                 my_t = torch.ones([x.shape[0]], device=device, dtype=torch.long) * cur_t
-                out = diffusion.p_mean_variance(model, x, my_t, clip_denoised=False)[
-                    'pred_xstart'
-                ]
+                out = diffusion.p_mean_variance(
+                    shared_model, x, my_t, clip_denoised=False
+                )['pred_xstart']
 
             fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
             x_in = out * fac + x * (1 - fac)
@@ -178,155 +258,186 @@ def do_run(
                 sat_losses = 0
 
             if init is not None and scheduler.init_scale:
-                init_losses = lpips_model(x_in, init).sum() * scheduler.init_scale
+                init_losses = (
+                    lpips_model(
+                        downsample(x_in, args.init_loss_size),
+                        downsample(init, args.init_loss_size),
+                    ).sum()
+                    * scheduler.init_scale
+                )
             else:
                 init_losses = 0
 
             loss = tv_losses + range_losses + sat_losses + init_losses
 
-            if loss != 0:
+            if torch.is_tensor(loss):
                 x_in_grad = torch.autograd.grad(loss, x_in)[0]
             else:
                 x_in_grad = 0
 
             cut_losses = 0
 
+            cut_planner = CutoutPlanner(
+                x_in.add(1).div(2),
+                Overview=scheduler.cut_overview,
+                InnerCrop=scheduler.cut_innercut,
+                IC_Size_Pow=scheduler.cut_ic_pow,
+                IC_Grey_P=scheduler.cut_icgray_p,
+                share_innercut_geometry=args.share_innercut_geometry,
+            )
+
             for model_stat in model_stats:
 
                 if not model_stat['schedules'][num_step]:
                     continue
 
-                active_prompt_ids = prompts.get_prompt_ids(
-                    model_stat['model_name'], num_step
-                )
+                active_prompts = model_stat['prompt_weights'][num_step]
 
-                if active_prompt_ids:
-                    masked_embeds = model_stat['prompt_embeds'][
-                        list(active_prompt_ids[0])
-                    ]
-                    masked_weights = normalize_fn(
-                        torch.tensor(
-                            active_prompt_ids[1], device=device, dtype=torch.float16
-                        ),
-                        dim=0,
-                    )
-                    logger.debug(
-                        f'activate prompt ids: {active_prompt_ids} prompt weights: {masked_weights}'
-                    )
+                if active_prompts:
+                    active_prompt_ids, masked_embeds, masked_weights = active_prompts
+                    logger.debug(f'activate prompt ids: {active_prompt_ids}')
                 else:
                     continue
 
-                cuts = MakeCutouts(
+                num_cuts = scheduler.cut_overview + scheduler.cut_innercut
+                micro_batches = cut_micro_batcher.split(
+                    model_stat['model_name'],
+                    scheduler.cutn_batches,
+                    num_cuts * x.shape[0],
                     model_stat['input_resolution'],
-                    Overview=scheduler.cut_overview,
-                    InnerCrop=scheduler.cut_innercut,
-                    IC_Size_Pow=scheduler.cut_ic_pow,
-                    IC_Grey_P=scheduler.cut_icgray_p,
                 )
 
-                for _ in range(scheduler.cutn_batches):
-
-                    clip_in = cuts(x_in.add(1).div(2))
-
-                    if args.visualize_cuts and not is_cuts_visualized:
-                        _cuts_da = DocumentArray.empty(clip_in.shape[0])
-                        _cuts_da.tensors = (
-                            (inv_normalize(clip_in) * 255).detach().cpu().numpy()
-                        )
-                        _cuts_da.plot_image_sprites(
-                            os.path.join(output_dir, f'{_nb}-cuts-{num_step}.png'),
-                            show_index=True,
-                            channel_axis=0,
+                cut_batch_idx = 0
+                for micro_batch_size in micro_batches:
+                    with cut_micro_batcher.calibrate(
+                        model_stat['model_name'],
+                        micro_batch_size * num_cuts * x.shape[0],
+                    ):
+                        clip_in = model_stat['make_cutouts'].augment_cuts(
+                            [
+                                c
+                                for j in range(micro_batch_size)
+                                for c in cut_planner.get_cuts(
+                                    model_stat['input_resolution'], cut_batch_idx + j
+                                )
+                            ]
                         )
-                        is_cuts_visualized = True
+                        cut_batch_idx += micro_batch_size
+
+                        if args.visualize_cuts and not is_cuts_visualized:
+                            _cuts_da = DocumentArray.empty(num_cuts * x.shape[0])
+                            _cuts_da.tensors = (
+                                (inv_normalize(clip_in[: len(_cuts_da)]) * 255)
+                                .detach()
+                                .cpu()
+                                .numpy()
+                            )
+                            _cuts_da.plot_image_sprites(
+                                os.path.join(output_dir, f'{_nb}-cuts-{num_step}.png'),
+                                show_index=True,
+                                channel_axis=0,
+                            )
+                            is_cuts_visualized = True
 
-                    image_embeds = (
-                        model_stat['clip_model'].encode_image(clip_in).unsqueeze(1)
-                    )
+                        image_embeds = (
+                            model_stat['clip_model'].encode_image(clip_in).unsqueeze(1)
+                        )
 
-                    dists = spherical_dist_loss(
-                        image_embeds,
-                        masked_embeds.unsqueeze(0),  # 1, 2, 512
-                    )
+                        dists = spherical_dist_loss(
+                            image_embeds,
+                            masked_embeds.unsqueeze(0),  # 1, 2, 512
+                        )
 
-                    dists = dists.view(
-                        [
-                            scheduler.cut_overview + scheduler.cut_innercut,
+                        cut_loss = get_cut_loss(
+                            dists,
+                            masked_weights,
+                            micro_batch_size,
+                            num_cuts,
                             x.shape[0],
-                            -1,
-                        ]
-                    )
+                            scheduler.clip_guidance_scale,
+                            scheduler.cutn_batches,
+                        )
 
-                    cut_loss = (
-                        dists.mul(masked_weights).sum(2).mean(0).sum()
-                        * scheduler.clip_guidance_scale
-                        / scheduler.cutn_batches
-                    )
+                        # the planned cutouts are reused by the next cutn batches and models, so their graph is retained
+                        (cut_grad,) = torch.autograd.grad(
+                            cut_loss, x_in, retain_graph=True
+                        )
+                        x_in_grad += cut_grad
 
-                    x_in_grad += torch.autograd.grad(cut_loss, x_in)[0]
+                        cut_losses = cut_losses + cut_loss.detach()
 
-                    cut_losses += cut_loss.detach().item()
+                        # release the retained CLIP graph before the next micro-batch builds its own
+                        del clip_in, image_embeds, dists, cut_loss
 
-        x_is_NaN = False
         if isinstance(x_in_grad, int) and x_in_grad == 0:
+            is_nan = torch.zeros([], dtype=torch.bool, device=device)
             grad = torch.zeros_like(x)
-        elif not torch.isnan(x_in_grad).any():
-            grad = -torch.autograd.grad(x_in, x, x_in_grad)[0]
         else:
-            x_is_NaN = True
-            grad = torch.zeros_like(x)
-            logger.warning(
-                f'NaN detected in grad at the diffusion inner-step {num_step}, no panic. '
-                f'However, if this message continues to show up *in a row*, '
-                f'then your generation is ill-conditioned and image will not updated, further steps are unnecessary.'
-            )
+            # a NaN gradient is masked on the device, so that no step has to wait for the check
+            is_nan = torch.isnan(x_in_grad).any()
+            grad = -torch.autograd.grad(x_in, x, x_in_grad.masked_fill(is_nan, 0))[0]
 
         r_grad = grad
-        if scheduler.clamp_grad and not x_is_NaN:
+        if scheduler.clamp_grad:
             magnitude = r_grad.square().mean().sqrt()
-            r_grad = (
-                grad * magnitude.clamp(max=scheduler.clamp_max) / magnitude
+            r_grad = torch.where(
+                is_nan,
+                grad,
+                grad * magnitude.clamp(max=scheduler.clamp_max) / magnitude,
             )  # min=-0.02, min=-clamp_max,
 
-        traced_info = {
-            'losses/total': detach_gpu(loss) + cut_losses,
-            'losses/tv': detach_gpu(tv_losses),
-            'losses/range': detach_gpu(range_losses),
-            'losses/sat': detach_gpu(sat_losses),
-            'losses/init': detach_gpu(init_losses),
-            'losses/cuts': detach_gpu(cut_losses),
-        }
-
-        traced_info.update(
+        loss_tracker.record(
+            num_step,
             {
-                f'scheduler/{k}': int(v) if isinstance(v, bool) else v
-                for k, v in vars(scheduler).items()
-            }
+                'total': loss + cut_losses,
+                'tv': tv_losses,
+                'range': range_losses,
+                'sat': sat_losses,
+                'init': init_losses,
+                'cuts': cut_losses,
+            },
+            is_nan,
+            scheduler=vars(scheduler),
+            grad=r_grad,
         )
 
-        try:
-            traced_info['gradients'] = wandb.Histogram(r_grad.detach().cpu().numpy())
-        except ValueError:
-            # avoid nan gradients
-            pass
-
-        wandb.log(traced_info)
-        loss_values.append(traced_info['losses/total'])
+        shared_model.clear()
 
         return r_grad
 
-    if args.diffusion_sampling_mode == 'ddim':
-        sample_fn = diffusion.ddim_sample_loop_progressive
+    persist_worker = PersistWorker()
+    checkpoint_path = get_checkpoint_path(output_dir)
+
+    if args.spill_batches:
+        # finished batches are moved into SQLite, their documents are loaded on demand
+        spill_path = os.path.join(output_dir, 'da.sqlite')
+        if os.path.exists(spill_path):
+            os.remove(spill_path)
+        da_batches = DocumentArray(
+            storage='sqlite',
+            config={'connection': spill_path, 'table_name': 'discoart'},
+        )
     else:
-        sample_fn = diffusion.plms_sample_loop_progressive
-
-    is_busy_evs = [threading.Event() for _ in range(3)]
-
-    da_batches = DocumentArray()
+        da_batches = DocumentArray()
+    _da = DocumentArray()
+    # the cloud backup holds all results, with `spill_batches` every batch is pushed on its own to stay bounded
+    cloud_backup = {} if args.spill_batches else dict(cloud_da=da_batches)
 
     org_seed = args.seed
 
-    if os.environ.get('WANDB_MODE', 'disabled') == 'disabled':
+    start_nb, resumed_da = 0, None
+    if checkpoint:
+        start_nb = checkpoint['nb']
+        finished_da, resumed_da = _load_resumed_results(output_dir, checkpoint, args)
+        da_batches.extend(finished_da)
+        persist_worker.restore(
+            DocumentArray([*finished_da, *(resumed_da or [])]), args.name_docarray
+        )
+        logger.info(
+            f'resuming `{args.name_docarray}` from batch {start_nb} step {checkpoint["step"]}'
+        )
+
+    if not is_wandb_enabled():
         logger.info(
             '''
 W&B dashboard is disabled. To enable the online dashboard for tracking losses, gradients, 
@@ -340,44 +451,79 @@ scheduling tracking, please set `WANDB_MODE=online` before running/importing Dis
 '''
         )
 
-    for _nb in range(args.n_batches):
-        logger.info(
-            f'creating artworks `{args.name_docarray}` ({_nb}/{args.n_batches})...'
-        )
-
-        # set seed for each image in the batch
-        new_seed = org_seed + _nb
-        set_seed(new_seed)
-        args.seed = new_seed
-        if _is_jupyter:
-            redraw_widget(
-                _handlers,
-                _redraw_fn,
-                args,
-                _nb,
+    try:
+        for _nb in range(start_nb, args.n_batches):
+            logger.info(
+                f'creating artworks `{args.name_docarray}` ({_nb}/{args.n_batches})...'
             )
-        free_memory()
-
-        _da = DocumentArray(
-            [Document(tags=copy.deepcopy(vars(args))) for _ in range(args.batch_size)]
-        )
-        _da_gif = DocumentArray([Document() for _ in range(args.batch_size)])
-        da_batches.extend(_da)
 
-        cur_t = diffusion.num_timesteps - skip_steps - 1
+            # set seed for each image in the batch
+            new_seed = org_seed + _nb
+            set_seed(new_seed)
+            args.seed = new_seed
+            if _is_jupyter:
+                redraw_widget(
+                    _handlers,
+                    _redraw_fn,
+                    args,
+                    _nb,
+                )
+            free_memory()
 
-        if args.perlin_init:
-            init = regen_perlin(
-                args.perlin_mode, side_y, side_x, device, args.batch_size
+            is_resumed = _nb == start_nb and resumed_da is not None
+            if is_resumed:
+                _da = resumed_da
+            else:
+                _da = DocumentArray(
+                    [
+                        Document(tags=copy.deepcopy(vars(args)))
+                        for _ in range(args.batch_size)
+                    ]
+                )
+            _progress = ProgressWriter(
+                output_dir,
+                _nb,
+                args.batch_size,
+                count_save_steps(diffusion.num_timesteps - skip_steps, args.save_rate),
+                args.gif_fps,
+                args.gif_size_ratio,
             )
+            if args.spill_batches:
+                cloud_backup = dict(cloud_name=f'{args.name_docarray}-{_nb}')
+            else:
+                da_batches.extend(_da)
+
+            telemetry = loss_tracker.start_batch(diffusion.num_timesteps - skip_steps)
+            telemetry_path = os.path.join(output_dir, f'{_nb}-telemetry.npz')
+
+            start_step = 0
+            if is_resumed:
+                start_step = checkpoint['step'] + 1
+                telemetry.restore(checkpoint['telemetry'])
+                if args.image_output:
+                    _restore_progress(_progress, _da)
+                init = (
+                    checkpoint['init'].to(device)
+                    if checkpoint['init'] is not None
+                    else None
+                )
+                set_rng_state(checkpoint['rng_state'])
+            elif args.perlin_init:
+                init = regen_perlin(
+                    args.perlin_mode, side_y, side_x, device, args.batch_size
+                )
+
+            cur_t = diffusion.num_timesteps - skip_steps - 1 - start_step
+            last_cond_t = None
 
-        if args.diffusion_sampling_mode == 'ddim':
-            samples = sample_fn(
-                model,
+            samples = sample_loop_progressive(
+                diffusion,
+                shared_model,
                 (args.batch_size, 3, side_y, side_x),
+                args.diffusion_sampling_mode,
+                cond_fn=cond_fn,
                 clip_denoised=args.clip_denoised,
                 model_kwargs={},
-                cond_fn=cond_fn,
                 progress='DISCOART_DISABLE_TQDM' not in os.environ,
                 skip_timesteps=skip_steps,
                 init_image=init,
@@ -387,99 +533,239 @@ scheduling tracking, please set `WANDB_MODE=online` before running/importing Dis
                     x, args.use_horizontal_symmetry, args.use_vertical_symmetry
                 ),
                 transformation_percent=args.transformation_percent,
-            )
-        else:
-            samples = sample_fn(
-                model,
-                (args.batch_size, 3, side_y, side_x),
-                clip_denoised=args.clip_denoised,
-                model_kwargs={},
-                cond_fn=cond_fn,
-                progress='DISCOART_DISABLE_TQDM' not in os.environ,
-                skip_timesteps=skip_steps,
-                init_image=init,
-                randomize_class=args.randomize_class,
                 order=2,
+                start_step=start_step,
+                x=checkpoint['x'] if is_resumed else None,
+                old_eps=checkpoint['old_eps'] if is_resumed else None,
             )
 
-        threads = []
-
-        with wandb.init(
-            project=args.name_docarray,
-            config=vars(args),
-            anonymous='must',
-            reinit=True,
-            mode=os.environ.get('WANDB_MODE', 'disabled'),
-        ):
-            for j, sample in enumerate(samples):
-                if skip_event.is_set() or stop_event.is_set():
-                    logger.debug('skip_event/stop_event is set, skipping this run')
-                    skip_event.clear()
-                    break
-
-                cur_t -= 1
-
-                is_save_step = args.save_rate > 0 and j % args.save_rate == 0
-                is_complete = cur_t == -1
-                is_display_step = args.display_rate > 0 and j % args.display_rate == 0
-
-                threads.append(
-                    _sample_thread(
+            with wandb.init(
+                project=args.name_docarray,
+                config=vars(args),
+                anonymous='must',
+                reinit=True,
+                mode=os.environ.get('WANDB_MODE', 'disabled'),
+            ):
+                step_start = time.perf_counter()
+                for j, sample in enumerate(samples, start=start_step):
+                    telemetry.add_step_time(time.perf_counter() - step_start)
+
+                    if skip_event.is_set() or stop_event.is_set():
+                        logger.debug('skip_event/stop_event is set, skipping this run')
+                        skip_event.clear()
+                        break
+
+                    cur_t -= 1
+
+                    is_save_step = args.save_rate > 0 and j % args.save_rate == 0
+                    is_complete = cur_t == -1
+                    is_display_step = (
+                        args.display_rate > 0 and j % args.display_rate == 0
+                    )
+
+                    if is_save_step or is_complete or (_is_jupyter and is_display_step):
+                        loss_tracker.flush()
+
+                    persist_worker.submit(
+                        _sample,
                         sample,
                         _nb,
                         cur_t,
                         _da,
-                        _da_gif,
+                        _progress,
                         _handlers,
                         j,
-                        loss_values,
+                        {
+                            **telemetry.summary(),
+                            'telemetry': os.path.basename(telemetry_path),
+                        },
                         output_dir,
-                        is_busy_evs[0],
                         is_save_step or is_complete,
                         args.gif_fps > 0,
                         args.image_output,
                         is_display_step,
                         image_callback,
                     )
-                )
 
-                if is_complete or is_save_step:
-                    if args.image_output:
-                        threads.append(
-                            _save_progress_thread(
-                                _da,
-                                _da_gif,
-                                _nb,
-                                output_dir,
-                                args.gif_fps,
-                                args.gif_size_ratio,
+                    if is_complete or is_save_step:
+                        if args.image_output:
+                            persist_worker.submit(
+                                _save_progress,
+                                _progress,
+                                key=f'progress-{_nb}',
                             )
+
+                        persist_worker.submit(
+                            _save_telemetry,
+                            telemetry_path,
+                            telemetry.snapshot(schedule_table),
+                            key=f'telemetry-{_nb}',
+                        )
+                        persist_worker.submit_backup(
+                            _da, args.name_docarray, **cloud_backup
                         )
 
-                    threads.extend(
-                        _persist_thread(
-                            da_batches,
+                    if (
+                        args.checkpoint_rate > 0
+                        and (j + 1) % args.checkpoint_rate == 0
+                        and not is_complete
+                    ):
+                        loss_tracker.flush()
+                        persist_worker.submit_checkpoint(
+                            checkpoint_path,
+                            new_checkpoint(
+                                config,
+                                _nb,
+                                step=j,
+                                sample=sample,
+                                init=init,
+                                rng_state=get_rng_state(),
+                                doc_ids=_da[:, 'id'],
+                                telemetry=telemetry.snapshot(),
+                            ),
+                            _da,
                             args.name_docarray,
-                            is_busy_evs[1:],
-                            is_busy_evs[0],
-                            is_completed=is_complete,
                         )
-                    )
 
-        for t in threads:
-            t.join()
-        _dp1.clear_output(wait=True)
+                    step_start = time.perf_counter()
 
-        if stop_event.is_set():
-            logger.debug('stop_event is set, skipping the while `n_batches`')
-            stop_event.clear()
-            break
+            loss_tracker.flush()
+            persist_worker.submit(
+                _save_telemetry,
+                telemetry_path,
+                telemetry.snapshot(schedule_table),
+                key=f'telemetry-{_nb}',
+            )
+            persist_worker.flush_backup(_da, args.name_docarray, **cloud_backup)
+            persist_worker.wait()
+            if args.spill_batches:
+                da_batches.extend(_da)
+            if args.checkpoint_rate > 0 and not stop_event.is_set():
+                # the next batch starts from its seed, so no sampler state is needed
+                persist_worker.submit(
+                    save_checkpoint,
+                    checkpoint_path,
+                    new_checkpoint(config, _nb + 1),
+                    key='checkpoint',
+                )
+            _dp1.clear_output(wait=True)
+
+            if stop_event.is_set():
+                logger.debug('stop_event is set, skipping the while `n_batches`')
+                stop_event.clear()
+                break
+    finally:
+        # the results are always backed up in the end, also when the run is interrupted
+        persist_worker.flush_backup(_da, args.name_docarray, **cloud_backup)
+        persist_worker.close()
 
     logger.info(f'done! {args.name_docarray}')
 
     return da_batches
 
 
+def _get_prompt_embeds(
+    clip_model, model_name: str, prompts, args, text_device, text_embeds_cache
+) -> 'torch.Tensor':
+    """
+    Return the text embeddings of `prompts` on `text_device`, cached embeddings are cast to the text tower's dtype.
+
+    The text tower is only made resident when some prompt is not in the cache.
+    """
+    dtype = get_text_dtype(clip_model)
+    placement = f'{text_device.type}-{dtype}'
+    prompt_embeds = [
+        text_embeds_cache.get(
+            model_name, _p.tokenized, args.truncate_overlength_prompt, placement
+        )
+        if text_embeds_cache
+        else None
+        for _p in prompts
+    ]
+
+    if any(txt is None for txt in prompt_embeds):
+        # the text tower may have been offloaded or released by an earlier run
+        load_text_tower(clip_model, model_name, text_device)
+
+    for j, (_p, txt) in enumerate(zip(prompts, prompt_embeds)):
+        if txt is None:
+            txt = clip_model.encode_text(
+                clip.tokenize(
+                    _p.tokenized, truncate=args.truncate_overlength_prompt
+                ).to(text_device)
+            )
+            if text_embeds_cache:
+                text_embeds_cache.put(
+                    model_name,
+                    _p.tokenized,
+                    args.truncate_overlength_prompt,
+                    placement,
+                    txt.detach().cpu().numpy(),
+                )
+        else:
+            txt = torch.from_numpy(np.array(txt)).to(text_device, dtype=dtype)
+        prompt_embeds[j] = txt
+    return torch.cat(prompt_embeds)
+
+
+def _get_guidance_mask(schedule_table, prompts, model_stats) -> 'np.ndarray':
+    """
+    Return a boolean mask over all diffusion steps, true where a CLIP, tv, range or sat loss is active.
+
+    The init loss is not included, as it depends on the init image of each batch.
+    """
+    clip_mask = np.zeros(len(schedule_table), dtype=bool)
+    for model_stat in model_stats:
+        clip_mask |= model_stat['schedules'].to_array(
+            dtype=bool
+        ) & prompts.get_active_steps(model_stat['model_name'])
+
+    mask = clip_mask & (schedule_table.column('clip_guidance_scale') != 0)
+    for k in ('tv_scale', 'range_scale', 'sat_scale'):
+        mask |= schedule_table.column(k) != 0
+    return mask
+
+
+def _load_resumed_results(output_dir: str, checkpoint: Dict, args):
+    """
+    Load the results of the run that `checkpoint` belongs to.
+
+    :return: the documents of the finished batches, and the documents of the batch to resume, without the
+        intermediate results after the checkpoint. The latter is None if the checkpoint is taken between batches.
+    """
+    results = load_results(output_dir) or DocumentArray()
+    doc_ids = checkpoint.get('doc_ids') or []
+    finished_da = DocumentArray(d for d in results if d.id not in doc_ids)
+    if checkpoint['step'] is None:
+        return finished_da, None
+
+    resumed_da = DocumentArray()
+    for doc_id in doc_ids:
+        if doc_id in results:
+            d = results[doc_id]
+            d.chunks = DocumentArray(
+                c for c in d.chunks if c.tags['_status']['step'] <= checkpoint['step']
+            )
+        else:
+            # the checkpoint is taken before the batch is first saved
+            d = Document(id=doc_id, tags=copy.deepcopy(vars(args)))
+        resumed_da.append(d)
+    return finished_da, resumed_da
+
+
+def _restore_progress(progress: 'ProgressWriter', da: 'DocumentArray') -> None:
+    """Add the intermediate results of a resumed batch to its progress sprites, the GIFs restart from here."""
+    for k, d in enumerate(da):
+        for c in d.chunks:
+            if c.uri:
+                _c = Document(uri=c.uri).load_uri_to_image_tensor()
+            elif c.blob:
+                _c = Document(blob=c.blob).convert_blob_to_image_tensor()
+            else:
+                _c = Document(tensor=c.tensor)
+            progress.append_tile(k, Image.fromarray(_c.tensor))
+
+
 def redraw_widget(_handlers, _redraw_fn, args, _nb):
     _handlers.progress.max = args.n_batches
     _handlers.progress.value = _nb + 1
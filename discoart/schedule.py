@@ -0,0 +1,304 @@
+import ast
+import bisect
+import operator
+import re
+from types import SimpleNamespace
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+
+_MAX_DIFFUSION_STEPS = 1000
+
+_SCHEDULE_KEYS = (
+    'cut_overview',
+    'cut_innercut',
+    'cut_icgray_p',
+    'cut_ic_pow',
+    'use_secondary_model',
+    'cutn_batches',
+    'clip_guidance_scale',
+    'tv_scale',
+    'range_scale',
+    'sat_scale',
+    'init_scale',
+    'clamp_grad',
+    'clamp_max',
+)
+
+_SCALAR_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+}
+
+Segments = List[Tuple[Any, int]]
+
+
+def _is_valid_schedule_str(val) -> bool:
+    r = re.match(r'(False\b|True\b|[\(\)\[\]0-9\, \.\*\+\-])+', val)
+    if r and r.group(0) == val:
+        return True
+    return False
+
+
+def _is_scalar(val) -> bool:
+    return isinstance(val, (int, float, bool))
+
+
+def _to_python(val):
+    # numpy scalars are converted so that the original Python type is kept in the segments
+    return val.item() if hasattr(val, 'item') else val
+
+
+def _same(a, b) -> bool:
+    # `True == 1` in Python, but a schedule must keep the type of its values
+    return type(a) is type(b) and a == b
+
+
+def _format_value(val) -> str:
+    s = repr(val)
+    if isinstance(val, float) and 'e' in s:
+        # the scientific notation is not a valid scheduling string, the positional one keeps all digits of `repr`
+        s = np.format_float_positional(val, trim='.')
+    return s
+
+
+def _merge(segments: Segments) -> Segments:
+    merged = []
+    for v, n in segments:
+        if n <= 0:
+            continue
+        if merged and _same(merged[-1][0], v):
+            merged[-1] = (v, merged[-1][1] + n)
+        else:
+            merged.append((v, n))
+    return merged
+
+
+def _repeat(segments: Segments, times) -> Segments:
+    if isinstance(times, float):
+        raise ValueError(f'can not multiply a schedule by non-int {times}')
+    if sum(n for _, n in segments) * times > _MAX_DIFFUSION_STEPS:
+        raise ValueError(
+            f'invalid scheduling string: the schedule steps should be exactly {_MAX_DIFFUSION_STEPS}'
+        )
+    if len(segments) == 1:
+        return _merge([(segments[0][0], segments[0][1] * times)])
+    return _merge(segments * times)
+
+
+def _compile_node(node) -> Union[int, float, bool, Segments]:
+    """Evaluate the AST of a schedule string into either a scalar or run-length segments, without expanding them."""
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body)
+    if isinstance(node, ast.Constant) and _is_scalar(node.value):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        v = _compile_node(node.operand)
+        if _is_scalar(v):
+            return -v if isinstance(node.op, ast.USub) else +v
+    elif isinstance(node, (ast.List, ast.Tuple)):
+        values = [_compile_node(v) for v in node.elts]
+        if all(_is_scalar(v) for v in values):
+            return _merge([(v, 1) for v in values])
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        # long `+` chains are unrolled iteratively to avoid hitting the recursion limit
+        operands = []
+        while isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            operands.append(node.right)
+            node = node.left
+        operands.append(node)
+        values = [_compile_node(v) for v in reversed(operands)]
+        if all(_is_scalar(v) for v in values):
+            return sum(values)
+        if not any(_is_scalar(v) for v in values):
+            return _merge([seg for v in values for seg in v])
+    elif isinstance(node, ast.BinOp) and type(node.op) in _SCALAR_OPS:
+        left, right = _compile_node(node.left), _compile_node(node.right)
+        if _is_scalar(left) and _is_scalar(right):
+            return _SCALAR_OPS[type(node.op)](left, right)
+        if isinstance(node.op, ast.Mult):
+            if _is_scalar(left) and not _is_scalar(right):
+                return _repeat(right, left)
+            if _is_scalar(right) and not _is_scalar(left):
+                return _repeat(left, right)
+    raise ValueError(f'unsupported expression in scheduling string: {ast.dump(node)}')
+
+
+class Schedule:
+    """
+    A compiled schedule of :data:`_MAX_DIFFUSION_STEPS` values, stored as run-length segments of ``(value, length)``.
+
+    Use :func:`compile_schedule` to build it from a scheduling string such as ``[12]*400+[4]*600``.
+    """
+
+    def __init__(self, segments: Segments):
+        self.segments = segments
+        self._ends = list(np.cumsum([n for _, n in segments]))
+
+    def __len__(self):
+        return int(self._ends[-1]) if self._ends else 0
+
+    def __getitem__(self, t: int):
+        if not 0 <= t < len(self):
+            raise IndexError(f'schedule index {t} is out of range')
+        return self.segments[bisect.bisect_right(self._ends, t)][0]
+
+    def __iter__(self):
+        for v, n in self.segments:
+            for _ in range(n):
+                yield v
+
+    def __eq__(self, other):
+        if isinstance(other, Schedule):
+            return len(self.segments) == len(other.segments) and all(
+                _same(a[0], b[0]) and a[1] == b[1]
+                for a, b in zip(self.segments, other.segments)
+            )
+        return NotImplemented
+
+    def __repr__(self):
+        return f'Schedule({self})'
+
+    def __str__(self):
+        segments = self.segments
+        times = 1
+        for period in range(1, len(segments) // 2 + 1):
+            if len(segments) % period == 0 and all(
+                _same(a[0], b[0]) and a[1] == b[1]
+                for a, b in zip(segments, segments[period:])
+            ):
+                segments, times = segments[:period], len(segments) // period
+                break
+
+        terms = []
+        singles = []
+        for v, n in segments + [(None, 0)]:
+            if n == 1:
+                singles.append(_format_value(v))
+                continue
+            if singles:
+                terms.append(f'[{", ".join(singles)}]')
+                singles = []
+            if n > 1:
+                terms.append(f'[{_format_value(v)}]*{n}')
+
+        s = '+'.join(terms)
+        return f'({s})*{times}' if times > 1 else s
+
+    def any(self) -> bool:
+        return any(bool(v) for v, _ in self.segments)
+
+    def to_list(self) -> List:
+        return list(self)
+
+    def to_array(self, dtype=np.float64) -> 'np.ndarray':
+        return np.repeat(
+            np.array([v for v, _ in self.segments], dtype=dtype),
+            [n for _, n in self.segments],
+        )
+
+
+def compile_schedule(val) -> Schedule:
+    """
+    Compile a scheduling value into a :class:`Schedule`.
+
+    :param val: a scheduling string, e.g. `[12]*400+[4]*600`, a scalar or a list of values
+    :return: the compiled schedule of exactly :data:`_MAX_DIFFUSION_STEPS` steps
+    """
+    if isinstance(val, Schedule):
+        return val
+
+    if isinstance(val, str):
+        if not _is_valid_schedule_str(val):
+            raise ValueError(
+                f'invalid scheduling string: {val}, it contains unsafe code'
+            )
+        try:
+            val = _compile_node(ast.parse(val.strip(), mode='eval'))
+        except SyntaxError as ex:
+            raise ValueError(f'invalid scheduling string: {val}, {ex}') from ex
+    elif isinstance(val, (list, tuple)):
+        val = _merge([(_to_python(v), 1) for v in val])
+    else:
+        val = _to_python(val)
+
+    if _is_scalar(val):
+        return Schedule([(val, _MAX_DIFFUSION_STEPS)])
+    elif isinstance(val, list):
+        schedule = Schedule(val)
+        if len(schedule) != _MAX_DIFFUSION_STEPS:
+            raise ValueError(
+                f'invalid scheduling string: {val} the schedule steps should be exactly {_MAX_DIFFUSION_STEPS}'
+            )
+        return schedule
+    raise ValueError(f'unsupported scheduling type: {val}: {type(val)}')
+
+
+def _get_cast_fn(schedule: Schedule):
+    values = [v for v, _ in schedule.segments]
+    if all(isinstance(v, (bool, np.bool_)) for v in values):
+        return bool
+    elif all(isinstance(v, (int, np.integer)) for v in values):
+        return int
+    return float
+
+
+class ScheduleTable:
+    """
+    A lookup table of all scheduled arguments over all diffusion steps.
+
+    The values are kept in a ``[_MAX_DIFFUSION_STEPS, len(keys)]`` NumPy array. Identical rows share the same
+    :class:`SimpleNamespace`, so looking up the schedule of a step is a single row index.
+    """
+
+    def __init__(self, schedules: Dict[str, Schedule]):
+        self.schedules = schedules
+        self.keys = list(schedules.keys())
+        self.table = np.stack([s.to_array() for s in schedules.values()], axis=1)
+
+        cast_fns = [_get_cast_fn(s) for s in schedules.values()]
+        _, first_idx, row_ids = np.unique(
+            self.table, axis=0, return_index=True, return_inverse=True
+        )
+        self._row_ids = row_ids.reshape(-1)
+        self._rows = [
+            SimpleNamespace(
+                **{
+                    k: fn(self.table[r, j])
+                    for j, (k, fn) in enumerate(zip(self.keys, cast_fns))
+                }
+            )
+            for r in first_idx
+        ]
+
+    @classmethod
+    def from_args(cls, args) -> 'ScheduleTable':
+        return cls({k: compile_schedule(getattr(args, k)) for k in _SCHEDULE_KEYS})
+
+    def __len__(self):
+        return self.table.shape[0]
+
+    def __getitem__(self, t: int) -> 'SimpleNamespace':
+        return self._rows[self._row_ids[t]]
+
+    def column(self, key: str) -> 'np.ndarray':
+        return self.table[:, self.keys.index(key)]
+
+    def to_dict(self) -> Dict[str, str]:
+        return {k: str(s) for k, s in self.schedules.items()}
+
+
+def compact_schedule(val):
+    """
+    Return the compact scheduling string of a list-valued schedule, so that it is not stored as an expanded list.
+
+    Any other value is returned as is.
+    """
+    if isinstance(val, (list, tuple)) and len(val) > 1:
+        try:
+            return str(compile_schedule(val))
+        except ValueError:
+            pass
+    return val
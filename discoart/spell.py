@@ -0,0 +1,269 @@
+import hashlib
+import os
+import string
+import unicodedata
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from . import __resources_path__
+from .helper import cache_dir, logger
+
+# the version of the index files, bump it when their layout changes
+_INDEX_VERSION = 1
+
+
+def _get_deletes(word: str, max_distance: int) -> Set[str]:
+    deletes = {word}
+    edits = {word}
+    for _ in range(max_distance):
+        edits = {w[:i] + w[i + 1 :] for w in edits for i in range(len(w))}
+        deletes |= edits
+    return deletes
+
+
+def _get_hash(word: str) -> int:
+    return zlib.crc32(word.encode('utf-8'))
+
+
+def _remove_diacritics(word: str) -> str:
+    return ''.join(
+        c for c in unicodedata.normalize('NFKD', word) if not unicodedata.combining(c)
+    )
+
+
+def damerau_levenshtein(a: str, b: str) -> int:
+    """The Damerau-Levenshtein distance, i.e. the fewest inserts, deletes, replaces and adjacent swaps from `a` to `b`."""
+    # the common prefix and suffix do not change the distance
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < min(len(a), len(b)) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start : len(a) - end], b[start : len(b) - end]
+    if not a or not b:
+        return len(a) + len(b)
+
+    inf = len(a) + len(b)
+    last_row = {}
+    d = [[inf] * (len(b) + 2)]
+    d += [[inf, *range(len(b) + 1)]]
+    d += [[inf, i] + [0] * len(b) for i in range(1, len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        last_col = 0
+        for j in range(1, len(b) + 1):
+            k = last_row.get(b[j - 1], 0)
+            l = last_col
+            cost = 1
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+                last_col = j
+            d[i + 1][j + 1] = min(
+                d[i][j] + cost,
+                d[i + 1][j] + 1,
+                d[i][j + 1] + 1,
+                d[k][l] + (i - k - 1) + 1 + (j - l - 1),
+            )
+        last_row[a[i - 1]] = i
+    return d[len(a) + 1][len(b) + 1]
+
+
+class SymSpell:
+    """
+    A spell checker over a word frequency list, with the same results as :class:`spellchecker.SpellChecker`.
+
+    Instead of generating all edits of an unknown word, it looks up the deletes of the word in a symmetric-delete
+    index, i.e. the deletes of the first ``prefix_length`` letters of every known word within ``max_distance``. The
+    index is kept as sorted CRC32 hashes of the deletes in NumPy arrays, which are saved to ``root`` and memory-mapped
+    by later processes.
+    """
+
+    def __init__(
+        self,
+        words: List[str],
+        freqs: 'np.ndarray',
+        keys: 'np.ndarray',
+        word_ids: 'np.ndarray',
+        max_distance: int = 2,
+        prefix_length: int = 7,
+    ):
+        self.words = words
+        self.freqs = freqs
+        self.keys = keys
+        self.word_ids = word_ids
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self._word_to_id = {w: j for j, w in enumerate(words)}
+        self._longest_word_length = max(len(w) for w in words)
+
+    @classmethod
+    def build(
+        cls, word_freqs: Dict[str, int], max_distance: int = 2, prefix_length: int = 7
+    ) -> 'SymSpell':
+        words = sorted(word_freqs)
+        keys, word_ids = [], []
+        for j, w in enumerate(words):
+            for d in _get_deletes(w[:prefix_length], max_distance):
+                keys.append(_get_hash(d))
+                word_ids.append(j)
+        keys = np.array(keys, dtype=np.uint32)
+        order = np.argsort(keys, kind='stable')
+        return cls(
+            words,
+            np.array([word_freqs[w] for w in words], dtype=np.int64),
+            keys[order],
+            np.array(word_ids, dtype=np.int32)[order],
+            max_distance,
+            prefix_length,
+        )
+
+    def save(self, root: str) -> None:
+        Path(root).mkdir(parents=True, exist_ok=True)
+        # the words file is written last, so that a complete index is found by its presence
+        for name, arr in (
+            ('freqs', self.freqs),
+            ('keys', self.keys),
+            ('word_ids', self.word_ids),
+        ):
+            tmp_path = os.path.join(root, f'{name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as fp:
+                np.save(fp, arr)
+            os.replace(tmp_path, os.path.join(root, f'{name}.npy'))
+
+        tmp_path = os.path.join(root, f'words.{os.getpid()}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            fp.write('\n'.join(self.words))
+        os.replace(tmp_path, os.path.join(root, 'words.txt'))
+
+    @classmethod
+    def load(
+        cls, root: str, max_distance: int = 2, prefix_length: int = 7
+    ) -> 'SymSpell':
+        with open(os.path.join(root, 'words.txt'), encoding='utf-8') as fp:
+            words = fp.read().split('\n')
+        return cls(
+            words,
+            *(
+                np.load(os.path.join(root, f'{name}.npy'), mmap_mode='r')
+                for name in ('freqs', 'keys', 'word_ids')
+            ),
+            max_distance,
+            prefix_length,
+        )
+
+    def __contains__(self, word: str) -> bool:
+        return word in self._word_to_id
+
+    def _should_check(self, word: str) -> bool:
+        if len(word) == 1 and word in string.punctuation:
+            return False
+        if len(word) > self._longest_word_length + 3:
+            return False
+        if word.lower() in ('nan', 'inf', 'infinity'):
+            return True
+        try:
+            float(word)
+            return False
+        except ValueError:
+            return True
+
+    def unknown(self, words: Iterable[str]) -> Set[str]:
+        """Return the words that are not known, as :meth:`spellchecker.SpellChecker.unknown`."""
+        return {
+            w.lower()
+            for w in words
+            if self._should_check(w) and w.lower() not in self._word_to_id
+        }
+
+    def candidates(self, word: str) -> Optional[Set[str]]:
+        """Return the known words with the smallest edit distance to `word` up to `max_distance`, or None."""
+        if word in self._word_to_id or not self._should_check(word):
+            return {word}
+
+        hashes = np.array(
+            [
+                _get_hash(d)
+                for d in _get_deletes(word[: self.prefix_length], self.max_distance)
+            ],
+            dtype=self.keys.dtype,
+        )
+        word_ids = set()
+        for start, end in zip(
+            np.searchsorted(self.keys, hashes, 'left'),
+            np.searchsorted(self.keys, hashes, 'right'),
+        ):
+            word_ids.update(self.word_ids[start:end].tolist())
+
+        by_distance = {}
+        for j in word_ids:
+            w = self.words[j]
+            if abs(len(w) - len(word)) > self.max_distance:
+                continue
+            distance = damerau_levenshtein(word, w)
+            if distance <= self.max_distance:
+                by_distance.setdefault(distance, set()).add(w)
+        return by_distance[min(by_distance)] if by_distance else None
+
+    def correction(self, word: str) -> Optional[str]:
+        """Return the most frequent candidate of `word`, as :meth:`spellchecker.SpellChecker.correction`."""
+        candidates = self.candidates(word)
+        if not candidates:
+            return None
+        # prefer exact matches with incorrect diacritics
+        word_no_accents = _remove_diacritics(word)
+        candidates = [
+            c for c in candidates if _remove_diacritics(c) == word_no_accents
+        ] or candidates
+        return max(
+            candidates,
+            key=lambda c: (
+                self.freqs[self._word_to_id[c]] if c in self._word_to_id else 0,
+                c,
+            ),
+        )
+
+
+def _get_word_freqs() -> Dict[str, int]:
+    from spellchecker import SpellChecker
+
+    spell = SpellChecker()
+    with open(os.path.join(__resources_path__, 'vocab.txt'), encoding='utf-8') as fp:
+        spell.word_frequency.load_words(
+            line.strip() for line in fp if len(line.strip()) > 1
+        )
+    return dict(spell.word_frequency.dictionary)
+
+
+def _get_index_root() -> str:
+    import spellchecker
+
+    sha = hashlib.sha256(
+        f'{_INDEX_VERSION}\n{getattr(spellchecker, "__version__", "")}\n'.encode()
+    )
+    with open(os.path.join(__resources_path__, 'vocab.txt'), 'rb') as fp:
+        sha.update(fp.read())
+    return os.path.join(cache_dir, 'symspell', sha.hexdigest()[:16])
+
+
+def load_spell_index() -> SymSpell:
+    """
+    Return the spell checker over the English dictionary and `resources/vocab.txt`.
+
+    Its index is built on the first call and saved into the cache dir, later processes memory-map it.
+    """
+    root = _get_index_root()
+    try:
+        return SymSpell.load(root)
+    except (OSError, ValueError):
+        pass
+
+    logger.debug(f'building the spell checking index into {root}...')
+    spell = SymSpell.build(_get_word_freqs())
+    try:
+        spell.save(root)
+    except OSError as ex:
+        logger.debug(f'can not save the spell checking index: {ex}')
+    return spell
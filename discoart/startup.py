@@ -0,0 +1,79 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .helper import (
+    load_clip_models,
+    load_diffusion_model,
+    load_secondary_model,
+    logger,
+)
+
+
+def _timed(timings: Dict[str, float], name: str, fn: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def prepare_run(
+    args, device, max_workers: Optional[int] = None
+) -> Tuple[Tuple[Any, Any, Dict[str, Any], Any], 'PromptPlanner', Dict[str, float]]:
+    """
+    Load all models of a run and parse its prompts concurrently on a thread pool.
+
+    Each CLIP model, the diffusion model, the secondary model and the prompts are a separate job, so downloading,
+    SHA checks, reading the checkpoints and deserializing the state dicts overlap. Models already in the model cache
+    are returned at once.
+
+    :param args: the config of the run
+    :param device: the device of the models
+    :param max_workers: the number of threads, defaults to one per job
+    :return: the models as expected by `do_run`, the prompts, and the time of each job and of the whole startup in
+        seconds
+    """
+    from .prompt import PromptPlanner
+
+    timings = {}
+    start = time.perf_counter()
+    jobs = {
+        'diffusion': (load_diffusion_model, args, device),
+        'secondary': (load_secondary_model, args, device),
+        'prompts': (PromptPlanner, args),
+        **{
+            f'clip {k}': (
+                load_clip_models,
+                device,
+                [k],
+                args.text_clip_on_cpu,
+            )
+            for k in args.clip_models
+        },
+    }
+    with ThreadPoolExecutor(max_workers=max_workers or len(jobs)) as executor:
+        futures = {
+            name: executor.submit(_timed, timings, name, *job)
+            for name, job in jobs.items()
+        }
+        results = {name: f.result() for name, f in futures.items()}
+    timings['total'] = time.perf_counter() - start
+
+    logger.info(
+        f'startup took {timings["total"]:.2f}s: '
+        + ', '.join(
+            f'{name} {timings[name]:.2f}s'
+            for name in sorted(jobs, key=timings.get, reverse=True)
+        )
+    )
+
+    model, diffusion = results['diffusion']
+    clip_models = {}
+    for k in args.clip_models:
+        clip_models.update(results[f'clip {k}'])
+    return (
+        (model, diffusion, clip_models, results['secondary']),
+        results['prompts'],
+        timings,
+    )
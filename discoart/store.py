@@ -0,0 +1,137 @@
+import glob
+import os
+from typing import Dict, Optional
+
+from docarray import DocumentArray
+
+from .frames import to_datauri_document
+from .helper import logger
+
+_SNAPSHOT_NAME = 'da.protobuf.lz4'
+_SEGMENTS_DIR = 'da.segments'
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+
+
+def _merge_into(da: DocumentArray, delta: DocumentArray) -> None:
+    for d in delta:
+        if d.id not in da:
+            da.append(d)
+            continue
+        root = da[d.id]
+        root.tags = d.tags
+        root.uri = d.uri
+        # merging is idempotent, a segment may be merged again if a compaction was interrupted
+        chunk_ids = set(root.chunks[:, 'id'])
+        root.chunks.extend(c for c in d.chunks if c.id not in chunk_ids)
+
+
+class ResultStore:
+    """
+    An append-only local store of the results of a run.
+
+    Every :meth:`append` writes one segment into `da.segments/` that only contains the chunks added since the last
+    append, together with the latest `tags` and `uri` of the root documents. Once the segments outgrow the snapshot
+    `da.protobuf.lz4`, they are compacted into it. All files are written atomically. Use :func:`load_results` to read
+    the store back into a :class:`DocumentArray`.
+    """
+
+    def __init__(self, output_dir: str, min_segments_to_compact: int = 8):
+        self.output_dir = output_dir
+        self.min_segments_to_compact = min_segments_to_compact
+        self._snapshot_path = os.path.join(output_dir, _SNAPSHOT_NAME)
+        self._segments_dir = os.path.join(output_dir, _SEGMENTS_DIR)
+        self._num_written_chunks: Dict[str, int] = {}
+        self._next_segment = 0
+        self._is_reset = False
+
+    def append(self, da_batches: DocumentArray) -> None:
+        if not self._is_reset:
+            # a new run overwrites the results of a previous run with the same name
+            self._remove_segments()
+            if os.path.exists(self._snapshot_path):
+                os.remove(self._snapshot_path)
+            os.makedirs(self._segments_dir, exist_ok=True)
+            self._is_reset = True
+
+        delta = DocumentArray()
+        for d in da_batches:
+            num_chunks = len(d.chunks)
+            delta.append(
+                to_datauri_document(
+                    d, d.chunks[self._num_written_chunks.get(d.id, 0) : num_chunks]
+                )
+            )
+            self._num_written_chunks[d.id] = num_chunks
+
+        _write_atomic(
+            os.path.join(self._segments_dir, f'{self._next_segment:08d}.protobuf.lz4'),
+            delta.to_bytes(protocol='protobuf', compress='lz4'),
+        )
+        self._next_segment += 1
+        logger.debug(f'local backup segment {self._next_segment} to {self.output_dir}')
+
+        segments = self._list_segments()
+        snapshot_size = (
+            os.path.getsize(self._snapshot_path)
+            if os.path.exists(self._snapshot_path)
+            else 0
+        )
+        if (
+            len(segments) >= self.min_segments_to_compact
+            and sum(os.path.getsize(f) for f in segments) >= snapshot_size
+        ):
+            self.compact()
+
+    def compact(self) -> None:
+        """Merge all segments into the snapshot `da.protobuf.lz4` and remove them."""
+        segments = self._list_segments()
+        if not segments:
+            return
+        da = load_results(self.output_dir)
+        _write_atomic(
+            self._snapshot_path, da.to_bytes(protocol='protobuf', compress='lz4')
+        )
+        for f in segments:
+            os.remove(f)
+        logger.debug(f'compacted {len(segments)} segments into {self._snapshot_path}')
+
+    def _list_segments(self):
+        return sorted(glob.glob(os.path.join(self._segments_dir, '*.protobuf.lz4')))
+
+    def _remove_segments(self):
+        for f in self._list_segments():
+            os.remove(f)
+
+
+def load_results(output_dir: str) -> Optional[DocumentArray]:
+    """
+    Load the results stored by :class:`ResultStore`, i.e. the snapshot with all segments merged into it.
+
+    :param output_dir: the output directory of the run
+    :return: the results, or None if nothing is stored yet
+    """
+    snapshot_path = os.path.join(output_dir, _SNAPSHOT_NAME)
+    segments = sorted(
+        glob.glob(os.path.join(output_dir, _SEGMENTS_DIR, '*.protobuf.lz4'))
+    )
+    if not segments and not os.path.exists(snapshot_path):
+        return None
+
+    da = (
+        DocumentArray.load_binary(snapshot_path)
+        if os.path.exists(snapshot_path)
+        else DocumentArray()
+    )
+    for f in segments:
+        try:
+            _merge_into(da, DocumentArray.load_binary(f))
+        except FileNotFoundError:
+            # the segment is removed by a concurrent compaction, which merged it into the snapshot
+            return load_results(output_dir)
+    return da
@@ -0,0 +1,184 @@
+import os
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import torch
+import wandb
+
+from .helper import logger
+
+_LOSS_NAMES = ('total', 'tv', 'range', 'sat', 'init', 'cuts')
+
+
+def is_wandb_enabled() -> bool:
+    return os.environ.get('WANDB_MODE', 'disabled') != 'disabled'
+
+
+class StepTelemetry:
+    """
+    The telemetry of one batch in preallocated NumPy arrays.
+
+    It holds the diffusion step, the losses and the NaN flag of every `cond_fn` call, and the wall time of every
+    sampling step. Only a summary goes into the tags of the results, the full arrays are saved as a compressed
+    `.npz` file from a :meth:`snapshot`.
+    """
+
+    def __init__(self, num_steps: int):
+        # PLMS evaluates `cond_fn` twice at its first step
+        capacity = num_steps + 1
+        self.steps = np.zeros(capacity, dtype=np.int32)
+        self.losses = np.zeros([capacity, len(_LOSS_NAMES)], dtype=np.float32)
+        self.is_nan = np.zeros(capacity, dtype=bool)
+        self.step_times = np.zeros(num_steps, dtype=np.float32)
+        self._num_rows = 0
+        self._num_timed = 0
+
+    def append(self, num_step: int, losses: List[float], is_nan: bool) -> None:
+        if self._num_rows == len(self.steps):
+            self.steps = np.resize(self.steps, 2 * len(self.steps))
+            self.losses = np.resize(
+                self.losses, [2 * len(self.losses), len(_LOSS_NAMES)]
+            )
+            self.is_nan = np.resize(self.is_nan, 2 * len(self.is_nan))
+        self.steps[self._num_rows] = num_step
+        self.losses[self._num_rows] = losses
+        self.is_nan[self._num_rows] = is_nan
+        self._num_rows += 1
+
+    def add_step_time(self, seconds: float) -> None:
+        if self._num_timed == len(self.step_times):
+            self.step_times = np.resize(self.step_times, 2 * len(self.step_times) + 1)
+        self.step_times[self._num_timed] = seconds
+        self._num_timed += 1
+
+    def restore(self, arrays: Dict[str, 'np.ndarray']) -> None:
+        """Continue from the arrays of a :meth:`snapshot`, e.g. of a checkpoint."""
+        for num_step, losses, is_nan in zip(
+            arrays['step'], arrays['loss'], arrays['is_nan']
+        ):
+            self.append(int(num_step), losses, bool(is_nan))
+        for seconds in arrays['step_time']:
+            self.add_step_time(float(seconds))
+
+    @property
+    def latest_loss(self) -> Optional[float]:
+        """The total loss of the latest `cond_fn` call, None if there is none yet."""
+        return float(self.losses[self._num_rows - 1, 0]) if self._num_rows else None
+
+    def summary(self) -> Dict:
+        return {
+            'loss': self.latest_loss,
+            'num_nan': int(self.is_nan[: self._num_rows].sum()),
+        }
+
+    def snapshot(self, schedule_table=None) -> Dict[str, 'np.ndarray']:
+        """
+        Return a copy of the recorded arrays, which can be saved by `numpy.savez_compressed`.
+
+        :param schedule_table: if given, the scheduled arguments of the recorded steps are added as `scheduler`,
+            with their names in `scheduler_keys`
+        """
+        n = self._num_rows
+        arrays = {
+            'step': self.steps[:n].copy(),
+            'loss': self.losses[:n].copy(),
+            'loss_names': np.array(_LOSS_NAMES),
+            'is_nan': self.is_nan[:n].copy(),
+            'step_time': self.step_times[: self._num_timed].copy(),
+        }
+        if schedule_table is not None:
+            arrays['scheduler'] = schedule_table.table[arrays['step']]
+            arrays['scheduler_keys'] = np.array(schedule_table.keys)
+        return arrays
+
+
+class LossTracker:
+    """
+    Track the losses of `cond_fn` without synchronizing the device at every step.
+
+    The losses and the NaN flag of each step are written into a preallocated device buffer, which is copied to the
+    host in one go by :meth:`flush`, e.g. at the save and display steps, into the :class:`StepTelemetry` of the
+    current batch. When W&B is enabled, every step is flushed right away, as logging the gradient histogram needs the
+    gradient on the host anyway.
+    """
+
+    def __init__(self, device, capacity: int = 64, log_to_wandb: bool = False):
+        self.device = device
+        self.log_to_wandb = log_to_wandb
+        # the last column is the NaN flag of the gradient
+        self._buffer = torch.zeros([capacity, len(_LOSS_NAMES) + 1], device=device)
+        self._steps = []
+        self._schedulers = []
+        self.telemetry = StepTelemetry(0)
+
+    def start_batch(self, num_steps: int) -> StepTelemetry:
+        """Flush the steps of the previous batch and start recording into a new :class:`StepTelemetry`."""
+        self.flush()
+        self.telemetry = StepTelemetry(num_steps)
+        return self.telemetry
+
+    def record(
+        self,
+        num_step: int,
+        losses: Dict[str, Union[int, float, 'torch.Tensor']],
+        is_nan: 'torch.Tensor',
+        scheduler: Optional[Dict] = None,
+        grad: Optional['torch.Tensor'] = None,
+    ) -> None:
+        """
+        Record the losses of a diffusion step, all tensors stay on the device.
+
+        :param num_step: the diffusion step
+        :param losses: the loss terms, keyed by the names in `_LOSS_NAMES`
+        :param is_nan: a boolean scalar tensor, whether the gradient of this step is NaN
+        :param scheduler: the scheduled arguments of this step, only used for W&B
+        :param grad: the gradient of this step, only used for W&B
+        """
+        row = len(self._steps)
+        if row == self._buffer.shape[0]:
+            self._buffer = torch.cat([self._buffer, torch.zeros_like(self._buffer)])
+
+        for j, name in enumerate(_LOSS_NAMES):
+            v = losses.get(name, 0)
+            self._buffer[row, j] = v.detach() if torch.is_tensor(v) else float(v)
+        self._buffer[row, -1] = is_nan
+
+        self._steps.append(num_step)
+        self._schedulers.append(scheduler)
+
+        if self.log_to_wandb:
+            self.flush(grad)
+
+    def flush(self, grad: Optional['torch.Tensor'] = None) -> None:
+        """Copy the recorded losses to the host, into :attr:`telemetry`."""
+        if not self._steps:
+            return
+
+        rows = self._buffer[: len(self._steps)].cpu().tolist()
+        for num_step, scheduler, row in zip(self._steps, self._schedulers, rows):
+            if row[-1]:
+                logger.warning(
+                    f'NaN detected in grad at the diffusion inner-step {num_step}, no panic. '
+                    f'However, if this message continues to show up *in a row*, '
+                    f'then your generation is ill-conditioned and image will not updated, further steps are unnecessary.'
+                )
+            self.telemetry.append(num_step, row[:-1], bool(row[-1]))
+
+            if self.log_to_wandb:
+                traced_info = {
+                    f'losses/{name}': v for name, v in zip(_LOSS_NAMES, row[:-1])
+                }
+                traced_info.update(
+                    {
+                        f'scheduler/{k}': int(v) if isinstance(v, bool) else v
+                        for k, v in (scheduler or {}).items()
+                    }
+                )
+                if grad is not None and not row[-1]:
+                    traced_info['gradients'] = wandb.Histogram(
+                        grad.detach().cpu().numpy()
+                    )
+                wandb.log(traced_info)
+
+        self._steps.clear()
+        self._schedulers.clear()
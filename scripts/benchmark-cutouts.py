@@ -0,0 +1,62 @@
+"""
+CPU microbenchmark of `MakeCutouts`, comparing the per-cut torchvision augmentation against the batched augmentation.
+
+    python scripts/benchmark-cutouts.py --cuts 16 --batch-size 1 --repeat 10
+"""
+import argparse
+import time
+
+import torch
+
+from discoart.nn.make_cutouts import MakeCutouts
+
+
+def _bench(fn, x, repeat):
+    torch.manual_seed(0)
+    outputs = [fn(x)]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        outputs.append(fn(x))
+    return (time.perf_counter() - start) / repeat, torch.cat(outputs)
+
+
+def _augment_only(cuts):
+    if cuts.batched_augment:
+        return cuts._augment_batch
+    return lambda c: torch.cat([cuts.augment(v) for v in c])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cuts', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--cut-size', type=int, default=224)
+    parser.add_argument('--side', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    x = torch.rand(args.batch_size, 3, args.side, args.side)
+    results, aug_results = {}, {}
+    for batched in (False, True):
+        cuts = MakeCutouts(
+            args.cut_size,
+            Overview=args.cuts // 2,
+            InnerCrop=args.cuts - args.cuts // 2,
+            batched_augment=batched,
+        )
+        results[batched] = _bench(cuts, x, args.repeat)
+        aug_results[batched] = _bench(
+            _augment_only(cuts), list(cuts._cut_generator(x)), args.repeat
+        )
+
+    for batched, (secs, out) in results.items():
+        print(
+            f'{"batched" if batched else "per-cut"}: {secs * 1000:.1f} ms/call '
+            f'({aug_results[batched][0] * 1000:.1f} ms augmentation), '
+            f'output mean {out.mean():.4f} std {out.std():.4f}'
+        )
+    print(
+        f'speedup: {results[False][0] / results[True][0]:.2f}x '
+        f'({aug_results[False][0] / aug_results[True][0]:.2f}x augmentation)'
+    )
@@ -10,13 +10,16 @@ with open('../discoart/resources/docstrings.yml') as ymlfile:
 
 all_args = ['@overload\ndef create(']
 cfg['init_document'] = None
+cfg['resume_from'] = None
 for k, v in sorted(cfg.items(), key=lambda v: v[0]):
     v_type = type(v).__name__
     if k == 'init_image':
         v_type = 'str'
+    elif k == 'resume_from':
+        v_type = 'str'
     elif k == 'init_document':
         v_type = 'Union[\'Document\', \'DocumentArray\']'
-    elif k in ('seed', 'display_rate'):
+    elif k in ('seed', 'display_rate', 'init_loss_size'):
         v_type = 'int'
     elif k in ('text_prompts',):
         v_type = 'Union[List[str], Dict[str, Any]]'
@@ -0,0 +1,165 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from docarray import Document, DocumentArray
+
+from discoart.cache import ResultCache, TextEmbedsCache, get_result_key
+from discoart.config import load_config
+
+
+def test_text_embeds_cache(tmpdir):
+    cache = TextEmbedsCache(str(tmpdir), max_entries=2)
+    placement = 'cuda-torch.float16'
+    assert cache.get('ViT-B-32::openai', 'hello', False, placement) is None
+
+    embeds = np.random.random([1, 512]).astype(np.float16)
+    cache.put('ViT-B-32::openai', 'hello', False, placement, embeds)
+    np.testing.assert_array_equal(
+        cache.get('ViT-B-32::openai', 'hello', False, placement), embeds
+    )
+    assert cache.get('ViT-B-32::openai', 'hello', True, placement) is None
+    assert cache.get('RN50::openai', 'hello', False, placement) is None
+    assert cache.get('ViT-B-32::openai', 'hello', False, 'cpu-torch.float32') is None
+
+
+def test_text_embeds_cache_evict(tmpdir):
+    cache = TextEmbedsCache(str(tmpdir), max_entries=2)
+    for j in range(3):
+        cache.put(
+            'ViT-B-32::openai',
+            f'hello {j}',
+            False,
+            'cpu-torch.float32',
+            np.zeros([1, 512]),
+        )
+    assert len(tmpdir.listdir()) == 2
+
+
+class _TinyCLIP(torch.nn.Module):
+    def __init__(self, dtype):
+        super().__init__()
+        self.visual = torch.nn.Linear(4, 4)
+        self.text_projection = torch.nn.Parameter(
+            torch.randn(4, 8, dtype=dtype), requires_grad=False
+        )
+        self.num_encoded = 0
+
+    def encode_text(self, tokens):
+        self.num_encoded += 1
+        return tokens[:, :4].to(self.text_projection.dtype) @ self.text_projection
+
+
+def test_prompt_embeds_mix_cache_hits_and_misses(tmpdir):
+    from discoart.runner import _get_prompt_embeds
+
+    cache = TextEmbedsCache(str(tmpdir))
+    args = SimpleNamespace(truncate_overlength_prompt=False)
+    prompts = [SimpleNamespace(tokenized=t) for t in ('a lighthouse', 'a sea')]
+    device = torch.device('cpu')
+
+    m = _TinyCLIP(torch.float64)
+    expected = _get_prompt_embeds(m, 'tiny', prompts, args, device, None)
+
+    # a hit is cast to the dtype of the misses
+    cache.put(
+        'tiny',
+        'a lighthouse',
+        False,
+        'cpu-torch.float64',
+        expected[:1].numpy().astype(np.float32),
+    )
+    embeds = _get_prompt_embeds(m, 'tiny', prompts, args, device, cache)
+    assert embeds.dtype == torch.float64 and embeds.shape == (2, 8)
+    torch.testing.assert_close(embeds, expected, rtol=1e-6, atol=1e-6)
+    assert m.num_encoded == 3
+
+    # embeddings of another precision are not reused
+    m32 = _TinyCLIP(torch.float32)
+    assert _get_prompt_embeds(m32, 'tiny', prompts, args, device, cache).dtype == (
+        torch.float32
+    )
+    assert m32.num_encoded == 2
+
+
+def test_result_key():
+    cfg = load_config({'seed': 42, 'name_docarray': 'a'})
+    assert get_result_key(cfg) == get_result_key(
+        load_config({'seed': 42, 'name_docarray': 'b', 'save_rate': 1})
+    )
+    assert get_result_key(cfg) != get_result_key(load_config({'seed': 43}))
+    assert get_result_key(cfg) != get_result_key(
+        load_config({'seed': 42, 'steps': 100})
+    )
+
+
+def test_result_key_hashes_init_image(tmpdir):
+    init_path = str(tmpdir / 'init.png')
+    with open(init_path, 'wb') as fp:
+        fp.write(b'first')
+    cfg = load_config({'seed': 42, 'init_image': init_path})
+    key = get_result_key(cfg)
+    assert key == get_result_key(cfg)
+
+    # the key follows the content of the file, not its path
+    with open(init_path, 'wb') as fp:
+        fp.write(b'second')
+    assert get_result_key(cfg) != key
+
+    datauri = 'data:image/png;base64,Zmlyc3Q='
+    assert get_result_key(load_config({'seed': 42, 'init_image': datauri})) != (
+        get_result_key(load_config({'seed': 42, 'init_image': datauri[:-4]}))
+    )
+    # remote init images are not cached
+    assert (
+        get_result_key(load_config({'init_image': 'https://example.com/init.png'}))
+        is None
+    )
+
+
+def test_result_cache_evict(tmpdir):
+    cache = ResultCache(str(tmpdir))
+    assert cache.get('a') is None
+
+    da = DocumentArray(
+        Document(tags={'seed': 42}, uri=f'data:image/png;base64,{"A" * 4096}')
+        for _ in range(2)
+    )
+    da[0].chunks.append(Document())
+    cache.put('a', da)
+    cached = cache.get('a')
+    assert cached[:, 'id'] == da[:, 'id']
+    assert cached[:, 'uri'] == da[:, 'uri']
+    assert not cached[0].chunks
+
+    cache.max_size = os.path.getsize(tmpdir / 'a.protobuf.lz4') * 2
+    cache.put('b', da)
+    os.utime(tmpdir / 'a.protobuf.lz4', (0, 0))
+    cache.put('c', da)
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+
+
+def test_prompt_embeds_keep_text_tower_offloaded_on_cache_hits(tmpdir, monkeypatch):
+    from discoart import runner
+    from discoart.runner import _get_prompt_embeds
+
+    cache = TextEmbedsCache(str(tmpdir))
+    args = SimpleNamespace(truncate_overlength_prompt=False)
+    prompts = [SimpleNamespace(tokenized=t) for t in ('a lighthouse', 'a sea')]
+    device = torch.device('cpu')
+    m = _TinyCLIP(torch.float32)
+    expected = _get_prompt_embeds(m, 'tiny', prompts, args, device, cache)
+
+    loads = []
+    monkeypatch.setattr(runner, 'load_text_tower', lambda *args: loads.append(args))
+    embeds = _get_prompt_embeds(m, 'tiny', prompts, args, device, cache)
+    torch.testing.assert_close(embeds, expected)
+    assert not loads and m.num_encoded == 2
+
+    # one miss makes the text tower resident once
+    prompts.append(SimpleNamespace(tokenized='a storm'))
+    _get_prompt_embeds(m, 'tiny', prompts, args, device, cache)
+    assert len(loads) == 1 and m.num_encoded == 3
@@ -1,3 +1,6 @@
+from types import SimpleNamespace
+
+import numpy as np
 import pytest
 
 from discoart.config import default_args, save_config, load_config, export_python
@@ -100,3 +103,96 @@ def test_eval_config(field, val):
     cfg = load_config(default_args)
     cfg[field] = val
     assert load_config(cfg)[field] is not None
+
+
+@pytest.mark.parametrize(
+    'val',
+    [
+        '[12]*400+[4]*600',
+        '[0.2]*400+[0]*600',
+        '([1]+[2])*500',
+        '[True, False]*500',
+        '[-1]*500+[0]*250+[10]*250',
+        '[0.5]*400+[0.2]*300+[True]*300',
+        '0.5',
+        True,
+        [3] * 1000,
+    ],
+)
+def test_compile_schedule(val):
+    from discoart.schedule import compile_schedule
+
+    expected = eval(val) if isinstance(val, str) else val
+    if not isinstance(expected, list):
+        expected = [expected] * 1000
+    schedule = compile_schedule(val)
+    assert schedule.to_list() == expected
+    assert [schedule[j] for j in range(1000)] == expected
+    assert compile_schedule(str(schedule)) == schedule
+
+
+def test_compile_schedule_segments():
+    from discoart.schedule import compile_schedule
+
+    assert compile_schedule('[12]*400+[4]*600').segments == [(12, 400), (4, 600)]
+    assert str(compile_schedule([1] * 500 + [2] * 500)) == '[1]*500+[2]*500'
+    with pytest.raises(ValueError):
+        compile_schedule('[1]*999')
+    with pytest.raises(ValueError):
+        compile_schedule('[1]*10000000000')
+    with pytest.raises(ValueError):
+        compile_schedule('[hello]*1000')
+
+
+def test_schedule_table():
+    from discoart.schedule import ScheduleTable
+
+    cfg = load_config(default_args)
+    cfg['use_secondary_model'] = '[True]*500+[False]*500'
+    table = ScheduleTable.from_args(SimpleNamespace(**cfg))
+    for t in (0, 399, 400, 999):
+        scheduler = table[t]
+        for k in table.keys:
+            assert scheduler.__dict__[k] == _eval_scheduling_str(cfg[k])[t]
+    assert table[0].use_secondary_model is True
+    assert table[999].use_secondary_model is False
+    assert isinstance(table[0].cut_overview, int)
+
+
+def test_load_config_compact_schedule():
+    cfg = load_config({'cut_overview': [12] * 400 + [4] * 600})
+    assert cfg['cut_overview'] == '[12]*400+[4]*600'
+
+
+@pytest.mark.parametrize(
+    'val',
+    [
+        [1e-25] * 1000,
+        [1.234567e-15] * 500 + [2.0] * 500,
+        [1e20] * 1000,
+        [True] * 500 + [False] * 500,
+        [1] * 300 + [0] * 700,
+    ],
+)
+def test_compact_schedule_round_trip(val):
+    from discoart.schedule import (
+        ScheduleTable,
+        _get_cast_fn,
+        compact_schedule,
+        compile_schedule,
+    )
+
+    compacted = compact_schedule(val)
+    assert isinstance(compacted, str)
+    values = compile_schedule(compacted).to_list()
+    assert values == val
+    assert [type(v) for v in values] == [type(v) for v in val]
+
+    cfg = load_config(default_args)
+    cfg['clamp_grad'] = compacted
+    table = ScheduleTable.from_args(SimpleNamespace(**cfg))
+    assert [table[t].clamp_grad for t in range(1000)] == val
+    assert {type(table[t].clamp_grad) for t in range(1000)} == {type(val[0])}
+
+    # NumPy scalars are cast like their Python counterparts
+    assert _get_cast_fn(compile_schedule(list(np.array(val)))) is type(val[0])
@@ -0,0 +1,156 @@
+import pytest
+import torch
+from torchvision import transforms as T
+from torchvision.transforms import functional as TF
+
+from discoart.nn.make_cutouts import (
+    _CLIP_MEAN,
+    _CLIP_STD,
+    CutoutPlanner,
+    MakeCutouts,
+    _adjust_hue,
+)
+from discoart.nn.losses import spherical_dist_loss
+from discoart.nn.micro_batch import CutMicroBatcher, get_cut_loss
+
+
+@pytest.mark.parametrize('hue_factor', [-0.1, 0.0, 0.07])
+def test_adjust_hue(hue_factor):
+    x = torch.rand(2, 3, 32, 32) * 1.2 - 0.1
+    torch.testing.assert_close(
+        _adjust_hue(x, torch.full([2, 1, 1, 1], hue_factor)),
+        TF.adjust_hue(x, hue_factor),
+        atol=1e-5,
+        rtol=0,
+    )
+
+
+def test_batched_augment():
+    torch.manual_seed(0)
+    x = torch.rand(2, 3, 64, 48, requires_grad=True)
+    cuts = MakeCutouts(32, Overview=4, InnerCrop=4)
+    out = cuts(x)
+    assert out.shape == (16, 3, 32, 32)
+
+    out.mean().backward()
+    assert torch.isfinite(x.grad).all()
+
+
+def _augment_cut(c, params, i):
+    # the ops of `MakeCutouts.augment` with the parameters of cut `i`, without the noise
+    if params['is_flip'][i]:
+        c = TF.hflip(c)
+    c = TF.affine(
+        c,
+        angle=params['angles'][i].item(),
+        translate=[int(params['tx'][i]), int(params['ty'][i])],
+        scale=1.0,
+        shear=[0.0, 0.0],
+        interpolation=T.InterpolationMode.BILINEAR,
+        fill=[0.0],
+    )
+    if params['is_gray'][i]:
+        c = TF.rgb_to_grayscale(c, 3)
+    jitter_fns = (
+        TF.adjust_brightness,
+        TF.adjust_contrast,
+        TF.adjust_saturation,
+        TF.adjust_hue,
+    )
+    for fn_idx in params['jitter_order'][i].tolist():
+        c = jitter_fns[fn_idx](c, params['jitter_factors'][fn_idx, i].item())
+    return TF.normalize(c, _CLIP_MEAN, _CLIP_STD)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_batched_augment_matches_torchvision(monkeypatch, seed):
+    monkeypatch.setattr(torch, 'randn_like', torch.zeros_like)
+    torch.manual_seed(seed)
+    num_cuts = 8
+    cuts = [torch.rand(2, 3, 32, 32) for _ in range(num_cuts)]
+    params = MakeCutouts._sample_augment_params(num_cuts, 32, 32)
+    # every branch is taken by some cut
+    params['is_flip'][:2] = torch.tensor([True, False])
+    params['is_gray'][:2] = torch.tensor([True, False])
+    params['angles'][0] = 9.5
+
+    out = MakeCutouts(32)._augment_batch(cuts, params)
+    expected = torch.cat([_augment_cut(c, params, i) for i, c in enumerate(cuts)])
+    torch.testing.assert_close(out, expected, atol=1e-4, rtol=0)
+
+
+@pytest.mark.parametrize('share_innercut_geometry', [True, False])
+def test_cutout_planner(share_innercut_geometry):
+    x = torch.rand(1, 3, 64, 48)
+    planner = CutoutPlanner(
+        x, Overview=6, InnerCrop=2, share_innercut_geometry=share_innercut_geometry
+    )
+    cuts = planner.get_cuts(32, 0)
+    assert len(cuts) == 8
+    assert all(c.shape == (1, 3, 32, 32) for c in cuts)
+    torch.testing.assert_close(cuts[2], cuts[0].flip(-1))
+    assert cuts[4] is cuts[0]
+
+    other_cuts = planner.get_cuts(32, 0)
+    assert other_cuts[0] is cuts[0]
+    assert (other_cuts[-1] is cuts[-1]) == share_innercut_geometry
+    assert planner.get_cuts(32, 1)[-1] is not cuts[-1]
+    assert planner.get_cuts(16, 0)[0].shape == (1, 3, 16, 16)
+
+
+@pytest.mark.parametrize(
+    'budget_mb, expected', [(0, [1, 1, 1, 1, 1]), (100, [1] * 5), (1000, [3, 2])]
+)
+def test_cut_micro_batcher(budget_mb, expected):
+    batcher = CutMicroBatcher(budget_mb, torch.device('cpu'))
+    assert batcher.split('ViT-B-32::openai', 5, 4, 224) == expected
+
+
+@pytest.mark.parametrize('micro_batch_size', [1, 2, 3, 5])
+def test_micro_batched_cut_loss_gradient(micro_batch_size):
+    torch.manual_seed(0)
+    cutn_batches, num_cuts, batch_size, num_prompts = 5, 3, 2, 4
+    clip_model = torch.nn.Sequential(
+        torch.nn.Flatten(), torch.nn.Linear(3 * 8 * 8, 16)
+    ).double()
+    target_embeds = torch.randn(num_prompts, 16, dtype=torch.float64)
+    weights = torch.rand(num_prompts, dtype=torch.float64)
+    weights /= weights.sum()
+    scale = 1000
+    x_in = torch.randn(batch_size, 3, 16, 16, dtype=torch.float64)
+    # the cuts of each cutn batch, i.e. `num_cuts` tensors of `batch_size` images
+    crops = torch.randint(0, 8, (cutn_batches, num_cuts, 2)).tolist()
+
+    def _get_cuts(x, j):
+        return [x[:, :, r : r + 8, c : c + 8] for r, c in crops[j]]
+
+    def _dists(clip_in):
+        return spherical_dist_loss(
+            clip_model(clip_in).unsqueeze(1), target_embeds.unsqueeze(0)
+        )
+
+    # the original loop over the cutn batches
+    x = x_in.clone().requires_grad_()
+    expected = 0
+    for j in range(cutn_batches):
+        dists = _dists(torch.cat(_get_cuts(x, j)))
+        dists = dists.view([num_cuts, batch_size, -1])
+        loss = dists.mul(weights).sum(2).mean(0).sum() * scale / cutn_batches
+        expected += torch.autograd.grad(loss, x)[0]
+
+    x = x_in.clone().requires_grad_()
+    grad = 0
+    sizes = [micro_batch_size] * (cutn_batches // micro_batch_size)
+    sizes += (
+        [cutn_batches % micro_batch_size] if cutn_batches % micro_batch_size else []
+    )
+    j = 0
+    for size in sizes:
+        clip_in = torch.cat([c for k in range(size) for c in _get_cuts(x, j + k)])
+        j += size
+        loss = get_cut_loss(
+            _dists(clip_in), weights, size, num_cuts, batch_size, scale, cutn_batches
+        )
+        grad += torch.autograd.grad(loss, x)[0]
+
+    torch.testing.assert_close(grad, expected, rtol=1e-10, atol=1e-12)
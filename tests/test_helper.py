@@ -0,0 +1,116 @@
+import hashlib
+import inspect
+import os
+
+import pytest
+import torch
+
+from discoart import helper
+
+
+def test_check_sha_skips_verified_files(tmpdir, monkeypatch):
+    monkeypatch.delenv('DISCOART_DISABLE_CHECK_MODEL_SHA', raising=False)
+    monkeypatch.setattr(helper, '_VERIFIED_SHA_PATH', str(tmpdir / 'verified-sha.json'))
+    path = str(tmpdir / 'model.pt')
+    data = os.urandom(3 << 20)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    expected_sha = hashlib.sha256(data).hexdigest()
+
+    assert helper._check_sha(path, expected_sha)
+    assert not helper._check_sha(path, 'bad-sha')
+
+    num_reads = []
+    _open = open
+
+    def _counting_open(f, *args, **kwargs):
+        if f == path:
+            num_reads.append(f)
+        return _open(f, *args, **kwargs)
+
+    monkeypatch.setattr('builtins.open', _counting_open)
+    assert helper._check_sha(path, expected_sha)
+    assert not num_reads
+
+    # a changed file is hashed again
+    with _open(path, 'ab') as fp:
+        fp.write(b'x')
+    assert not helper._check_sha(path, expected_sha)
+    assert num_reads
+
+
+@pytest.mark.parametrize('use_fp16', [False, True])
+def test_load_diffusion_model_from_weight_cache(tmpdir, monkeypatch, use_fp16):
+    from guided_diffusion.script_util import create_model, model_and_diffusion_defaults
+
+    monkeypatch.delenv('DISCOART_DISABLE_WEIGHT_CACHE', raising=False)
+    monkeypatch.setattr(helper, 'cache_dir', str(tmpdir))
+    monkeypatch.setattr(helper, '_VERIFIED_SHA_PATH', str(tmpdir / 'verified-sha.json'))
+    cfg = model_and_diffusion_defaults()
+    cfg = {k: cfg[k] for k in inspect.signature(create_model).parameters if k in cfg}
+    cfg.update(
+        image_size=64,
+        num_channels=32,
+        num_res_blocks=1,
+        channel_mult='1,1,2,2',
+        attention_resolutions='8',
+        learn_sigma=True,
+        use_fp16=use_fp16,
+    )
+    path = str(tmpdir / 'custom.pt')
+    torch.save(create_model(**cfg).state_dict(), path)
+
+    expected = helper._load_diffusion_model(path, cfg, torch.device('cpu'))
+    assert len((tmpdir / 'weights').listdir()) == 1
+
+    # the converted weights are memory-mapped from the cache, the checkpoint is not read again
+    def _fail(*args, **kwargs):
+        raise AssertionError('the checkpoint is loaded')
+
+    monkeypatch.setattr(torch, 'load', _fail)
+    model = helper._load_diffusion_model(path, cfg, torch.device('cpu'))
+    expected_state = expected.state_dict()
+    for name, t in model.state_dict().items():
+        assert t.dtype == expected_state[name].dtype
+        assert torch.equal(t, expected_state[name]), name
+    assert all(p.requires_grad for n, p in model.named_parameters() if 'qkv' in n)
+
+
+def test_save_verified_sha_from_threads(tmpdir, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(helper, '_VERIFIED_SHA_PATH', str(tmpdir / 'verified-sha.json'))
+    paths = [f'/models/{j}.pt' for j in range(32)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda p: helper._save_verified_sha(p, {'sha': p}), paths))
+
+    assert set(helper._load_verified_sha()) == set(paths)
+    assert tmpdir.listdir() == [tmpdir / 'verified-sha.json']
+
+
+def test_remote_model_list_is_swapped(monkeypatch):
+    import contextlib
+    import io
+
+    import yaml
+
+    monkeypatch.delenv('DISCOART_DISABLE_REMOTE_MODELS', raising=False)
+    local_models = helper.models_list
+    monkeypatch.setattr(helper, 'models_list', local_models)
+    remote_models = {**local_models, 'remote-model': {'sha': 'x', 'sources': []}}
+    monkeypatch.setattr(
+        helper,
+        'urlopen',
+        lambda *args, **kwargs: contextlib.closing(
+            io.BytesIO(yaml.dump(remote_models).encode())
+        ),
+    )
+
+    # a loader on another thread may be iterating the local list meanwhile
+    it = iter(local_models)
+    next(it)
+    helper.get_remote_model_list(helper.models_list)
+    list(it)
+
+    assert 'remote-model' not in local_models
+    assert helper._get_model_name('remote-model') == 'remote-model'
@@ -0,0 +1,26 @@
+import subprocess
+import sys
+
+_SCRIPT = '''
+import sys, threading, time
+
+t = time.perf_counter()
+import discoart
+from discoart import cheatsheet, load_config
+
+load_config({})
+print(time.perf_counter() - t)
+print(','.join(m for m in ('torch', 'docarray', 'discoart.helper') if m in sys.modules))
+print(threading.active_count())
+'''
+
+
+def test_import_is_fast_and_side_effect_free():
+    output = subprocess.run(
+        [sys.executable, '-c', _SCRIPT], capture_output=True, text=True, check=True
+    ).stdout.splitlines()
+    import_time, heavy_modules, num_threads = output[-3:]
+    assert not heavy_modules
+    assert num_threads == '1'
+    # loading torch alone takes longer than this
+    assert float(import_time) < 2
@@ -0,0 +1,61 @@
+import threading
+
+from docarray import Document, DocumentArray
+
+from discoart import persist
+from discoart.persist import PersistWorker
+
+
+def test_persist_worker_order_and_coalesce():
+    worker = PersistWorker(maxsize=8)
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def _slow_job():
+        started.set()
+        release.wait()
+
+    worker.submit(_slow_job)
+    started.wait()
+    for j in range(3):
+        worker.submit(results.append, f'sample-{j}')
+        worker.submit(results.append, f'progress-{j}', key='progress')
+    release.set()
+    worker.wait()
+    assert results == ['sample-0', 'sample-1', 'sample-2', 'progress-2']
+
+    worker.submit(results.append, 'final')
+    worker.close()
+    assert results[-1] == 'final'
+
+
+def test_cloud_backup_is_a_snapshot(tmpdir, monkeypatch):
+    monkeypatch.delenv('DISCOART_OPTOUT_CLOUD_BACKUP', raising=False)
+    monkeypatch.setenv('DISCOART_OUTPUT_DIR', str(tmpdir))
+    release = threading.Event()
+    pushed = []
+
+    def _cloud_push(da, name):
+        release.wait()
+        pushed.append((da, name))
+
+    monkeypatch.setattr(persist, '_cloud_push', _cloud_push)
+
+    da = DocumentArray([Document(tags={'_status': {'step': 0}})])
+    da[0].chunks.append(Document(tags={'step': 0}))
+    worker = PersistWorker()
+    worker.submit_backup(da, 'test-backup')
+    worker.wait()
+
+    # the sampling goes on while the backup is pushed
+    da[0].chunks.append(Document(tags={'step': 1}))
+    da[0].tags['_status'] = {'step': 1}
+    release.set()
+    worker.close()
+
+    ((snapshot, name),) = pushed
+    assert name == 'test-backup'
+    assert snapshot[0].id == da[0].id
+    assert snapshot[0].tags['_status'] == {'step': 0}
+    assert len(snapshot[0].chunks) == 1
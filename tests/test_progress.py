@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from discoart.progress import GifWriter, SpriteWriter, count_save_steps
+
+
+def _random_image(seed, size=(48, 32)):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray((rng.random((size[1], size[0], 3)) * 255).astype('uint8'))
+
+
+def test_gif_writer_appends_frames(tmpdir):
+    path = str(tmpdir / 'progress.gif')
+    writer = GifWriter(path, duration=100, size_ratio=0.5, show_index=False)
+    images = [_random_image(j) for j in range(5)]
+    for j, image in enumerate(images):
+        writer.append(image)
+        if j % 2 == 0:
+            writer.flush()
+    writer.flush()
+
+    gif = Image.open(path)
+    assert gif.n_frames == 5
+    assert gif.size == (24, 16)
+    assert gif.info['duration'] == 100
+    for j, image in enumerate(images):
+        gif.seek(j)
+        diff = np.asarray(gif.convert('RGB'), dtype=float) - np.asarray(
+            image.resize(gif.size), dtype=float
+        )
+        assert np.abs(diff).mean() < 16
+
+
+def test_sprite_writer_grows(tmpdir):
+    path = str(tmpdir / 'progress.png')
+    writer = SpriteWriter(path, num_tiles=2, canvas_size=64, show_index=False)
+    for j in range(5):
+        writer.append(_random_image(j))
+    writer.save()
+    # the capacity grows from 2 to 8 tiles, which are laid out as 3x3 tiles of 21x14
+    assert Image.open(path).size == (63, 42)
+
+
+@pytest.mark.parametrize(
+    'num_steps, save_rate, expected',
+    [(10, 3, 4), (10, 1, 10), (10, 4, 4), (10, 9, 2), (10, 0, 1)],
+)
+def test_count_save_steps(num_steps, save_rate, expected):
+    assert count_save_steps(num_steps, save_rate) == expected
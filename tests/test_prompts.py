@@ -1,7 +1,9 @@
 from types import SimpleNamespace
 
+import torch
+
 from discoart.config import default_args
-from discoart.prompt import PromptPlanner
+from discoart.prompt import PromptPlanner, PromptWeights
 
 
 def test_prompt_builder_default_args():
@@ -132,3 +134,55 @@ def test_prompt_get_active_based_on_weights():
                 (1,),
                 (10,),
             )
+
+
+def test_prompt_get_active_steps():
+    smp = SimpleNamespace(**default_args)
+    smp.clip_models = set(['a', 'b'])
+    smp.text_prompts = {
+        'version': '1',
+        'prompts': [
+            {
+                'text': 'hello',
+                'clip_guidance': ['a'],
+                'schedule': '[True]*500+[False]*500',
+            },
+            {'text': 'bye', 'weight': '[0]*800+[1]*200'},
+        ],
+    }
+    pp = PromptPlanner(smp)
+    for i, (a, b) in enumerate(zip(pp.get_active_steps('a'), pp.get_active_steps('b'))):
+        assert a == (i < 500 or i >= 800)
+        assert b == (i >= 800)
+
+
+def test_prompt_weights():
+    smp = SimpleNamespace(**default_args)
+    smp.text_prompts = {
+        'version': '1',
+        'prompts': [
+            {'text': 'hello', 'weight': '[10]*500+[5]*250+[0]*250'},
+            {'text': 'bye', 'weight': '[-1]*500+[0]*250+[10]*250'},
+        ],
+    }
+    pp = PromptPlanner(smp)
+    embeds = torch.rand(2, 512)
+    pw = PromptWeights(pp.get_weight_table(smp.clip_models[0]), embeds)
+    for i in range(0, 1000):
+        ids, weights = pp.get_prompt_ids(smp.clip_models[0], i)
+        active_ids, masked_embeds, masked_weights = pw[i]
+        assert active_ids == list(ids)
+        torch.testing.assert_close(masked_embeds, embeds[active_ids])
+        torch.testing.assert_close(
+            masked_weights,
+            torch.nn.functional.normalize(
+                torch.tensor(weights, dtype=torch.float16), dim=0
+            ),
+        )
+    assert pw[0][1] is pw[499][1]
+
+    smp.text_prompts['prompts'][0]['schedule'] = '[True]*500+[False]*500'
+    smp.text_prompts['prompts'][1]['schedule'] = '[True]*500+[False]*500'
+    pp = PromptPlanner(smp)
+    pw = PromptWeights(pp.get_weight_table(smp.clip_models[0]), embeds)
+    assert pw[800] is None
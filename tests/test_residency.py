@@ -0,0 +1,164 @@
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from discoart import residency
+from discoart.residency import (
+    ModelCache,
+    get_model_size,
+    load_text_tower,
+    offload_text_tower,
+    text_tower_lease,
+)
+
+
+def test_model_cache_lru():
+    model_size = get_model_size(torch.nn.Linear(16, 16))
+    assert model_size == (16 * 16 + 16) * 4
+
+    cache = ModelCache(max_size=2 * model_size)
+    num_loads = []
+
+    def _load():
+        num_loads.append(1)
+        return torch.nn.Linear(16, 16)
+
+    m = cache.get_or_load(('a',), _load)
+    assert cache.get_or_load(('a',), _load) is m
+    cache.get_or_load(('b',), _load)
+    assert len(num_loads) == 2
+
+    # `a` is used more recently than `b`, so `b` is evicted
+    cache.get_or_load(('a',), _load)
+    cache.get_or_load(('c',), _load)
+    assert ('a',) in cache and ('c',) in cache and ('b',) not in cache
+    assert cache.size == 2 * model_size
+
+    # a model larger than the budget is still kept, as it is in use
+    cache.get_or_load(('d',), lambda: torch.nn.Linear(64, 64))
+    assert len(cache) == 1 and ('d',) in cache
+
+
+def test_model_cache_loads_concurrently():
+    cache = ModelCache(max_size=1 << 30)
+    num_loads = []
+
+    def _load():
+        num_loads.append(1)
+        time.sleep(0.2)
+        return torch.nn.Linear(4, 4)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(4) as executor:
+        models = list(executor.map(lambda k: cache.get_or_load((k,), _load), 'aabb'))
+    assert time.perf_counter() - start < 0.4
+    assert len(num_loads) == 2
+    assert models[0] is models[1] and models[2] is models[3]
+
+
+def test_model_cache_retries_failed_load():
+    cache = ModelCache(max_size=1 << 30)
+    num_loads = []
+
+    def _load():
+        num_loads.append(1)
+        if len(num_loads) == 1:
+            raise OSError('download failed')
+        return torch.nn.Linear(4, 4)
+
+    with pytest.raises(OSError):
+        cache.get_or_load(('a',), _load)
+    assert ('a',) not in cache and not cache._loading
+
+    model = cache.get_or_load(('a',), _load)
+    assert cache.get_or_load(('a',), _load) is model
+    assert len(num_loads) == 2 and not cache._loading
+
+
+class _TinyCLIP(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.visual = torch.nn.Linear(4, 4)
+        self.transformer = torch.nn.Linear(4, 4)
+        self.text_projection = torch.nn.Parameter(torch.randn(4, 4))
+        self.register_buffer('attn_mask', torch.ones(4))
+
+    def encode_text(self, x):
+        return self.transformer(x * self.attn_mask) @ self.text_projection
+
+
+@pytest.mark.parametrize('policy', ['keep', 'offload', 'release'])
+def test_text_tower_residency(monkeypatch, policy):
+    torch.manual_seed(0)
+    m = _TinyCLIP()
+    state = copy.deepcopy(m.state_dict())
+    x = torch.randn(2, 4)
+    expected = m.encode_text(x)
+
+    offload_text_tower(m, policy)
+    is_released = policy == 'release'
+    assert (m.transformer.weight.device.type == 'meta') == is_released
+    assert (m.attn_mask.device.type == 'meta') == is_released
+    assert m.visual.weight.device.type == 'cpu'
+
+    def _load_clip_model(name, device):
+        fresh = _TinyCLIP()
+        fresh.load_state_dict(state)
+        return fresh
+
+    monkeypatch.setattr(residency, '_load_clip_model', _load_clip_model)
+    load_text_tower(m, 'tiny', torch.device('cpu'))
+    assert torch.equal(m.encode_text(x), expected)
+    assert torch.equal(m.visual.weight, state['visual.weight'])
+
+
+def test_model_cache_tracks_text_tower(monkeypatch):
+    torch.manual_seed(0)
+    state = _TinyCLIP().state_dict()
+
+    def _load():
+        m = _TinyCLIP()
+        m.load_state_dict(state)
+        return m
+
+    full_size = get_model_size(_load())
+    cache = ModelCache(max_size=full_size)
+    monkeypatch.setattr(residency, '_model_cache', cache)
+    monkeypatch.setattr(residency, '_load_clip_model', lambda name, device: _load())
+
+    # two runs share the cached CLIP model
+    first = cache.get_or_load(('clip', 'tiny'), _load)
+    second = cache.get_or_load(('clip', 'tiny'), _load)
+    assert first is second
+    x = torch.randn(2, 4)
+    expected = first.encode_text(x)
+
+    offload_text_tower(first, 'release')
+    assert cache.size == get_model_size(first.visual) < full_size
+    # the freed memory makes room for another model
+    cache.get_or_load(('other',), lambda: torch.nn.Linear(4, 4))
+    assert ('other',) in cache
+
+    # the second run finds the text tower released and loads it again
+    load_text_tower(second, 'tiny', torch.device('cpu'))
+    assert torch.equal(second.encode_text(x), expected)
+    assert cache.size == full_size
+    assert ('other',) not in cache and ('clip', 'tiny') in cache
+
+
+def test_text_tower_lease_waits_for_all_runs():
+    torch.manual_seed(0)
+    m = _TinyCLIP()
+    x = torch.randn(2, 4)
+    expected = m.encode_text(x)
+
+    with text_tower_lease(m, 'release'):
+        # another run with the same cached model finishes its prompts first
+        with text_tower_lease(m, 'release'):
+            pass
+        assert torch.equal(m.encode_text(x), expected)
+    assert m.transformer.weight.device.type == 'meta'
+    assert m.visual.weight.device.type == 'cpu'
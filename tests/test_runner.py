@@ -0,0 +1,170 @@
+import os
+import threading
+from types import SimpleNamespace
+
+import torch
+from docarray import DocumentArray
+from guided_diffusion.script_util import (
+    create_model_and_diffusion,
+    model_and_diffusion_defaults,
+)
+
+from discoart import persist
+from discoart.config import load_config
+from discoart.runner import do_run
+
+
+def _tiny_model_and_diffusion(steps):
+    torch.manual_seed(0)
+    cfg = model_and_diffusion_defaults()
+    cfg.update(
+        image_size=64,
+        num_channels=32,
+        num_res_blocks=1,
+        channel_mult='1,1,2,2',
+        attention_resolutions='8',
+        learn_sigma=True,
+        diffusion_steps=100,
+        timestep_respacing=f'ddim{steps}',
+        rescale_timesteps=True,
+        use_fp16=False,
+    )
+    model, diffusion = create_model_and_diffusion(**cfg)
+    return model.eval().requires_grad_(False), diffusion
+
+
+def _spill_run(output_dir, monkeypatch, n_batches):
+    monkeypatch.setenv('DISCOART_OUTPUT_DIR', str(output_dir))
+    monkeypatch.setenv('DISCOART_DISABLE_TQDM', '1')
+    monkeypatch.delenv('DISCOART_OPTOUT_CLOUD_BACKUP', raising=False)
+    pushed = []
+    monkeypatch.setattr(
+        persist, '_cloud_push', lambda da, name: pushed.append((da, name))
+    )
+
+    args = SimpleNamespace(
+        **load_config(
+            dict(
+                steps=3,
+                width_height=[64, 64],
+                n_batches=n_batches,
+                batch_size=2,
+                clip_models=[],
+                use_secondary_model=False,
+                save_rate=2,
+                gif_fps=-1,
+                spill_batches=True,
+                name_docarray='spill',
+                seed=1,
+            )
+        )
+    )
+    model, diffusion = _tiny_model_and_diffusion(args.steps)
+    events = (threading.Event(), threading.Event())
+    da = do_run(args, (model, diffusion, {}, None), torch.device('cpu'), events)
+    return da, pushed
+
+
+def test_spill_batches(tmpdir, monkeypatch):
+    da, pushed = _spill_run(tmpdir, monkeypatch, n_batches=3)
+
+    assert len(da) == 6
+    # every batch is in the results, each with its own seed
+    assert len(set(da[:, 'tags__seed'])) == 3
+    for d in da:
+        assert d.tags['_status']['completed']
+        assert d.uri.startswith('data:image/png')
+        assert d.chunks
+
+    # the spilled results are reopened from SQLite
+    spill_path = os.path.join(tmpdir, 'spill', 'da.sqlite')
+    reopened = DocumentArray(
+        storage='sqlite', config={'connection': spill_path, 'table_name': 'discoart'}
+    )
+    assert reopened[:, 'id'] == da[:, 'id']
+    assert reopened[:, 'uri'] == da[:, 'uri']
+    assert reopened[:, 'tags__seed'] == da[:, 'tags__seed']
+
+    # every batch is backed up on its own, the last backup of a batch holds it finished
+    last_pushed = {name: snapshot for snapshot, name in pushed}
+    assert sorted(last_pushed) == ['spill-0', 'spill-1', 'spill-2']
+    for nb, name in enumerate(sorted(last_pushed)):
+        snapshot = last_pushed[name]
+        assert snapshot[:, 'id'] == da[nb * 2 : nb * 2 + 2, 'id']
+        assert all(d.tags['_status']['completed'] for d in snapshot)
+
+
+def test_spill_backup_does_not_grow_with_batches(tmpdir, monkeypatch):
+    def _max_backup_size(pushed):
+        return max(len(da) + sum(len(d.chunks) for d in da) for da, _ in pushed)
+
+    _, pushed_one = _spill_run(tmpdir / 'one', monkeypatch, n_batches=1)
+    _, pushed_many = _spill_run(tmpdir / 'many', monkeypatch, n_batches=4)
+
+    assert _max_backup_size(pushed_many) == _max_backup_size(pushed_one)
+
+
+class _StubCLIP(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.visual = torch.nn.Linear(3, 8)
+        self.visual.input_resolution = 32
+        self.text_projection = torch.nn.Parameter(
+            torch.randn(77, 8), requires_grad=False
+        )
+
+    def encode_image(self, x):
+        return self.visual(x.mean(dim=(2, 3)))
+
+    def encode_text(self, tokens):
+        return tokens.float() @ self.text_projection
+
+
+class _CountingUNet(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.num_grad_calls = 0
+
+    def forward(self, x, ts, **kwargs):
+        self.num_grad_calls += torch.is_grad_enabled()
+        return self.model(x, ts, **kwargs)
+
+
+def test_plms_runs_one_grad_forward_per_evaluation(tmpdir, monkeypatch):
+    monkeypatch.setenv('DISCOART_OUTPUT_DIR', str(tmpdir))
+    monkeypatch.setenv('DISCOART_DISABLE_TQDM', '1')
+    monkeypatch.setenv('DISCOART_OPTOUT_CLOUD_BACKUP', '1')
+    monkeypatch.setenv('DISCOART_DISABLE_TEXT_EMBEDS_CACHE', '1')
+
+    args = SimpleNamespace(
+        **load_config(
+            dict(
+                steps=3,
+                width_height=[64, 64],
+                n_batches=1,
+                batch_size=1,
+                clip_models=['stub'],
+                use_secondary_model=False,
+                diffusion_sampling_mode='plms',
+                cutn_batches=1,
+                cut_overview='[2]*1000',
+                cut_innercut='[0]*1000',
+                gif_fps=-1,
+                name_docarray='plms',
+                seed=1,
+            )
+        )
+    )
+    model, diffusion = _tiny_model_and_diffusion(args.steps)
+    model = _CountingUNet(model)
+    events = (threading.Event(), threading.Event())
+    do_run(
+        args,
+        (model, diffusion, {'stub': _StubCLIP()}, None),
+        torch.device('cpu'),
+        events,
+    )
+
+    # the first step evaluates the model twice, each with one forward that `cond_fn` differentiates
+    assert model.num_grad_calls == diffusion.num_timesteps + 1
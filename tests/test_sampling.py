@@ -0,0 +1,86 @@
+import pytest
+import torch
+from guided_diffusion.script_util import (
+    create_model_and_diffusion,
+    model_and_diffusion_defaults,
+)
+
+from discoart.nn.helper import get_rng_state, set_rng_state
+from discoart.nn.sampling import sample_loop_progressive
+
+
+@pytest.fixture(scope='module')
+def model_and_diffusion():
+    torch.manual_seed(0)
+    cfg = model_and_diffusion_defaults()
+    cfg.update(
+        image_size=64,
+        num_channels=32,
+        num_res_blocks=1,
+        channel_mult='1,1,2,2',
+        attention_resolutions='8',
+        learn_sigma=True,
+        diffusion_steps=100,
+        timestep_respacing='ddim6',
+        rescale_timesteps=True,
+        use_fp16=False,
+    )
+    model, diffusion = create_model_and_diffusion(**cfg)
+    return model.eval().requires_grad_(False), diffusion
+
+
+def _cond_fn(x, t, **kwargs):
+    # a random guidance, so that the random states matter
+    return torch.randn_like(x) * 0.01
+
+
+@pytest.mark.parametrize('sampling_mode', ['ddim', 'plms'])
+def test_sample_loop_matches_guided_diffusion(model_and_diffusion, sampling_mode):
+    model, diffusion = model_and_diffusion
+    shape = (1, 3, 64, 64)
+    kwargs = dict(cond_fn=_cond_fn, model_kwargs={}, skip_timesteps=1)
+    if sampling_mode == 'ddim':
+        sample_fn, mode_kwargs = diffusion.ddim_sample_loop_progressive, {'eta': 0.8}
+    else:
+        sample_fn, mode_kwargs = diffusion.plms_sample_loop_progressive, {'order': 2}
+
+    torch.manual_seed(1)
+    expected = [
+        out['sample'] for out in sample_fn(model, shape, **kwargs, **mode_kwargs)
+    ]
+
+    torch.manual_seed(1)
+    outputs = []
+    for j, out in enumerate(
+        sample_loop_progressive(
+            diffusion, model, shape, sampling_mode, **kwargs, **mode_kwargs
+        )
+    ):
+        outputs.append(out['sample'])
+        if j == 2:
+            checkpoint = dict(
+                x=out['sample'].clone(),
+                old_eps=[e.clone() for e in out.get('old_eps', [])],
+                rng_state=get_rng_state(),
+            )
+    for x, y in zip(outputs, expected):
+        torch.testing.assert_close(x, y)
+
+    set_rng_state(checkpoint['rng_state'])
+    resumed = [
+        out['sample']
+        for out in sample_loop_progressive(
+            diffusion,
+            model,
+            shape,
+            sampling_mode,
+            **kwargs,
+            **mode_kwargs,
+            start_step=3,
+            x=checkpoint['x'],
+            old_eps=checkpoint['old_eps'],
+        )
+    ]
+    assert len(resumed) == len(expected) - 3
+    for x, y in zip(resumed, expected[3:]):
+        torch.testing.assert_close(x, y)
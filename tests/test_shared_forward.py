@@ -0,0 +1,52 @@
+import torch
+
+from discoart.nn.shared_forward import SharedForward
+
+
+class _CountingModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.tensor(2.0))
+        self.num_calls = 0
+        self.num_grad_calls = 0
+
+    def forward(self, x, ts):
+        self.num_calls += 1
+        self.num_grad_calls += torch.is_grad_enabled()
+        return x * self.weight
+
+
+def test_shared_forward_reuses_leaf():
+    model = _CountingModel()
+    is_enabled = [True]
+    shared = SharedForward(model, lambda: is_enabled[0])
+    x = torch.ones(2)
+    ts = torch.zeros(1)
+
+    out = shared(x, ts)
+    assert out.requires_grad and model.num_grad_calls == 1
+
+    # `cond_fn` gets the leaf of the same `x` and reuses the output
+    leaf = shared.get_leaf(x)
+    assert leaf.requires_grad and shared.get_leaf(x) is leaf
+    assert shared(leaf, ts) is out
+    assert model.num_calls == 1
+    (grad,) = torch.autograd.grad(out.sum(), leaf)
+    torch.testing.assert_close(grad, torch.full([2], 2.0))
+
+    # another `x` invalidates the kept forward
+    y = torch.ones(2)
+    assert shared.get_leaf(y) is not leaf
+    shared(y, ts)
+    assert shared.get_leaf(x) is not leaf
+    assert model.num_calls == 2
+
+    shared.clear()
+    assert shared.get_leaf(y) is not shared.get_leaf(y)
+
+    # without sharing, the sampler's forward runs without grad
+    is_enabled[0] = False
+    with torch.no_grad():
+        out = shared(x, ts)
+    assert not out.requires_grad
+    assert model.num_grad_calls == 2 and model.num_calls == 3
@@ -0,0 +1,39 @@
+import pytest
+from spellchecker import SpellChecker
+
+from discoart.spell import SymSpell, damerau_levenshtein
+
+_WORD_FREQS = {
+    'lighthouse': 10,
+    'painting': 20,
+    'paining': 5,
+    'artstation': 3,
+    'rutkowski': 2,
+    'kinkade': 2,
+    'kinked': 1,
+    'abc': 1,
+}
+
+
+@pytest.mark.parametrize(
+    'a, b, distance',
+    [('ca', 'abc', 2), ('abc', 'abc', 0), ('kitten', 'sitting', 3), ('ab', 'ba', 1)],
+)
+def test_damerau_levenshtein(a, b, distance):
+    assert damerau_levenshtein(a, b) == distance
+
+
+@pytest.mark.parametrize(
+    'word',
+    ['lighthuose', 'paintng', 'artstaton', 'rutkowksy', 'kinkde', 'ca', 'qwzxrtyp'],
+)
+def test_symspell_same_as_spellchecker(tmpdir, word):
+    spell = SpellChecker(language=None)
+    spell.word_frequency.load_json(_WORD_FREQS)
+
+    SymSpell.build(_WORD_FREQS).save(str(tmpdir))
+    sym_spell = SymSpell.load(str(tmpdir))
+
+    assert sym_spell.unknown([word]) == spell.unknown([word])
+    assert sym_spell.candidates(word) == spell.candidates(word)
+    assert sym_spell.correction(word) == spell.correction(word)
@@ -0,0 +1,31 @@
+import time
+from types import SimpleNamespace
+
+from discoart import startup
+from discoart.config import load_config
+
+
+def test_prepare_run_loads_concurrently(monkeypatch):
+    def _load(*args):
+        time.sleep(0.2)
+        return args
+
+    monkeypatch.setattr(startup, 'load_diffusion_model', lambda a, d: _load(a, d))
+    monkeypatch.setattr(startup, 'load_secondary_model', _load)
+    monkeypatch.setattr(
+        startup, 'load_clip_models', lambda d, enabled, _: {enabled[0]: _load()}
+    )
+    args = SimpleNamespace(**load_config({'text_prompts': ['a lighthouse']}))
+
+    models, prompts, timings = startup.prepare_run(args, 'cpu')
+    assert list(models[2]) == args.clip_models
+    assert prompts.prompts[0].tokenized == 'a lighthouse'
+    assert set(timings) == {
+        'diffusion',
+        'secondary',
+        'prompts',
+        'total',
+        *(f'clip {k}' for k in args.clip_models),
+    }
+    # the jobs overlap
+    assert timings['total'] < sum(v for k, v in timings.items() if k != 'total')
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+from docarray import Document, DocumentArray
+from PIL import Image
+
+from discoart.frames import new_frame
+from discoart.store import ResultStore, load_results
+
+
+def test_result_store_append_and_compact(tmpdir):
+    da = DocumentArray([Document(tags={'step': 0}) for _ in range(2)])
+    store = ResultStore(str(tmpdir), min_segments_to_compact=100)
+    assert load_results(str(tmpdir)) is None
+
+    for j in range(3):
+        for d in da:
+            d.chunks.append(Document(tags={'step': j}))
+            d.tags['step'] = j
+        store.append(da)
+
+    assert len(os.listdir(os.path.join(tmpdir, 'da.segments'))) == 3
+    loaded = load_results(str(tmpdir))
+    assert loaded[:, 'id'] == da[:, 'id']
+    assert loaded[:, 'tags__step'] == [2, 2]
+    assert [c.tags['step'] for c in loaded[0].chunks] == [0, 1, 2]
+
+    store.compact()
+    assert os.path.exists(os.path.join(tmpdir, 'da.protobuf.lz4'))
+    assert not os.listdir(os.path.join(tmpdir, 'da.segments'))
+    loaded = load_results(str(tmpdir))
+    assert loaded[1].chunks[:, 'id'] == da[1].chunks[:, 'id']
+
+
+def test_result_store_serializes_frames_as_datauri(tmpdir):
+    image = Image.fromarray(np.full([8, 8, 3], 127, dtype='uint8'))
+    image.save(str(tmpdir / 'step.png'))
+    d = Document(tensor=np.asarray(image))
+    d.chunks.append(new_frame(image, tags={}, path=str(tmpdir / 'step.png')))
+    d.chunks.append(new_frame(image, tags={}))
+    assert not d.chunks[0].uri.startswith('data:')
+    assert d.chunks[1].blob and d.chunks[1].tensor is None
+
+    ResultStore(str(tmpdir)).append(DocumentArray([d]))
+    loaded = load_results(str(tmpdir))[0]
+    for doc in [loaded, *loaded.chunks]:
+        assert doc.uri.startswith('data:image/png;base64,')
+        doc.load_uri_to_image_tensor()
+        np.testing.assert_array_equal(doc.tensor, np.asarray(image))
+
+
+def _frame_nbytes(d):
+    return len(d.uri or '') + len(d.blob or b'') + getattr(d.tensor, 'nbytes', 0)
+
+
+def test_frame_memory_with_and_without_image_output(tmpdir):
+    x, y = np.meshgrid(np.arange(256), np.arange(256))
+    pixels = np.stack([x, y, (x + y) // 2], axis=-1).astype('uint8')
+    image = Image.fromarray(pixels)
+    image.save(str(tmpdir / 'step.png'))
+
+    # `image_output=True` only refers to the saved file
+    saved = new_frame(image, tags={}, path=str(tmpdir / 'step.png'))
+    assert _frame_nbytes(saved) < 1024
+    # `image_output=False` keeps the PNG bytes instead of the raw pixels
+    kept = new_frame(image, tags={})
+    assert _frame_nbytes(kept) < pixels.nbytes / 4
+    np.testing.assert_array_equal(
+        Document(blob=kept.blob).convert_blob_to_image_tensor().tensor, pixels
+    )
@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+
+from discoart.schedule import ScheduleTable, compile_schedule
+from discoart.telemetry import LossTracker
+
+
+def test_loss_tracker():
+    tracker = LossTracker(torch.device('cpu'), capacity=2)
+    telemetry = tracker.start_batch(2)
+    for j in range(3):
+        tracker.record(
+            j,
+            {'total': torch.tensor(j + 1.0), 'tv': 0, 'cuts': torch.tensor(0.5)},
+            torch.tensor(j == 1),
+        )
+    assert telemetry.latest_loss is None
+
+    tracker.flush()
+    assert telemetry.latest_loss == 3.0
+    assert telemetry.summary() == {'loss': 3.0, 'num_nan': 1}
+
+    tracker.record(3, {'total': 4.0}, torch.tensor(False))
+    next_telemetry = tracker.start_batch(2)
+    assert next_telemetry.latest_loss is None
+
+    arrays = telemetry.snapshot()
+    np.testing.assert_array_equal(arrays['step'], [0, 1, 2, 3])
+    np.testing.assert_array_equal(arrays['loss'][:, 0], [1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_array_equal(arrays['loss'][:, -1], [0.5, 0.5, 0.5, 0])
+    np.testing.assert_array_equal(arrays['is_nan'], [False, True, False, False])
+
+
+def test_step_telemetry_snapshot(tmpdir):
+    tracker = LossTracker(torch.device('cpu'))
+    telemetry = tracker.start_batch(3)
+    for j in range(3):
+        tracker.record(j, {'total': 1.0}, torch.tensor(False))
+        telemetry.add_step_time(0.1)
+    tracker.flush()
+
+    table = ScheduleTable({'tv_scale': compile_schedule('[0]*500+[1]*500')})
+    path = str(tmpdir / 'telemetry.npz')
+    np.savez_compressed(path, **telemetry.snapshot(table))
+    arrays = np.load(path)
+    assert arrays['step_time'].shape == (3,)
+    assert list(arrays['scheduler_keys']) == ['tv_scale']
+    np.testing.assert_array_equal(arrays['scheduler'][:, 0], [0, 0, 0])